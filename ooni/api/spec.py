@@ -46,7 +46,11 @@ class ORequestHandler(web.RequestHandler):
 class Status(ORequestHandler):
     @check_xsrf
     def get(self):
-        result = {'active_tests': oonidApplication.director.activeNetTests}
+        director = oonidApplication.director
+        result = {
+            'active_tests': director.activeNetTests,
+            'measurement_concurrency': director.measurementConcurrency
+        }
         self.write(result)
 
 def list_inputs():
@@ -14,9 +14,65 @@ _twisted_14_0_2_version = Version('twisted', 14, 0, 2)
 
 from ooni import errors as e
 from ooni.settings import config
+from ooni.common.txextra import HTTPConnectionPool
 from ooni.utils import log, onion
 from ooni.utils.net import BodyReceiver, StringProducer, Downloader
-from ooni.utils.socks import TrueHeadersSOCKS5Agent
+
+
+class OONIBConnectionPool(HTTPConnectionPool):
+    """
+    A pool of persistent connections to a backend that keeps track of how
+    many requests could reuse an already established connection (hits) and
+    how many required a new one (misses).
+
+    Idle connections are closed after cachedConnectionTimeout seconds.
+    """
+    maxPersistentPerHost = 2
+    cachedConnectionTimeout = 60
+
+    def __init__(self, reactor):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        if config.advanced.backend_max_persistent_connections:
+            self.maxPersistentPerHost = \
+                config.advanced.backend_max_persistent_connections
+        if config.advanced.backend_connection_idle_timeout:
+            self.cachedConnectionTimeout = \
+                config.advanced.backend_connection_idle_timeout
+        self.hits = 0
+        self.misses = 0
+
+    def getConnection(self, key, endpoint):
+        if self._connections.get(key):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+
+_connection_pools = {}
+
+
+def getConnectionPool(base_address):
+    """
+    Returns the connection pool shared by all the clients of the backend at
+    base_address.
+    """
+    if base_address not in _connection_pools:
+        _connection_pools[base_address] = OONIBConnectionPool(reactor)
+    return _connection_pools[base_address]
+
+
+def closeConnectionPools():
+    """
+    Closes all the cached backend connections.
+
+    Returns:
+        a deferred that fires once all the connections have been closed.
+    """
+    pools = _connection_pools.values()
+    _connection_pools.clear()
+    return defer.DeferredList([pool.closeCachedConnections()
+                               for pool in pools])
 
 
 class OONIBClient(object):
@@ -89,14 +145,31 @@ class OONIBClient(object):
     def isReachable(self):
         raise NotImplemented
 
+    @property
+    def connectionPool(self):
+        return getConnectionPool(self.base_address)
+
+    @property
+    def connectionPoolStats(self):
+        """
+        Returns the number of requests to this backend that reused a
+        persistent connection (hits) and that had to open a new one (misses).
+        """
+        return {
+            'hits': self.connectionPool.hits,
+            'misses': self.connectionPool.misses
+        }
+
     def _request(self, method, urn, genReceiver, bodyProducer=None, retries=3):
         if self.backend_type == 'onion':
+            from ooni.utils.socks import TrueHeadersSOCKS5Agent
             agent = TrueHeadersSOCKS5Agent(reactor,
                                            proxyEndpoint=TCP4ClientEndpoint(reactor,
                                                                             '127.0.0.1',
-                                                                            config.tor.socks_port))
+                                                                            config.tor.socks_port),
+                                           pool=self.connectionPool)
         else:
-            agent = Agent(reactor)
+            agent = Agent(reactor, pool=self.connectionPool)
 
         attempts = 0
 
@@ -133,9 +206,19 @@ class OONIBClient(object):
         return finished
 
     def queryBackend(self, method, urn, query=None, retries=3):
-        bodyProducer = None
+        body = None
         if query:
-            bodyProducer = StringProducer(json.dumps(query))
+            body = json.dumps(query)
+        return self._queryBackend(method, urn, body, retries)
+
+    def _queryBackend(self, method, urn, body=None, retries=3):
+        """
+        Like queryBackend, but takes the already JSON encoded body of the
+        request.
+        """
+        bodyProducer = None
+        if body:
+            bodyProducer = StringProducer(body)
 
         def genReceiver(finished, content_length):
             def process_response(s):
@@ -247,8 +330,8 @@ class CollectorClient(OONIBClient):
             d = self.download('/input/' + input_hash + '/file', input_file.cached_file)
 
             @d.addCallback
-            def cb(res):
-                input_file.verify()
+            def cb(file_hash):
+                input_file.verify(file_hash)
                 return input_file
 
             @d.addErrback
@@ -299,8 +382,8 @@ class CollectorClient(OONIBClient):
             d = self.download('/deck/' + deck_hash + '/file', deck.cached_file)
 
             @d.addCallback
-            def cb(res):
-                deck.verify()
+            def cb(file_hash):
+                deck.verify(file_hash)
                 return deck
 
             @d.addErrback
@@ -337,10 +420,170 @@ class CollectorClient(OONIBClient):
         return self.queryBackend('POST', '/report/%s' % report_id,
                                  query=request)
 
+    def updateReportBatch(self, report_id, entries):
+        """
+        Submits many report entries in a single request. This must only be
+        used if the collector has advertised support for it by setting
+        batch_upload in the response to createReport.
+
+        Args:
+            entries:
+                a list of report entries that have already been serialized to
+                JSON.
+        """
+        body = '{"format": "json", "content": [%s]}' % ', '.join(entries)
+        return self._queryBackend('POST', '/report/%s' % report_id, body)
 
     def closeReport(self, report_id):
         return self.queryBackend('POST', '/report/' + report_id + '/close')
 
+class ControlRequestBatcher(object):
+    """
+    Collects the control requests that the measurements running at the same
+    time make to a web connectivity test helper and sends them in a single
+    request.
+
+    Batches are only sent if the helper advertises batch_control support in
+    its status. Otherwise every control request is sent on its own as
+    before.
+
+    A batch is sent batchInterval seconds after its first control request
+    was made, or as soon as it has batchSize of them.
+
+    If the status of the helper can not be fetched, the control requests are
+    sent on their own for supportRetryInterval seconds, after which the
+    status is fetched again.
+    """
+    batchSize = 50
+    batchInterval = 0.1
+    supportRetryInterval = 60
+
+    # So that we can test the callLater calls
+    clock = reactor
+
+    def __init__(self, client):
+        self.client = client
+        self.supported = None
+
+        if config.advanced.control_batch_size is not None:
+            self.batchSize = config.advanced.control_batch_size
+        if config.advanced.control_batch_interval is not None:
+            self.batchInterval = config.advanced.control_batch_interval
+
+        self._batch = []
+        self._batchTimer = None
+        self._checkingSupport = False
+        self._retrySupportAt = 0
+
+    def control(self, request):
+        if self.supported is False or self.batchSize <= 1 or \
+                self.clock.seconds() < self._retrySupportAt:
+            return self.client.sendControl(request)
+
+        d = defer.Deferred()
+        self._batch.append((request, d))
+        if self.supported is None:
+            self._checkSupport()
+        else:
+            self._scheduleFlush()
+        return d
+
+    def _checkSupport(self):
+        if self._checkingSupport:
+            return
+        self._checkingSupport = True
+
+        d = self.client.queryBackend('GET', '/status')
+        d.addCallback(lambda status: bool(status.get('batch_control', False)))
+
+        @d.addErrback
+        def failed(failure):
+            # It is only for the requests we have collected so far, whether
+            # batches are supported will be checked again later.
+            log.debug("Failed to check if %s supports batches of control "
+                      "requests, trying again in %d seconds" % (
+                          self.client.base_address,
+                          self.supportRetryInterval))
+            self._retrySupportAt = self.clock.seconds() + \
+                self.supportRetryInterval
+            return None
+
+        @d.addCallback
+        def checked(supported):
+            self._checkingSupport = False
+            self.supported = supported
+            if supported:
+                log.debug("Sending batches of control requests to %s" %
+                          self.client.base_address)
+                self._scheduleFlush()
+                return
+            batch, self._batch = self._batch, []
+            for request, request_done in batch:
+                self.client.sendControl(request).chainDeferred(request_done)
+
+    def _scheduleFlush(self):
+        if len(self._batch) >= self.batchSize:
+            self.flush()
+        elif self._batchTimer is None:
+            self._batchTimer = self.clock.callLater(self.batchInterval,
+                                                    self.flush)
+
+    def flush(self):
+        """
+        Sends the control requests that have been collected so far.
+        """
+        if self._batchTimer is not None:
+            if self._batchTimer.active():
+                self._batchTimer.cancel()
+            self._batchTimer = None
+        while self._batch:
+            batch = self._batch[:self.batchSize]
+            self._batch = self._batch[self.batchSize:]
+            self._sendBatch(batch)
+
+    def _sendBatch(self, batch):
+        log.debug("Sending %d control requests to %s" % (
+            len(batch), self.client.base_address))
+        d = self.client.queryBackend('POST', '/batch', query={
+            'requests': [request for request, _ in batch]
+        })
+
+        @d.addCallback
+        def cb(response):
+            responses = response.get('responses', [])
+            if len(responses) != len(batch):
+                raise e.OONIBError("Got %d control responses for %d "
+                                   "requests" % (len(responses), len(batch)))
+            for (_, request_done), control in zip(batch, responses):
+                if 'error' in control:
+                    try:
+                        raise e.get_error(control['error'])
+                    except Exception:
+                        request_done.errback()
+                else:
+                    request_done.callback(control)
+
+        @d.addErrback
+        def eb(failure):
+            log.err("Failed to send %d control requests" % len(batch))
+            log.exception(failure)
+            for _, request_done in batch:
+                if not request_done.called:
+                    request_done.errback(failure)
+
+
+_control_batchers = {}
+
+def getControlBatcher(client):
+    """
+    Returns the batcher shared by all the clients of the web connectivity
+    test helper client talks to.
+    """
+    if client.base_address not in _control_batchers:
+        _control_batchers[client.base_address] = ControlRequestBatcher(client)
+    return _control_batchers[client.base_address]
+
+
 class WebConnectivityClient(OONIBClient):
     def isReachable(self):
         d = self.queryBackend('GET', '/status')
@@ -362,4 +605,7 @@ class WebConnectivityClient(OONIBClient):
             'http_request': http_request,
             'tcp_connect': tcp_connect
         }
+        return getControlBatcher(self).control(request)
+
+    def sendControl(self, request):
         return self.queryBackend('POST', '/', query=request)
@@ -4,7 +4,14 @@ from base64 import b64encode
 
 META_CHARSET_REGEXP = re.compile('<meta(?!\s*(?:name|value)\s*=)[^>]*?charset\s*=[\s"\']*([^\s"\'/>!;]+)')
 
-def representBody(body):
+# Like browsers, only look for the meta charset in the first 1024 bytes
+META_CHARSET_PREFIX_SIZE = 1024
+
+def representBody(body, truncated=False):
+    """
+    If body has been truncated, a character that is cut in half at its end
+    does not prevent it from being decoded.
+    """
     if not body:
         return body
     # XXX perhaps add support for decoding gzip in the future.
@@ -14,7 +21,8 @@ def representBody(body):
 
     # If we are able to detect the charset of body from the meta tag
     # try to decode using that one first
-    charset = META_CHARSET_REGEXP.search(body, re.IGNORECASE)
+    charset = META_CHARSET_REGEXP.search(body[:META_CHARSET_PREFIX_SIZE],
+                                         re.IGNORECASE)
     if charset:
         try:
             encoding = charset.group(1).lower()
@@ -26,7 +34,11 @@ def representBody(body):
 
     for encoding in charsets:
         try:
-            body = unicode(body, encoding)
+            if truncated:
+                decoder = codecs.getincrementaldecoder(encoding)()
+                body = decoder.decode(body, final=False)
+            else:
+                body = unicode(body, encoding)
             decoded = True
             break
         except UnicodeDecodeError:
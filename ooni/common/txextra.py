@@ -1,5 +1,6 @@
 import itertools
 from copy import copy
+from hashlib import sha256
 
 from twisted.web.http_headers import Headers
 from twisted.web import error
@@ -200,3 +201,50 @@ class FixedRedirectAgent(BrowserLikeRedirectAgent):
         deferred.addCallback(_chainResponse)
         return deferred.addCallback(
             self._handleResponse, method, uri, headers, redirectCount + 1)
+
+
+class _ReadBodyPrefixProtocol(client._ReadBodyProtocol):
+    def __init__(self, response, max_size, deferred):
+        client._ReadBodyProtocol.__init__(self, response.code,
+                                          response.phrase, deferred)
+        self.response = response
+        self.maxSize = max_size
+        self.length = 0
+        self.kept = 0
+        self.sha256 = sha256()
+
+    def dataReceived(self, data):
+        self.length += len(data)
+        self.sha256.update(data)
+        if self.maxSize is not None:
+            data = data[:max(self.maxSize - self.kept, 0)]
+        if data:
+            self.kept += len(data)
+            self.dataBuffer.append(data)
+
+    def connectionLost(self, reason):
+        self.response.bodyLength = self.length
+        self.response.bodySHA256 = self.sha256.hexdigest()
+        self.response.bodyTruncated = self.kept < self.length
+        client._ReadBodyProtocol.connectionLost(self, reason)
+
+
+def readBody(response, max_size=None):
+    """
+    Like :func:twisted.web.client.readBody, but only the first max_size bytes
+    of the body are kept in memory, so that large responses do not need more
+    memory than small ones.
+
+    The length and the SHA256 hex digest of the whole body are set as the
+    bodyLength and bodySHA256 attributes of the response, and bodyTruncated
+    tells whether the body it fires with is only a part of it.
+    """
+    def cancel(deferred):
+        abort = getattr(body_protocol.transport, 'abortConnection', None)
+        if abort is not None:
+            abort()
+
+    d = Deferred(cancel)
+    body_protocol = _ReadBodyPrefixProtocol(response, max_size, d)
+    response.deliverBody(body_protocol)
+    return d
@@ -5,6 +5,8 @@ from ooni.backend_client import WebConnectivityClient
 from ooni.nettest import NetTestLoader
 from ooni.settings import config
 from ooni.utils import log, onion
+from ooni.utils.reachability import ReachabilityCache, backend_key
+from ooni.utils.reachability import first_reachable
 from ooni import errors as e
 
 from twisted.python.filepath import FilePath
@@ -14,9 +16,35 @@ import os
 import yaml
 import json
 from hashlib import sha256
+from functools import partial
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def sha256_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Returns the hex sha256 digest of the file at path, reading it chunk_size
+    bytes at a time.
+    """
+    file_hash = sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
 
 
 class InputFile(object):
+    """
+    An input (or deck) file stored in a cache directory under its sha256
+    digest.
+
+    Once a file has been verified, its path, size, mtime and inode are kept
+    in a .verified sidecar, and it is not hashed again until one of them
+    changes.
+    """
     def __init__(self, input_hash, base_path=config.inputs_directory):
         self.id = input_hash
         cache_path = os.path.join(os.path.abspath(base_path), input_hash)
@@ -62,11 +90,48 @@ class InputFile(object):
         self.date = descriptor['date']
         self.description = descriptor['description']
 
-    def verify(self):
+    @property
+    def cached_verification(self):
+        return self.cached_file + '.verified'
+
+    def _fileState(self):
+        stat = os.stat(self.cached_file)
+        return {
+            'path': os.path.abspath(self.cached_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'inode': stat.st_ino
+        }
+
+    def verify(self, file_hash=None):
+        """
+        Checks that the sha256 digest of the cached file is the one it is
+        named after, raising AssertionError if it is not.
+
+        Args:
+            file_hash:
+                the hex digest of the file, if it has already been computed
+                (for example while downloading it).
+        """
         digest = os.path.basename(self.cached_file)
-        with open(self.cached_file) as f:
-            file_hash = sha256(f.read())
-            assert file_hash.hexdigest() == digest
+        state = self._fileState()
+        try:
+            with open(self.cached_verification) as f:
+                if json.load(f) == dict(state, sha256=digest):
+                    return
+        except (IOError, ValueError):
+            pass
+
+        if file_hash is None:
+            file_hash = sha256_file(self.cached_file)
+        assert file_hash == digest
+
+        try:
+            with open(self.cached_verification, 'w') as f:
+                json.dump(dict(state, sha256=digest), f)
+        except IOError as exc:
+            log.debug("Could not save the verification of %s: %s" % (
+                self.cached_file, exc))
 
 
 def nettest_to_path(path, allow_arbitrary_paths=False):
@@ -96,6 +161,7 @@ class Deck(InputFile):
     # this exists so we can mock it out in unittests
     _BouncerClient = BouncerClient
     _CollectorClient = CollectorClient
+    _ReachabilityCache = ReachabilityCache
 
     def __init__(self, deck_hash=None,
                  bouncer=None,
@@ -121,9 +187,8 @@ class Deck(InputFile):
         return self.cached_file + '.desc'
 
     def loadDeck(self, deckFile):
+        self.id = sha256_file(deckFile)
         with open(deckFile) as f:
-            self.id = sha256(f.read()).hexdigest()
-            f.seek(0)
             test_deck = yaml.safe_load(f)
 
         for test in test_deck:
@@ -140,6 +205,8 @@ class Deck(InputFile):
                 net_test_loader.collector = CollectorClient(
                     test['options']['collector']
                 )
+            if test['options'].get('reportformat', None) is not None:
+                net_test_loader.reportFormat = test['options']['reportformat']
             if test['options'].get('bouncer', None) is not None:
                 self.bouncer = test['options']['bouncer']
             self.insert(net_test_loader)
@@ -210,9 +277,11 @@ class Deck(InputFile):
                 plaintext_addresses)
 
     @defer.inlineCallbacks
-    def getReachableCollector(self, collector_address, collector_alternate):
+    def getReachableCollector(self, collector_address, collector_alternate,
+                              cache=None):
         # We prefer onion collector to https collector to cloudfront
         # collectors to plaintext collectors
+        candidates = []
         for collector_settings in self.sortAddressesByPriority(collector_address,
                                                                collector_alternate):
             collector = self._CollectorClient(settings=collector_settings)
@@ -221,22 +290,21 @@ class Deck(InputFile):
                             collector_settings['type'],
                             collector_settings['address']))
                 continue
-            reachable = yield collector.isReachable()
-            if not reachable:
-                log.err("Unreachable %s collector %s" % (
-                            collector_settings['type'],
-                            collector_settings['address']))
-                continue
-            defer.returnValue(collector)
+            candidates.append((backend_key(collector_settings), collector))
 
-        raise e.NoReachableCollectors
+        collector = yield first_reachable('collector', candidates, cache)
+        if collector is None:
+            raise e.NoReachableCollectors
+        defer.returnValue(collector)
 
     @defer.inlineCallbacks
     def getReachableTestHelper(self, test_helper_name, test_helper_address,
-                               test_helper_alternate):
+                               test_helper_alternate, cache=None):
         # For the moment we look for alternate addresses only of
         # web_connectivity test helpers.
         if test_helper_name == 'web-connectivity':
+            candidates = []
+            settings = {}
             for web_connectivity_settings in self.sortAddressesByPriority(
                     test_helper_address, test_helper_alternate):
                 web_connectivity_test_helper = WebConnectivityClient(
@@ -248,34 +316,63 @@ class Deck(InputFile):
                             web_connectivity_settings['address']
                     ))
                     continue
-                reachable = yield web_connectivity_test_helper.isReachable()
-                if not reachable:
-                    log.err("Unreachable %s web_connectivity test helper %s" % (
-                        web_connectivity_settings['type'],
-                        web_connectivity_settings['address']
-                    ))
-                    continue
-                defer.returnValue(web_connectivity_settings)
-            raise e.NoReachableTestHelpers
+                candidates.append((backend_key(web_connectivity_settings),
+                                   web_connectivity_test_helper))
+                settings[web_connectivity_test_helper] = \
+                    web_connectivity_settings
+
+            test_helper = yield first_reachable(
+                'web_connectivity test helper', candidates, cache)
+            if test_helper is None:
+                raise e.NoReachableTestHelpers
+            defer.returnValue(settings[test_helper])
         else:
             defer.returnValue(test_helper_address.encode('ascii'))
 
     @defer.inlineCallbacks
-    def getReachableTestHelpersAndCollectors(self, net_tests):
-        for net_test in net_tests:
-            net_test['collector'] = yield self.getReachableCollector(
-                        net_test['collector'],
-                        net_test.get('collector-alternate', [])
-            )
+    def getReachableTestHelpersAndCollectors(self, net_tests, cache=None):
+        """
+        Looks up the reachable collector and test helpers of all the net
+        tests at the same time. The ones that several net tests share are
+        only looked up once.
+        """
+        lookups = {}
+
+        def lookup(kind, method, address, alternate):
+            key = (kind, json.dumps(address, sort_keys=True),
+                   json.dumps(alternate, sort_keys=True))
+            if key not in lookups:
+                lookups[key] = (method, address, alternate)
+            return key
 
+        for net_test in net_tests:
+            net_test['collector'] = lookup(
+                'collector', self.getReachableCollector,
+                net_test['collector'],
+                net_test.get('collector-alternate', []))
             for test_helper_name, test_helper_address in net_test['test-helpers'].items():
-                 test_helper_alternate = \
-                     net_test.get('test-helpers-alternate', {}).get(test_helper_name, [])
-                 net_test['test-helpers'][test_helper_name] = \
-                            yield self.getReachableTestHelper(
-                                test_helper_name,
-                                test_helper_address,
-                                test_helper_alternate)
+                test_helper_alternate = \
+                    net_test.get('test-helpers-alternate', {}).get(test_helper_name, [])
+                net_test['test-helpers'][test_helper_name] = lookup(
+                    test_helper_name,
+                    partial(self.getReachableTestHelper, test_helper_name),
+                    test_helper_address,
+                    test_helper_alternate)
+
+        keys = lookups.keys()
+        try:
+            results = yield defer.gatherResults([
+                lookups[key][0](*lookups[key][1:], cache=cache)
+                for key in keys
+            ], consumeErrors=True)
+        except defer.FirstError as exc:
+            exc.subFailure.raiseException()
+        results = dict(zip(keys, results))
+
+        for net_test in net_tests:
+            net_test['collector'] = results[net_test['collector']]
+            for test_helper_name, key in net_test['test-helpers'].items():
+                net_test['test-helpers'][test_helper_name] = results[key]
 
         defer.returnValue(net_tests)
 
@@ -307,14 +404,25 @@ class Deck(InputFile):
         if not requires_test_helpers and not requires_collector:
             defer.returnValue(None)
 
-        response = yield oonibclient.lookupTestCollector(required_nettests)
+        cache = self._ReachabilityCache()
+        cache_key = 'bouncer %s %s' % (self.bouncer, sha256(
+            json.dumps(required_nettests, sort_keys=True)).hexdigest())
+        response = cache.get(cache_key)
+        if response is None:
+            response = yield oonibclient.lookupTestCollector(required_nettests)
+            cache.set(cache_key, response)
+        else:
+            log.msg("Using the cached response of the bouncer")
         try:
-            provided_net_tests = yield self.getReachableTestHelpersAndCollectors(response['net-tests'])
+            provided_net_tests = yield self.getReachableTestHelpersAndCollectors(
+                response['net-tests'], cache=cache)
         except e.NoReachableCollectors:
             log.err("Could not find any reachable collector")
+            cache.remove(cache_key)
             raise
         except e.NoReachableTestHelpers:
             log.err("Could not find any reachable test helpers")
+            cache.remove(cache_key)
             raise
 
         def find_collector_and_test_helpers(test_name, test_version, input_files):
@@ -21,6 +21,11 @@ class Options(usage.Options):
     synopsis = """%s [options]
     """ % sys.argv[0]
 
+    optFlags = [
+        ["profile-startup", None, "Print how long it took to import the "
+                                  "modules needed to start"]
+    ]
+
     optParameters = [
         ["country-code", "c", None,
          "Specify the two letter country code for which we should "
@@ -1,6 +1,5 @@
 import os
 import csv
-import GeoIP
 
 from ooni.settings import config
 
@@ -13,6 +12,7 @@ class GeoIPDB(object):
         self.__dict__ = self._borg
         if not self.country:
             try:
+                import GeoIP
                 country_file = config.get_data_file_path('GeoIP/GeoIP.dat')
                 self.country = GeoIP.open(country_file,
                                           GeoIP.GEOIP_STANDARD)
@@ -1,16 +1,17 @@
 import pwd
 import os
 
+from ooni.backend_client import closeConnectionPools
 from ooni.managers import ReportEntryManager, MeasurementManager
 from ooni.reporter import Report
 from ooni.utils import log, generate_filename
 from ooni.utils.net import randomFreePort
-from ooni.nettest import NetTest, getNetTestInformation
+from ooni.nettest import NetTest, NetTestInformationCache
+from ooni.sharding import ShardedNetTest
 from ooni.settings import config
 from ooni import errors
 from ooni.nettest import test_class_name_to_name
 
-from txtorcon import TorConfig, TorState, launch_tor, build_tor_connection
 
 from twisted.internet import defer, reactor
 from twisted.internet.endpoints import TCP4ClientEndpoint
@@ -36,15 +37,18 @@ class Director(object):
         |                       | [----------------] |   |
         |                       +--------------------+   |
         v                                                |
-    +---------+   ReportEntry                            |
-    |         |   [---------]    +--------------------+  |
-    |  Report |                  | ReportEntryManager |  |
+    +---------+   report entry                           |
     |         |   [---------]    +--------------------+  |
+    |  Report |----------------->|     ReportSink     |  |
+    |         |                  +--------------------+  |
     +---------+                  | [----------------] |  |
-                  [---------]    | [----------------] |--
-                                 | [----------------] |
+                                 | [----------------] |--
                                  +--------------------+
 
+    Every reporter of a Report is fed by a ReportSink, a bounded queue of
+    report entries. When a sink falls behind the ReportEntryManager stops
+    the MeasurementManager from scheduling new measurements.
+
     [------------] are Tasks
 
     +------+
@@ -65,19 +69,21 @@ class Director(object):
 
     def __init__(self):
         self.activeNetTests = []
+        self._netTests = None
 
         self.measurementManager = MeasurementManager()
         self.measurementManager.director = self
 
         self.reportEntryManager = ReportEntryManager()
         self.reportEntryManager.director = self
-        # Link the TaskManager's by least available slots.
+        # Stop scheduling measurements while a report sink is full.
         self.measurementManager.child = self.reportEntryManager
-        # Notify the parent when tasks complete # XXX deadlock!?
+        # Resume scheduling once the sinks have drained.
         self.reportEntryManager.parent = self.measurementManager
 
         self.successfulMeasurements = 0
         self.failedMeasurements = 0
+        self.timedOutMeasurements = 0
 
         self.totalMeasurements = 0
 
@@ -87,14 +93,26 @@ class Director(object):
         self.failures = []
 
         self.torControlProtocol = None
+        self._shutdownTrigger = None
 
         # This deferred is fired once all the measurements and their reporting
         # tasks are completed.
         self.allTestsDone = defer.Deferred()
         self.sniffers = {}
 
+    @property
+    def netTests(self):
+        """
+        The installed nettests, which are only discovered when first needed.
+        """
+        if self._netTests is None:
+            self._netTests = self.getNetTests()
+        return self._netTests
+
     def getNetTests(self):
         nettests = {}
+        cache = NetTestInformationCache(os.path.join(config.ooni_home,
+                                                     'nettests.json'))
 
         def is_nettest(filename):
             return not filename == '__init__.py' and filename.endswith('.py')
@@ -106,7 +124,7 @@ class Director(object):
                 if is_nettest(filename):
                     net_test_file = os.path.join(dirname, filename)
                     try:
-                        nettest = getNetTestInformation(net_test_file)
+                        nettest = dict(cache.get(net_test_file))
                     except:
                         log.err("Error processing %s" % filename)
                         continue
@@ -121,11 +139,16 @@ class Director(object):
                                                    '')
                         nettests[nettest['id']] = nettest
 
+        cache.save()
         return nettests
 
     @defer.inlineCallbacks
     def start(self, start_tor=False, check_incoherences=True):
-        self.netTests = self.getNetTests()
+        if self._shutdownTrigger is None:
+            # The persistent connections to the backends are only closed
+            # once we are done with them.
+            self._shutdownTrigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', closeConnectionPools)
 
         if start_tor:
             if check_incoherences:
@@ -183,12 +206,53 @@ class Director(object):
 
         return self.failedMeasurements / self.totalMeasurementRuntime
 
+    @property
+    def measurementConcurrency(self):
+        """
+        The number of measurements that are currently allowed to run
+        concurrently. This changes at runtime when the adaptive measurement
+        concurrency is enabled.
+        """
+        return self.measurementManager.concurrency
+
+    @property
+    def measurementConcurrencyWindow(self):
+        """
+        The (fractional) congestion window of the adaptive concurrency
+        controller or None if the concurrency is fixed.
+        """
+        if self.measurementManager.controller is None:
+            return None
+        return self.measurementManager.controller.window
+
     def measurementTimedOut(self, measurement):
         """
         This gets called every time a measurement times out independenty from
         the fact that it gets re-scheduled or not.
         """
-        pass
+        self.timedOutMeasurements += 1
+
+    def shardMeasurementDone(self, outcome, runtime):
+        """
+        This gets called when a measurement of a ShardedNetTest has been
+        completed by one of its worker processes.
+
+        Args:
+            outcome:
+                one of "succeeded", "failed" or "timed_out".
+
+            runtime:
+                the runtime of the measurement.
+        """
+        if outcome == 'timed_out':
+            self.timedOutMeasurements += 1
+            return
+        self.totalMeasurements += 1
+        self.totalMeasurementRuntime += runtime
+        if outcome == 'succeeded':
+            self.successfulMeasurements += 1
+        else:
+            self.failedMeasurements += 1
 
     def measurementStarted(self, measurement):
         self.totalMeasurements += 1
@@ -233,7 +297,8 @@ class Director(object):
 
     @defer.inlineCallbacks
     def startNetTest(self, net_test_loader, report_filename,
-                     collector_client=None, no_yamloo=False):
+                     collector_client=None, no_yamloo=False,
+                     report_format='yaml'):
         """
         Create the Report for the NetTest and start the report NetTest.
 
@@ -252,16 +317,30 @@ class Director(object):
         report = Report(test_details, report_filename,
                         self.reportEntryManager,
                         collector_client,
-                        no_yamloo)
+                        no_yamloo,
+                        report_format)
 
         yield report.open()
-        net_test = NetTest(test_cases, test_details, report)
+        shards = config.advanced.measurement_shards or 1
+        if shards > 1 and not ShardedNetTest.supports(net_test_loader):
+            log.msg("Running %s in a single process since it can not be "
+                    "split across processes" % test_details['test_name'])
+            shards = 1
+        if shards > 1:
+            net_test = ShardedNetTest(net_test_loader, test_details, report,
+                                      shards)
+        else:
+            net_test = NetTest(test_cases, test_details, report)
         net_test.director = self
 
         yield net_test.initialize()
         try:
             self.activeNetTests.append(net_test)
-            self.measurementManager.schedule(net_test.generateMeasurements())
+            if shards > 1:
+                net_test.start()
+            else:
+                self.measurementManager.schedule(net_test.measurementSource(
+                    self.measurementManager.wakeUp))
 
             yield net_test.done
             yield report.close()
@@ -301,6 +380,8 @@ class Director(object):
 
     @defer.inlineCallbacks
     def getTorState(self):
+        from txtorcon import build_tor_connection
+
         connection = TCP4ClientEndpoint(reactor, '127.0.0.1',
                                         config.tor.control_port)
         config.tor_state = yield build_tor_connection(connection)
@@ -310,6 +391,8 @@ class Director(object):
         Launches a Tor with :param: socks_port :param: control_port
         :param: tor_binary set in ooniprobe.conf
         """
+        from txtorcon import TorConfig, TorState, launch_tor
+
         log.msg("Starting Tor...")
 
         @defer.inlineCallbacks
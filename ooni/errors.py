@@ -11,14 +11,7 @@ from twisted.internet.error import ProcessDone, ConnectionDone
 
 from twisted.python import usage
 
-from txsocksx.errors import SOCKSError
-from txsocksx.errors import MethodsNotAcceptedError, AddressNotSupported
-from txsocksx.errors import ConnectionError, NetworkUnreachable
-from txsocksx.errors import ConnectionLostEarly, ConnectionNotAllowed
-from txsocksx.errors import NoAcceptableMethods, ServerFailure
-from txsocksx.errors import HostUnreachable, ConnectionRefused
-from txsocksx.errors import TTLExpired, CommandNotSupported
-
+import sys
 from socket import gaierror
 
 known_failures = [
@@ -33,24 +26,44 @@ known_failures = [
     (ResponseNeverReceived, 'response_never_received'),
     (DeferTimeoutError, 'deferred_timeout_error'),
     (GenericTimeoutError, 'generic_timeout_error'),
-    (MethodsNotAcceptedError, 'socks_methods_not_supported'),
-    (AddressNotSupported, 'socks_address_not_supported'),
-    (NetworkUnreachable, 'socks_network_unreachable'),
-    (ConnectionError, 'socks_connect_error'),
-    (ConnectionLostEarly, 'socks_connection_lost_early'),
-    (ConnectionNotAllowed, 'socks_connection_not_allowed'),
-    (NoAcceptableMethods, 'socks_no_acceptable_methods'),
-    (ServerFailure, 'socks_server_failure'),
-    (HostUnreachable, 'socks_host_unreachable'),
-    (ConnectionRefused, 'socks_connection_refused'),
-    (TTLExpired, 'socks_ttl_expired'),
-    (CommandNotSupported, 'socks_command_not_supported'),
-    (SOCKSError, 'socks_error'),
     (ProcessDone, 'process_done'),
     (ConnectionDone, 'connection_done'),
     (ConnectError, 'connect_error'),
 ]
 
+# The names of the txsocksx errors, which are looked up in txsocksx.errors
+known_socks_failures = [
+    ('MethodsNotAcceptedError', 'socks_methods_not_supported'),
+    ('AddressNotSupported', 'socks_address_not_supported'),
+    ('NetworkUnreachable', 'socks_network_unreachable'),
+    ('ConnectionError', 'socks_connect_error'),
+    ('ConnectionLostEarly', 'socks_connection_lost_early'),
+    ('ConnectionNotAllowed', 'socks_connection_not_allowed'),
+    ('NoAcceptableMethods', 'socks_no_acceptable_methods'),
+    ('ServerFailure', 'socks_server_failure'),
+    ('HostUnreachable', 'socks_host_unreachable'),
+    ('ConnectionRefused', 'socks_connection_refused'),
+    ('TTLExpired', 'socks_ttl_expired'),
+    ('CommandNotSupported', 'socks_command_not_supported'),
+    ('SOCKSError', 'socks_error'),
+]
+
+
+def knownFailures():
+    """
+    Returns the list of (failure type, failure string) that are recognised.
+    txsocksx is only imported by the SOCKS agent, so if it has not been
+    loaded there can not be any SOCKS failure.
+    """
+    socks_errors = sys.modules.get('txsocksx.errors')
+    if socks_errors is None:
+        return known_failures
+    return known_failures + [
+        (getattr(socks_errors, name), failure_string)
+        for name, failure_string in known_socks_failures
+    ]
+
+
 def handleAllFailures(failure):
     """
     Trap all the known Failures and we return a string that
@@ -58,7 +71,7 @@ def handleAllFailures(failure):
     returned by failure.trap().
     """
 
-    failure.trap(*[failure_type for failure_type, _ in known_failures])
+    failure.trap(*[failure_type for failure_type, _ in knownFailures()])
     return failureToString(failure)
 
 
@@ -76,7 +89,7 @@ def failureToString(failure):
         A string representing the HTTP response error message.
     """
 
-    for failure_type, failure_string in known_failures:
+    for failure_type, failure_string in knownFailures():
         if isinstance(failure.value, failure_type):
             return failure_string
     # Failure without a corresponding failure message
@@ -117,6 +130,10 @@ class ReportAlreadyClosed(Exception):
     pass
 
 
+class InvalidReportFormat(Exception):
+    pass
+
+
 class TorStateNotFound(Exception):
     pass
 
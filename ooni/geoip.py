@@ -4,6 +4,7 @@ import os
 import random
 
 from hashlib import sha256
+from collections import OrderedDict
 
 from twisted.web import client, http_headers
 
@@ -14,44 +15,168 @@ from twisted.internet import reactor, defer
 from ooni.utils import log
 from ooni import errors
 
-try:
-    from pygeoip import GeoIP
-except ImportError:
+
+def GeoIP(database_path):
+    """
+    Opens a GeoIP database with pygeoip or, if it is not installed, with the
+    libGeoIP bindings. They are imported only when a lookup is needed.
+
+    The database is memory mapped, so that opening it does not read the
+    whole file and the pages are shared with the other ooniprobe processes.
+    """
     try:
-        import GeoIP as CGeoIP
-        def GeoIP(database_path, *args, **kwargs):
-            return CGeoIP.open(database_path, CGeoIP.GEOIP_STANDARD)
+        import pygeoip
     except ImportError:
-        log.err("Unable to import pygeoip. We will not be able to run geo IP related measurements")
+        try:
+            import GeoIP as CGeoIP
+        except ImportError:
+            log.err("Unable to import pygeoip. We will not be able to run "
+                    "geo IP related measurements")
+            raise
+        return CGeoIP.open(database_path, CGeoIP.GEOIP_MMAP_CACHE)
+    return pygeoip.GeoIP(database_path, pygeoip.MMAP_CACHE)
 
 class GeoIPDataFilesNotFound(Exception):
     pass
 
-def IPToLocation(ipaddr):
-    from ooni.settings import config
 
-    country_file = config.get_data_file_path('GeoIP/GeoIP.dat')
-    asn_file = config.get_data_file_path('GeoIP/GeoIPASNum.dat')
+class GeoIPDatabase(object):
+    """
+    A GeoIP database file that is kept open and gets reopened when the file
+    is replaced, as ooniresources does when it updates it.
+    """
+    def __init__(self, file_name):
+        self.fileName = file_name
+        self.path = None
+        self.handle = None
+        self._signature = None
+
+    def _fileSignature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def check(self):
+        """
+        Opens the database if it has not been opened yet or its file has
+        changed. Returns True if the database has been (re)opened.
+        """
+        from ooni.settings import config
+
+        path = config.get_data_file_path(self.fileName)
+        signature = self._fileSignature(path) if path else None
+        if path == self.path and signature == self._signature:
+            return False
+
+        self.path = path
+        self._signature = signature
+        self.handle = None
+        if signature is not None:
+            log.debug("Opening the GeoIP database %s" % path)
+            try:
+                self.handle = GeoIP(path)
+            except Exception as exc:
+                log.err("Failed to open the GeoIP database %s" % path)
+                log.exception(exc)
+        return True
+
+
+class IPLocator(object):
+    """
+    Looks up the location of IP addresses in the GeoIP databases, which are
+    opened only once, and remembers the locations of the last cacheSize
+    addresses.
+
+    Every checkInterval seconds the database files are checked, so that the
+    new ones are used once they have been updated.
+    """
+    cacheSize = 4096
+    checkInterval = 5
+
+    # So that we can test when the database files get checked
+    clock = reactor
+
+    def __init__(self):
+        self.countryDatabase = GeoIPDatabase('GeoIP/GeoIP.dat')
+        self.asnDatabase = GeoIPDatabase('GeoIP/GeoIPASNum.dat')
+        self._cache = OrderedDict()
+        self._lastCheck = None
+
+    def checkDatabases(self, force=False):
+        now = self.clock.seconds()
+        if not force and self._lastCheck is not None and \
+                now - self._lastCheck < self.checkInterval:
+            return
+        self._lastCheck = now
+        reopened = [self.countryDatabase.check(), self.asnDatabase.check()]
+        if any(reopened):
+            self._cache.clear()
+
+    def reload(self):
+        """
+        Checks the database files right away instead of waiting for
+        checkInterval seconds to have passed.
+        """
+        self.checkDatabases(force=True)
+
+    def _locate(self, address):
+        location = {'city': None, 'countrycode': 'ZZ', 'asn': 'AS0'}
+
+        country_code = \
+            self.countryDatabase.handle.country_code_by_addr(address)
+        if country_code is not None:
+            location['countrycode'] = country_code
+
+        asn = self.asnDatabase.handle.org_by_addr(address)
+        if asn is not None:
+            location['asn'] = asn.split(' ')[0]
 
-    location = {'city': None, 'countrycode': 'ZZ', 'asn': 'AS0'}
-    if not asn_file or not country_file:
-        log.err("Could not find GeoIP data file in data directories."
-                "Try running ooniresources or"
-                " edit your ooniprobe.conf")
         return location
 
-    country_dat = GeoIP(country_file)
-    asn_dat = GeoIP(asn_file)
+    def lookupMany(self, addresses):
+        """
+        Returns a dict with the location of every address in addresses.
+        """
+        self.checkDatabases()
+
+        if self.countryDatabase.handle is None or \
+                self.asnDatabase.handle is None:
+            log.err("Could not find GeoIP data file in data directories."
+                    "Try running ooniresources or"
+                    " edit your ooniprobe.conf")
+            return dict((address, {'city': None, 'countrycode': 'ZZ',
+                                   'asn': 'AS0'})
+                        for address in addresses)
+
+        locations = {}
+        for address in addresses:
+            location = self._cache.pop(address, None)
+            if location is None:
+                location = self._locate(address)
+                if len(self._cache) >= self.cacheSize:
+                    self._cache.popitem(last=False)
+            self._cache[address] = location
+            # The callers are free to change what they get
+            locations[address] = dict(location)
+        return locations
+
+    def lookup(self, address):
+        return self.lookupMany([address])[address]
+
+ip_locator = IPLocator()
+
 
-    country_code = country_dat.country_code_by_addr(ipaddr)
-    if country_code is not None:
-        location['countrycode'] =  country_code
+def IPToLocation(ipaddr):
+    return ip_locator.lookup(ipaddr)
 
-    asn = asn_dat.org_by_addr(ipaddr)
-    if asn is not None:
-        location['asn'] = asn.split(' ')[0]
 
-    return location
+def IPToLocations(addresses):
+    """
+    Returns a dict with the location of every address in addresses.
+    """
+    return ip_locator.lookupMany(addresses)
 
 def database_version():
     from ooni.settings import config
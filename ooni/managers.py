@@ -1,7 +1,14 @@
+import sys
+import heapq
 import itertools
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
 
 from ooni.utils import log
 from ooni.settings import config
+from ooni.errors import TaskTimedOut
 
 
 def makeIterable(item):
@@ -17,29 +24,52 @@ def makeIterable(item):
 
 
 class TaskManager(object):
+    """
+    Schedules tasks to run in a bounded number of slots.
+
+    Pending work is kept in two places:
+
+    * a FIFO of task sources (the iterables passed to schedule) that are
+      consumed lazily, one task at a time, as slots become free.
+
+    * a heap of retry entries of the form (deadline, sequence, task). A
+      failed task is put back on the heap with a deadline of now plus its
+      backoff. Due retries are always preferred over fresh tasks.
+    """
     retries = 2
     concurrency = 10
 
+    # How many seconds to wait before retrying a failed task. The delay is
+    # doubled for every subsequent failure of the same task.
+    retryBackoff = 0
+
+    # So that we can test the callLater calls
+    clock = reactor
+
     def __init__(self):
-        self._tasks = iter(())
-        self._active_tasks = []
+        self._sources = deque()
+        self._retries = []
+        self._sequence = itertools.count()
+        self._active_tasks = set()
+        self._retry_timer = None
+        self._filling = False
         self.failures = 0
 
     def _failed(self, failure, task):
         """
-        The has failed to complete, we append it to the end of the task chain
-        to be re-run once all the currently scheduled tasks have run.
+        The task has failed to complete. If it has retries left we push it on
+        the retry heap so that it will be re-run once its backoff has expired.
         """
         log.debug("Task %s has failed %s times" % (task, task.failures))
         if config.advanced.debug:
             log.exception(failure)
 
-        self._active_tasks.remove(task)
+        self._active_tasks.discard(task)
         self.failures = self.failures + 1
 
         if task.failures <= self.retries:
             log.debug("Rescheduling...")
-            self._tasks = itertools.chain(makeIterable(task), self._tasks)
+            self._scheduleRetry(task)
 
         else:
             # This fires the errback when the task is done but has failed.
@@ -50,29 +80,89 @@ class TaskManager(object):
 
         self.failed(failure, task)
 
+    def _retryDelay(self, task):
+        if not self.retryBackoff:
+            return 0
+        return self.retryBackoff * (2 ** max(task.failures - 1, 0))
+
+    def _scheduleRetry(self, task):
+        deadline = self.clock.seconds() + self._retryDelay(task)
+        heapq.heappush(self._retries,
+                       (deadline, next(self._sequence), task))
+
+    def _armRetryTimer(self):
+        """
+        Makes sure that _fillSlots will be called once the earliest pending
+        retry is due, even if no other task completes in the meantime.
+        """
+        if not self._retries:
+            return
+        deadline = self._retries[0][0]
+        if deadline <= self.clock.seconds():
+            # The retry is already due, it will be picked up as soon as a slot
+            # frees up.
+            return
+        if self._retry_timer is not None and self._retry_timer.active():
+            if self._retry_timer.getTime() <= deadline:
+                return
+            self._retry_timer.cancel()
+        delay = deadline - self.clock.seconds()
+        self._retry_timer = self.clock.callLater(delay, self._fillSlots)
+
+    def _nextTask(self):
+        """
+        Returns the next task that should be run or None if there is nothing
+        that can be run right now.
+
+        A task source may yield None to signal that it has pending tasks but
+        that none of them can be run right now, in which case we move on to the
+        next source. Such sources are expected to call wakeUp once they are
+        ready again.
+        """
+        if self._retries and self._retries[0][0] <= self.clock.seconds():
+            return heapq.heappop(self._retries)[2]
+
+        idx = 0
+        while idx < len(self._sources):
+            try:
+                task = next(self._sources[idx])
+            except StopIteration:
+                del self._sources[idx]
+                continue
+            if task is not None:
+                return task
+            idx += 1
+        return None
+
     def _fillSlots(self):
         """
         Called on test completion and schedules measurements to be run for the
         available slots.
+
+        Tasks that complete synchronously will call us again while we are
+        still filling slots (or while a task source generator is running). In
+        that case we just return and let the outer loop pick up the freed
+        slots, so that the call stack does not grow with the number of tasks.
         """
-        for _ in range(self.availableSlots):
-            try:
-                task = self._tasks.next()
+        if self._filling:
+            return
+        self._filling = True
+        try:
+            while self.availableSlots > 0:
+                task = self._nextTask()
+                if task is None:
+                    break
                 self._run(task)
-            except StopIteration:
-                break
-            except ValueError:
-                # XXX this is a workaround the race condition that leads the
-                # _tasks generator to throw the exception
-                # ValueError: generator already called.
-                continue
+        finally:
+            self._filling = False
+        self._armRetryTimer()
 
     def _run(self, task):
         """
         This gets called to add a task to the list of currently active and
         running tasks.
         """
-        self._active_tasks.append(task)
+        self._active_tasks.add(task)
 
         d = task.start()
         d.addCallback(self._succeeded, task)
@@ -82,7 +172,7 @@ class TaskManager(object):
         """
         We have successfully completed a measurement.
         """
-        self._active_tasks.remove(task)
+        self._active_tasks.discard(task)
 
         # Fires the done deferred when the task has completed
         task.done.callback(result)
@@ -95,6 +185,13 @@ class TaskManager(object):
     def failedMeasurements(self):
         return self.failures
 
+    @property
+    def pendingRetries(self):
+        """
+        Returns the number of failed tasks that are waiting to be retried.
+        """
+        return len(self._retries)
+
     @property
     def availableSlots(self):
         """
@@ -102,16 +199,21 @@ class TaskManager(object):
         """
         return self.concurrency - len(self._active_tasks)
 
+    def wakeUp(self):
+        """
+        Should be called by task sources that were blocked and now have tasks
+        ready to be run.
+        """
+        self._fillSlots()
+
     def schedule(self, task_or_task_iterator):
         """
         Takes as argument a single task or a task iterable and appends it to
-        the task generator queue.
+        the task source queue.
         """
         log.debug("Starting this task %s" % repr(task_or_task_iterator))
 
-        iterable = makeIterable(task_or_task_iterator)
-
-        self._tasks = itertools.chain(self._tasks, iterable)
+        self._sources.append(makeIterable(task_or_task_iterator))
         self._fillSlots()
 
     def start(self):
@@ -147,7 +249,7 @@ class LinkedTaskManager(TaskManager):
 
     @property
     def availableSlots(self):
-        mySlots = self.concurrency - len(self._active_tasks)
+        mySlots = super(LinkedTaskManager, self).availableSlots
         if self.child:
             s = self.child.availableSlots
             return min(s, mySlots)
@@ -164,6 +266,288 @@ class LinkedTaskManager(TaskManager):
             self.parent._fillSlots()
 
 
+class AIMDController(object):
+    """
+    Additive increase, multiplicative decrease controller for the number of
+    concurrent measurements.
+
+    Every successful measurement grows the window by increase / window, so
+    that the window grows by about `increase` once per round of measurements.
+    The window is multiplied by `decrease` when a measurement times out, when
+    the failure ratio of the last round of measurements is above
+    maxFailureRatio, or when the smoothed measurement latency grows past
+    latencyTolerance times the lowest smoothed latency we have observed.
+
+    To avoid collapsing the window on a burst of timeouts, the window is
+    decreased at most once per round of measurements.
+    """
+    increase = 1.0
+    decrease = 0.5
+    maxFailureRatio = 0.25
+    latencyTolerance = 2.0
+    # The weight of the newest sample in the smoothed latency.
+    latencyAlpha = 0.125
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.window = float(min(max(initial, self.minimum), self.maximum))
+
+        self.latency = None
+        self.baseLatency = None
+
+        self._roundCompleted = 0
+        self._roundFailed = 0
+        self._cooldown = 0
+
+    @property
+    def slots(self):
+        """
+        Returns the number of slots the measurement manager should use.
+        """
+        return int(self.window)
+
+    def _completed(self, failed=False):
+        self._roundCompleted += 1
+        if failed:
+            self._roundFailed += 1
+        if self._cooldown > 0:
+            self._cooldown -= 1
+        if self._roundCompleted >= self.slots:
+            failure_ratio = float(self._roundFailed) / self._roundCompleted
+            self._roundCompleted = 0
+            self._roundFailed = 0
+            if failure_ratio > self.maxFailureRatio:
+                self._backOff()
+
+    def _backOff(self):
+        if self._cooldown > 0:
+            return
+        self.window = max(self.window * self.decrease, self.minimum)
+        self._cooldown = self.slots
+
+    def _observeLatency(self, runtime):
+        if self.latency is None:
+            self.latency = runtime
+        else:
+            self.latency += self.latencyAlpha * (runtime - self.latency)
+        if self.baseLatency is None or self.latency < self.baseLatency:
+            self.baseLatency = self.latency
+
+    def succeeded(self, runtime):
+        self._observeLatency(runtime)
+        if self.baseLatency and \
+                self.latency > self.baseLatency * self.latencyTolerance:
+            self._backOff()
+        else:
+            self.window = min(self.window + self.increase / self.window,
+                              self.maximum)
+        self._completed()
+
+    def failed(self):
+        self._completed(failed=True)
+
+    def timedOut(self):
+        self._backOff()
+        self._completed(failed=True)
+
+
+class TokenBucket(object):
+    """
+    A token bucket that refills at `rate` tokens per second and holds at most
+    `burst` tokens.
+    """
+    def __init__(self, rate, burst, clock):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        """
+        Takes a token from the bucket. Returns False if there is none.
+        """
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        """
+        Returns the number of seconds until a token will be available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class HostScheduler(object):
+    """
+    A task source that sits between the measurement generator of a NetTest and
+    the MeasurementManager.
+
+    It reads ahead up to `lookahead` measurements from the generator and hands
+    them out round robin by destination, so that a long run of inputs towards
+    the same host is interleaved with the rest of the inputs. On top of that it
+    enforces a per destination concurrency cap (`concurrency`) and a per
+    destination token bucket (`rate` measurements per second with bursts of
+    `burst`).
+
+    Measurements whose destination is None are not subject to any limit.
+
+    When no buffered measurement can be run we yield None and call `onReady`
+    once that changes.
+    """
+    lookahead = 100
+
+    # So that we can test the callLater calls
+    clock = reactor
+
+    def __init__(self, measurements, destination,
+                 concurrency=None, rate=None, burst=1):
+        """
+        measurements:
+            an iterator of measurements.
+
+        destination:
+            a callable that takes a measurement and returns the destination
+            it will be talking to (e.g. a hostname).
+        """
+        self._measurements = iter(measurements)
+        self._exhausted = False
+        self.destination = destination
+
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.onReady = None
+
+        self._queues = {}
+        self._order = deque()
+        self._buffered = 0
+        self._active = {}
+        self._buckets = {}
+        self._timer = None
+
+        self.destinations = set()
+        self.maxActivePerDestination = 0
+        self.throttled = 0
+
+    def __iter__(self):
+        return self
+
+    def _pull(self):
+        try:
+            measurement = next(self._measurements)
+        except StopIteration:
+            self._exhausted = True
+            return
+        host = self.destination(measurement)
+        if host not in self._queues:
+            self._queues[host] = deque()
+            self._order.append(host)
+        self._queues[host].append(measurement)
+        self._buffered += 1
+        self.destinations.add(host)
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.rate, self.burst,
+                                              self.clock)
+        return self._buckets[host]
+
+    def _canRun(self, host):
+        if host is None:
+            return True
+        if self.concurrency and \
+                self._active.get(host, 0) >= self.concurrency:
+            return False
+        if self.rate and not self._bucket(host).consume():
+            return False
+        return True
+
+    def _done(self, result, host):
+        self._active[host] -= 1
+        if self._active[host] == 0:
+            del self._active[host]
+        self._notify()
+        return result
+
+    def _notify(self):
+        if self.onReady is not None:
+            self.onReady()
+
+    def _timerFired(self):
+        self._timer = None
+        self._notify()
+
+    def _armTimer(self):
+        """
+        If we are only waiting for tokens, make sure we get woken up when the
+        first of them becomes available.
+        """
+        if not self.rate or self._timer is not None:
+            return
+        delays = [self._bucket(host).delay() for host in self._order
+                  if host is not None and
+                  (not self.concurrency or
+                   self._active.get(host, 0) < self.concurrency)]
+        if delays:
+            self._timer = self.clock.callLater(min(delays), self._timerFired)
+
+    def _pick(self):
+        for _ in range(len(self._order)):
+            host = self._order[0]
+            self._order.rotate(-1)
+            if not self._canRun(host):
+                continue
+            queue = self._queues[host]
+            measurement = queue.popleft()
+            self._buffered -= 1
+            if not queue:
+                del self._queues[host]
+                self._order.remove(host)
+            if host is not None:
+                self._active[host] = self._active.get(host, 0) + 1
+                self.maxActivePerDestination = max(
+                    self.maxActivePerDestination, self._active[host])
+                measurement.done.addBoth(self._done, host)
+            return measurement
+        return None
+
+    def next(self):
+        while not self._exhausted and self._buffered < self.lookahead:
+            self._pull()
+
+        if self._buffered == 0:
+            raise StopIteration
+
+        measurement = self._pick()
+        if measurement is None:
+            self.throttled += 1
+            self._armTimer()
+        return measurement
+
+    __next__ = next
+
+    @property
+    def summary(self):
+        return {
+            'destinations': len(self.destinations),
+            'max_active_per_destination': self.maxActivePerDestination,
+            'throttled': self.throttled
+        }
+
+
 class MeasurementManager(LinkedTaskManager):
 
     """
@@ -177,35 +561,85 @@ class MeasurementManager(LinkedTaskManager):
 
     NetTest on the contrary is aware of the typology of measurements that it is
     dispatching as they are logically grouped by test file.
+
+    When advanced.measurement_concurrency_adaptive is set the number of
+    concurrent measurements is adjusted at runtime by an AIMDController.
     """
+    director = None
+    controller = None
 
     def __init__(self):
         if config.advanced.measurement_retries:
             self.retries = config.advanced.measurement_retries
         if config.advanced.measurement_concurrency:
             self.concurrency = config.advanced.measurement_concurrency
+        if config.advanced.measurement_retry_backoff:
+            self.retryBackoff = config.advanced.measurement_retry_backoff
+        if config.advanced.measurement_concurrency_adaptive:
+            self.controller = AIMDController(
+                self.concurrency,
+                config.advanced.measurement_concurrency_min or 1,
+                config.advanced.measurement_concurrency_max or self.concurrency
+            )
+            self.concurrency = self.controller.slots
         super(MeasurementManager, self).__init__()
 
+    def _updateConcurrency(self):
+        if self.controller is None:
+            return
+        slots = self.controller.slots
+        if slots != self.concurrency:
+            log.debug("Changing measurement concurrency from %d to %d" %
+                      (self.concurrency, slots))
+            self.concurrency = slots
+            self._fillSlots()
+
     def succeeded(self, result, measurement):
         log.debug("Successfully performed measurement %s" % measurement)
         log.debug("%s" % result)
+        if self.controller is not None:
+            # The runtime would include the retry backoff and the time
+            # spent throttled, we only want the latency of the network.
+            self.controller.succeeded(measurement.attemptRuntime)
+            self._updateConcurrency()
 
     def failed(self, failure, measurement):
-        pass
-
+        timed_out = failure.check(CancelledError, TaskTimedOut) is not None
+        if timed_out and self.director is not None:
+            self.director.measurementTimedOut(measurement)
+        if self.controller is not None:
+            if timed_out:
+                self.controller.timedOut()
+            else:
+                self.controller.failed()
+            self._updateConcurrency()
+
+
+class ReportEntryManager(object):
+    """
+    Keeps track of the report sinks (see :class:ooni.reporter.ReportSink)
+    that have fallen behind.
 
-class ReportEntryManager(LinkedTaskManager):
+    It can be linked as the child of a LinkedTaskManager: while any sink is
+    full there are no available slots, so the parent stops scheduling new
+    measurements until the sink has drained.
+    """
+    parent = None
 
     def __init__(self):
-        if config.advanced.reporting_retries:
-            self.retries = config.advanced.reporting_retries
-        if config.advanced.reporting_concurrency:
-            self.concurrency = config.advanced.reporting_concurrency
-        super(ReportEntryManager, self).__init__()
+        self._fullSinks = set()
 
-    def succeeded(self, result, task):
-        log.debug("Successfully performed report %s" % task)
-        log.debug(str(result))
+    @property
+    def availableSlots(self):
+        if self._fullSinks:
+            return 0
+        return sys.maxint
 
-    def failed(self, failure, task):
-        pass
+    def sinkFull(self, sink):
+        log.debug("Report sink %s has fallen behind" % sink)
+        self._fullSinks.add(sink)
+
+    def sinkDrained(self, sink):
+        self._fullSinks.discard(sink)
+        if not self._fullSinks and self.parent:
+            self.parent._fillSlots()
@@ -2,7 +2,9 @@ import os
 import re
 import time
 import sys
+import json
 from hashlib import sha256
+from urlparse import urlparse
 
 from twisted.internet import defer
 from twisted.trial.runner import filenameToModule
@@ -11,6 +13,7 @@ from twisted.python import usage, reflect
 from ooni import __version__ as ooniprobe_version
 from ooni import otime
 from ooni.tasks import Measurement
+from ooni.managers import HostScheduler
 from ooni.utils import log, sanitize_options, randomStr
 from ooni.utils.net import hasRawSocketPermission
 from ooni.settings import config
@@ -129,6 +132,77 @@ def getNetTestInformation(net_test_file):
     return information
 
 
+class NetTestInformationCache(object):
+    """
+    Caches what getNetTestInformation returns in a JSON file, so that the
+    nettests do not need to be imported to be listed.
+
+    The entry of a nettest is used as long as the modification time and size
+    of its file are unchanged or, if they changed, as long as the sha256 of
+    its content is still the same.
+    """
+    def __init__(self, cache_file):
+        self.cacheFile = cache_file
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(cache_file) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def _digest(self, net_test_file):
+        with open(net_test_file, 'rb') as f:
+            return sha256(f.read()).hexdigest()
+
+    def get(self, net_test_file):
+        """
+        Returns the information about net_test_file, importing it only when
+        it is not in the cache or it has changed.
+        """
+        stat = os.stat(net_test_file)
+        entry = self._entries.get(net_test_file)
+        if entry and entry['mtime'] == stat.st_mtime and \
+                entry['size'] == stat.st_size:
+            return entry['information']
+
+        digest = self._digest(net_test_file)
+        if entry and entry['sha256'] == digest:
+            entry['mtime'] = stat.st_mtime
+            entry['size'] = stat.st_size
+            self._dirty = True
+            return entry['information']
+
+        information = getNetTestInformation(net_test_file)
+        try:
+            json.dumps(information)
+        except (TypeError, ValueError):
+            log.debug("Not caching the information about %s" % net_test_file)
+            return information
+        self._entries[net_test_file] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'sha256': digest,
+            'information': information
+        }
+        self._dirty = True
+        return information
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_file = self.cacheFile + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._entries, f)
+            os.rename(tmp_file, self.cacheFile)
+        except (IOError, OSError) as exc:
+            log.debug("Failed to write the nettest cache %s: %s" % (
+                self.cacheFile, exc))
+            return
+        self._dirty = False
+
+
 def usageOptionsFactory(test_name, test_version):
 
     class UsageOptions(usage.Options):
@@ -160,6 +234,7 @@ ONION_INPUT_REGEXP = re.compile("(httpo://[a-z0-9]{16}\.onion)/input/(["
 class NetTestLoader(object):
     method_prefix = 'test'
     collector = None
+    reportFormat = None
     yamloo = True
     requiresTor = False
 
@@ -182,6 +257,10 @@ class NetTestLoader(object):
         self._testCases = []
         self.localOptions = None
 
+        # The path of the nettest, so that it can be loaded again by the
+        # shard workers.
+        self.testFile = test_file
+
         if test_file:
             self.loadNetTestFile(test_file)
         elif test_string:
@@ -482,6 +561,11 @@ class NetTestState(object):
 class NetTest(object):
     director = None
 
+    # When set to a (index, count) tuple only every count-th report entry,
+    # starting from the index-th, is measured. This is used to split a
+    # NetTest across the worker processes of :class:ooni.sharding.ShardedNetTest.
+    shard = None
+
     def __init__(self, test_cases, test_details, report):
         """
         net_test_loader:
@@ -497,6 +581,7 @@ class NetTest(object):
         self.testCases = test_cases
 
         self.summary = {}
+        self.hostScheduler = None
 
         # This will fire when all the measurements have been completed and
         # all the reports are done. Done means that they have either completed
@@ -523,9 +608,36 @@ class NetTest(object):
             for test_class in self.uniqueClasses():
                 test_instance = test_class()
                 test_instance.displaySummary(self.summary)
+        scheduler_summary = self.schedulerSummary()
+        if scheduler_summary:
+            print "Destinations: %d (at most %d concurrent measurements " \
+                  "per destination, throttled %d times)" % (
+                      scheduler_summary['destinations'],
+                      scheduler_summary['max_active_per_destination'],
+                      scheduler_summary['throttled'])
         if self.testDetails["report_id"]:
             print "Report ID: %s" % self.testDetails["report_id"]
 
+    def schedulerSummary(self):
+        """
+        Returns the summary of the HostScheduler or None if the measurements
+        have not gone through one.
+        """
+        if self.hostScheduler:
+            return self.hostScheduler.summary
+        return None
+
+    def writeReport(self, entry, entry_index):
+        """
+        Writes the entry with the given index, in the order in which the
+        inputs are generated, to the report.
+        """
+        return self.report.write(entry)
+
+    def writeReportFailed(self, failure, entry_index):
+        log.err("Failed to produce the report entry %d" % entry_index)
+        log.exception(failure)
+
     def doneReport(self, report_results):
         """
         This will get called every time a report is done and therefore a
@@ -559,12 +671,63 @@ class NetTest(object):
         measurement.netTest = self
 
         if self.director:
+            self.director.measurementStarted(measurement)
             measurement.done.addCallback(self.director.measurementSucceeded,
                                          measurement)
             measurement.done.addErrback(self.director.measurementFailed,
                                         measurement)
         return measurement
 
+    def _destinationLimits(self):
+        test_class = self.testCases[0][0]
+        concurrency = test_class.perHostConcurrency
+        if concurrency is None:
+            concurrency = config.advanced.per_host_concurrency
+        rate = test_class.perHostRate
+        if rate is None:
+            rate = config.advanced.per_host_rate
+        burst = test_class.perHostBurst
+        if burst is None:
+            burst = config.advanced.per_host_burst or 1
+        if self.shard is not None:
+            # Every shard gets its share of the limits
+            _, count = self.shard
+            if concurrency:
+                concurrency = max(1, concurrency / count)
+            if rate:
+                rate = float(rate) / count
+        return concurrency, rate, burst
+
+    def measurementSource(self, on_ready=None):
+        """
+        Returns the source of measurements to be scheduled on the
+        MeasurementManager.
+
+        If a per destination concurrency or rate limit is set, either on the
+        NetTestCase or in ooniprobe.conf, the measurements are passed through
+        a :class:ooni.managers.HostScheduler that interleaves them by
+        destination and enforces such limits.
+
+        Args:
+            on_ready:
+                is called when the HostScheduler has measurements ready to run
+                after having been throttled.
+        """
+        measurements = self.generateMeasurements()
+        concurrency, rate, burst = self._destinationLimits()
+        if not concurrency and not rate:
+            return measurements
+
+        def destination(measurement):
+            test_instance = measurement.testInstance
+            return test_instance.destinationForInput(test_instance.input)
+
+        self.hostScheduler = HostScheduler(measurements, destination,
+                                           concurrency=concurrency,
+                                           rate=rate, burst=burst)
+        self.hostScheduler.onReady = on_ready
+        return self.hostScheduler
+
     @defer.inlineCallbacks
     def initialize(self):
         for test_class, _ in self.testCases:
@@ -584,9 +747,14 @@ class NetTest(object):
         callbacks for when a measurement is successful or has failed.
         """
 
+        entry_index = -1
         for test_class, test_methods in self.testCases:
             # load the input processor as late as possible
             for input in test_class.inputs:
+                entry_index += 1
+                if self.shard is not None and \
+                        entry_index % self.shard[1] != self.shard[0]:
+                    continue
                 measurements = []
                 test_instance = test_class()
                 test_instance._setUp()
@@ -608,7 +776,10 @@ class NetTest(object):
 
                     @post.addBoth
                     def set_runtime(results):
-                        runtime = time.time() - test_instance._start_time
+                        # None of the measurements may have been run
+                        start_time = getattr(test_instance, '_start_time',
+                                             time.time())
+                        runtime = time.time() - start_time
                         for _, m in results:
                             m.testInstance.report['test_runtime'] = runtime
                         test_instance.report['test_runtime'] = runtime
@@ -622,7 +793,8 @@ class NetTest(object):
                         failure.trap(e.NoPostProcessor)
                         return report
                     post.addErrback(noPostProcessor, test_instance.report)
-                    post.addCallback(self.report.write)
+                    post.addCallback(self.writeReport, entry_index)
+                    post.addErrback(self.writeReportFailed, entry_index)
 
                 if self.report and self.director:
                     # ghetto hax to keep NetTestState counts are accurate
@@ -677,6 +849,13 @@ class NetTestCase(object):
     * usageOptions: a subclass of twisted.python.usage.Options for processing
         of command line arguments
 
+    * perHostConcurrency, perHostRate, perHostBurst: limit how many
+      measurements may run concurrently towards the same destination and at
+      which rate (measurements per second, with bursts of perHostBurst) they
+      may be started. When set to None the values of per_host_concurrency,
+      per_host_rate and per_host_burst in ooniprobe.conf are used. The
+      destination of an input is given by destinationForInput.
+
     * localOptions: contains the parsed command line arguments.
 
     Quirks:
@@ -703,6 +882,10 @@ class NetTestCase(object):
     requiresRoot = False
     requiresTor = False
 
+    perHostConcurrency = None
+    perHostRate = None
+    perHostBurst = None
+
     localOptions = {}
 
     @classmethod
@@ -737,6 +920,23 @@ class NetTestCase(object):
         """
         pass
 
+    def destinationForInput(self, test_input):
+        """
+        Returns the destination (usually a hostname) that the measurement for
+        test_input will be talking to. This is used to interleave inputs and to
+        apply per destination limits.
+
+        Override this if your inputs are not URLs, host:port pairs or
+        hostnames. Returning None exempts the input from any limit.
+        """
+        if not test_input or not isinstance(test_input, basestring):
+            return None
+        if '://' in test_input:
+            return urlparse(test_input).hostname
+        if test_input.count(':') == 1:
+            return test_input.split(':')[0]
+        return test_input
+
     def postProcessor(self, measurements):
         """
         Subclass this to do post processing tasks that are to occur once all
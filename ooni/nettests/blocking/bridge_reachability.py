@@ -1,15 +1,11 @@
 # -*- encoding: utf-8 -*-
 import os
-import random
 import tempfile
-import shutil
 
 from twisted.python import usage
-from twisted.internet import reactor, error
+from twisted.internet import defer
 
-import txtorcon
-
-from ooni.utils import log, onion
+from ooni.utils import log, onion, torpool
 from ooni import nettest
 
 
@@ -21,7 +17,10 @@ class UsageOptions(usage.Options):
     optParameters = [
         ['timeout', 't', 120,
          'Specify the timeout after which to consider '
-         'the Tor bootstrapping process to have failed.'], ]
+         'the Tor bootstrapping process to have failed.'],
+        ['tor-instances', 'n', 4,
+         'Specify how many tor processes to test bridges with '
+         'at the same time.'], ]
 
 
 class BridgeReachability(nettest.NetTestCase):
@@ -29,7 +28,7 @@ class BridgeReachability(nettest.NetTestCase):
     description = "A test for checking if bridges are reachable " \
                   "from a given location."
     author = "Arturo Filastò"
-    version = "0.1.2"
+    version = "0.2.0"
 
     usageOptions = UsageOptions
 
@@ -40,6 +39,17 @@ class BridgeReachability(nettest.NetTestCase):
 
     requiredOptions = ['file']
 
+    @classmethod
+    def setUpClass(cls):
+        tor_instances = int(cls.localOptions['tor-instances'])
+        # Every tor of the pool tests one bridge at a time
+        cls.perHostConcurrency = tor_instances
+        cls.torPool = torpool.TorPool(tor_instances)
+
+    def destinationForInput(self, test_input):
+        # All the bridges are tested with the same pool of tor processes
+        return 'tor'
+
     def requirements(self):
         if not onion.find_tor_binary():
             raise TorIsNotInstalled(
@@ -54,7 +64,6 @@ class BridgeReachability(nettest.NetTestCase):
         os.close(fd)
         fd, self.obfsproxy_logfile = tempfile.mkstemp()
         os.close(fd)
-        self.tor_datadir = tempfile.mkdtemp()
 
         self.report['error'] = None
         self.report['success'] = None
@@ -121,15 +130,13 @@ class BridgeReachability(nettest.NetTestCase):
         log.msg("Working bridges: %s" % working_bridges)
         log.msg("Failing bridges: %s" % failing_bridges)
 
+    @defer.inlineCallbacks
     def test_full_tor_connection(self):
-        config = txtorcon.TorConfig()
-        config.ControlPort = random.randint(2**14, 2**16)
-        config.SocksPort = random.randint(2**14, 2**16)
-        config.DataDirectory = self.tor_datadir
         log.msg(
             "Connecting to %s with tor %s" %
             (self.bridge, onion.tor_details['version']))
 
+        transport_line = None
         transport_name = onion.transport_name(self.bridge)
         if transport_name == None:
             self.report['bridge_address'] = self.bridge.split(' ')[0]
@@ -138,7 +145,7 @@ class BridgeReachability(nettest.NetTestCase):
             self.report['transport_name'] = transport_name
 
             try:
-                config.ClientTransportPlugin = \
+                transport_line = \
                         onion.bridge_line(transport_name, self.obfsproxy_logfile)
             except onion.UnrecognizedTransport:
                 log.err("Unable to test bridge because we don't recognize "
@@ -161,13 +168,7 @@ class BridgeReachability(nettest.NetTestCase):
                 self.report['error'] = 'unsupported-tor-version'
                 return
 
-            log.debug("Using ClientTransportPlugin '%s'" % \
-                      config.ClientTransportPlugin)
-
-        config.Bridge = self.bridge
-        config.UseBridges = 1
-        config.log = ['notice stdout', 'notice file %s' % self.tor_logfile]
-        config.save()
+            log.debug("Using ClientTransportPlugin '%s'" % transport_line)
 
         def updates(prog, tag, summary):
             log.msg("%s: %s%%" % (self.bridge, prog))
@@ -175,40 +176,28 @@ class BridgeReachability(nettest.NetTestCase):
             self.report['tor_progress_tag'] = tag
             self.report['tor_progress_summary'] = summary
 
-        d = txtorcon.launch_tor(config, reactor, timeout=self.timeout,
-                                progress_updates=updates)
+        tor = yield self.torPool.acquire()
+        try:
+            success = yield tor.testBridge(self.bridge, transport_line,
+                                           self.tor_logfile, self.timeout,
+                                           progress_updates=updates)
+            obfs4proxy_log = tor.transportLog()
+        finally:
+            self.torPool.release(tor)
 
-        @d.addCallback
-        def setup_complete(proto):
-            try:
-                proto.transport.signalProcess('TERM')
-            except error.ProcessExitedAlready:
-                proto.transport.loseConnection()
+        if success:
             log.msg("Successfully connected to %s" % self.bridge)
             self.report['success'] = True
-
-        @d.addErrback
-        def setup_failed(failure):
+        else:
             log.msg("Failed to connect to %s" % self.bridge)
             self.report['success'] = False
             self.report['error'] = 'timeout-reached'
-            return
-
-        @d.addCallback
-        def write_log(_):
-            with open(self.tor_logfile) as f:
-                self.report['tor_log'] = f.read()
-            os.remove(self.tor_logfile)
-            with open(self.obfsproxy_logfile) as f:
-                self.report['obfsproxy_log'] = f.read()
-            os.remove(self.obfsproxy_logfile)
-            try:
-                with open(os.path.join(self.tor_datadir,
-                        'pt_state', 'obfs4proxy.log')) as f:
-                    self.report['obfsproxy_log'] = f.read()
-            except:
-                pass
-            finally:
-                shutil.rmtree(self.tor_datadir)
-
-        return d
+
+        with open(self.tor_logfile) as f:
+            self.report['tor_log'] = f.read()
+        os.remove(self.tor_logfile)
+        with open(self.obfsproxy_logfile) as f:
+            self.report['obfsproxy_log'] = f.read()
+        os.remove(self.obfsproxy_logfile)
+        if obfs4proxy_log is not None:
+            self.report['obfsproxy_log'] = obfs4proxy_log
@@ -30,16 +30,26 @@ class UsageOptions(usage.Options):
                      ['testresolvers', 'T', None,
                       'File containing list of DNS resolvers to test against.'],
                      ['testresolver', 't', None,
-                         'Specify a single test resolver to use for testing.']
+                         'Specify a single test resolver to use for testing.'],
+                     ['concurrency', 'c', 20,
+                      'How many test resolvers to query at the same time.']
                      ]
 
+    def postOptions(self):
+        try:
+            self['concurrency'] = int(self['concurrency'])
+        except ValueError:
+            raise usage.UsageError("The concurrency must be a number")
+        if self['concurrency'] < 1:
+            raise usage.UsageError("The concurrency must be at least 1")
+
 
 class DNSConsistencyTest(dnst.DNSTest):
 
     name = "DNS Consistency"
     description = "Checks to see if the DNS responses from a "\
                   "set of DNS resolvers are consistent."
-    version = "0.7.0"
+    version = "0.8.0"
     authors = "Arturo Filastò, Isis Lovecruft"
 
     inputFile = ['file', 'f', None,
@@ -117,8 +127,8 @@ class DNSConsistencyTest(dnst.DNSTest):
         self.report['errors'] = {}
 
         try:
-            control_answers = yield self.performALookup(hostname,
-                                                        self.control_dns_server)
+            control_answers = yield self.performALookup(
+                hostname, self.control_dns_server, use_cache=True)
 
             if not control_answers:
                 log.err(
@@ -134,69 +144,99 @@ class DNSConsistencyTest(dnst.DNSTest):
                 self.control_dns_server] = 'error'
             control_answers = None
 
-        for test_resolver in self.test_resolvers:
-            log.msg("Testing resolver: %s" % test_resolver)
-            test_dns_server = (test_resolver, 53)
-
-            try:
-                experiment_answers = yield self.performALookup(hostname,
-                                                               test_dns_server)
-            except Exception:
-                log.err("Problem performing the DNS lookup")
-                self.report['errors'][test_resolver] = 'dns_lookup_error'
-                self.report['failures'].append(test_resolver)
-                continue
-
-            if not experiment_answers:
-                log.err("Got no response, perhaps the DNS resolver is down?")
-                self.report['errors'][test_resolver] = 'no_answer'
-                self.report['failures'].append(test_resolver)
-                continue
-            else:
-                log.debug(
-                    "Got the following A lookup answers %s from %s" %
-                    (experiment_answers, test_resolver))
-
-            def lookup_details():
-                """
-                A closure useful for printing test details.
-                """
-                log.msg("test resolver: %s" % test_resolver)
-                log.msg("experiment answers: %s" % experiment_answers)
-                log.msg("control answers: %s" % control_answers)
+        # The test resolvers are queried in parallel, but they, and their
+        # queries, are listed in the report in the same order as before. The
+        # control lookups go through the shared DNS cache, so the resolvers
+        # that need the reverse lookup of the control answers wait for the
+        # same query instead of sending one each.
+        resolver_queries = [[] for _ in self.test_resolvers]
+        semaphore = defer.DeferredSemaphore(self.localOptions['concurrency'])
+        results = yield defer.DeferredList([
+            semaphore.run(self.compareResolver, hostname, test_resolver,
+                          control_answers, queries)
+            for test_resolver, queries in zip(self.test_resolvers,
+                                              resolver_queries)
+        ], consumeErrors=True)
+        for test_resolver, queries, (success, outcome) in zip(
+                self.test_resolvers, resolver_queries, results):
+            self.report['queries'].extend(queries)
+            if not success:
+                # A failed reverse lookup fails the measurement, like it did
+                # when the resolvers were queried one after the other.
+                outcome.raiseException()
+            if outcome is not None:
+                self.report[outcome].append(test_resolver)
 
-            log.debug(
-                "Comparing %s with %s" %
-                (experiment_answers, control_answers))
+    @defer.inlineCallbacks
+    def compareResolver(self, hostname, test_resolver, control_answers,
+                        queries):
+        """
+        Compares the answers of test_resolver with the control ones and
+        returns the list of the report it belongs to, if any.
 
-            if not control_answers:
-                log.msg("Skipping control resolver comparison")
-                self.report['errors'][test_resolver] = None
+        The queries it makes are added to queries.
+        """
+        log.msg("Testing resolver: %s" % test_resolver)
+        test_dns_server = (test_resolver, 53)
 
-            elif set(experiment_answers) & set(control_answers):
+        try:
+            experiment_answers = yield self.performALookup(
+                hostname, test_dns_server, queries=queries)
+        except Exception:
+            log.err("Problem performing the DNS lookup")
+            self.report['errors'][test_resolver] = 'dns_lookup_error'
+            defer.returnValue('failures')
+
+        if not experiment_answers:
+            log.err("Got no response, perhaps the DNS resolver is down?")
+            self.report['errors'][test_resolver] = 'no_answer'
+            defer.returnValue('failures')
+        else:
+            log.debug(
+                "Got the following A lookup answers %s from %s" %
+                (experiment_answers, test_resolver))
+
+        def lookup_details():
+            """
+            A closure useful for printing test details.
+            """
+            log.msg("test resolver: %s" % test_resolver)
+            log.msg("experiment answers: %s" % experiment_answers)
+            log.msg("control answers: %s" % control_answers)
+
+        log.debug(
+            "Comparing %s with %s" %
+            (experiment_answers, control_answers))
+
+        if not control_answers:
+            log.msg("Skipping control resolver comparison")
+            self.report['errors'][test_resolver] = None
+            defer.returnValue(None)
+        elif set(experiment_answers) & set(control_answers):
+            lookup_details()
+            log.msg("tampering: false")
+            self.report['errors'][test_resolver] = False
+            defer.returnValue('successful')
+        else:
+            log.msg("Trying to do reverse lookup")
+            experiment_reverse = yield self.performPTRLookup(
+                experiment_answers[0], test_dns_server, queries=queries)
+            control_reverse = yield self.performPTRLookup(
+                control_answers[0], self.control_dns_server,
+                use_cache=True, queries=queries)
+
+            if experiment_reverse == control_reverse:
+                log.msg("Further testing has eliminated false positives")
                 lookup_details()
-                log.msg("tampering: false")
-                self.report['errors'][test_resolver] = False
-                self.report['successful'].append(test_resolver)
+                log.msg("tampering: reverse_match")
+                self.report['errors'][test_resolver] = 'reverse_match'
+                defer.returnValue('successful')
             else:
-                log.msg("Trying to do reverse lookup")
-                experiment_reverse = yield self.performPTRLookup(experiment_answers[0],
-                                                                 test_dns_server)
-                control_reverse = yield self.performPTRLookup(control_answers[0],
-                                                              self.control_dns_server)
-
-                if experiment_reverse == control_reverse:
-                    log.msg("Further testing has eliminated false positives")
-                    lookup_details()
-                    log.msg("tampering: reverse_match")
-                    self.report['errors'][test_resolver] = 'reverse_match'
-                    self.report['successful'].append(test_resolver)
-                else:
-                    log.msg("Reverse lookups do not match")
-                    lookup_details()
-                    log.msg("tampering: true")
-                    self.report['errors'][test_resolver] = True
-                    self.report['inconsistent'].append(test_resolver)
+                log.msg("Reverse lookups do not match")
+                lookup_details()
+                log.msg("tampering: true")
+                self.report['errors'][test_resolver] = True
+                defer.returnValue('inconsistent')
 
     def inputProcessor(self, filename=None):
         """
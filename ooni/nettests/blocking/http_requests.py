@@ -153,8 +153,8 @@ class HTTPRequestsTest(httpt.HTTPTest):
                     log.msg("The control body contains a blockpage from "
                             "cloudflare. This will skew our results.")
                     self.report['control_cloudflare'] = True
-                self.compare_body_lengths(len(control.body),
-                                          len(experiment.body))
+                self.compare_body_lengths(control.bodyLength,
+                                          experiment.bodyLength)
             if hasattr(experiment, 'headers') and hasattr(control, 'headers') \
                     and experiment.headers and control.headers:
                 self.compare_headers(control.headers,
@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 
 import csv
+import time
 from urlparse import urlparse
 
 from ipaddr import IPv4Address, AddressValueError
@@ -37,6 +38,11 @@ class UsageOptions(usage.Options):
         ['retries', 'r', 1, 'Number of retries for the HTTP request'],
         ['timeout', 't', 240, 'Total timeout for this test'],
     ]
+    optFlags = [
+        ['no-pipeline', None, 'Send the control request only once the TCP '
+         'connect and HTTP experiments are done, instead of while they are '
+         'running.'],
+    ]
 
 
 def is_public_ipv4_address(address):
@@ -58,7 +64,7 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
                    "connect to the resolved IPs and then fetching the page "
                    "and comparing all these results with those of a control.")
     author = "Arturo Filastò"
-    version = "0.1.0"
+    version = "0.2.0"
 
     contentDecoders = [('gzip', GzipDecoder)]
 
@@ -166,6 +172,13 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
 
         self.report['tcp_connect'] = []
         self.report['control'] = {}
+        # How long each phase of the test took, in seconds
+        self.report['runtimes'] = {
+            'dns_experiment': None,
+            'tcp_connect': None,
+            'http_experiment': None,
+            'control_request': None
+        }
 
         self.hostname = urlparse(self.input).netloc
         if not self.hostname:
@@ -194,6 +207,18 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
                 self.localOptions['backend']
             )
 
+    def timed(self, phase, d):
+        """
+        Records in the report how long it took for d to fire.
+        """
+        start_time = time.time()
+
+        @d.addBoth
+        def done(result):
+            self.report['runtimes'][phase] = time.time() - start_time
+            return result
+        return d
+
     def experiment_dns_query(self):
         log.msg("* doing DNS query for {}".format(self.hostname))
         return self.performALookup(self.hostname)
@@ -276,7 +301,7 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
 
     def compare_body_lengths(self, experiment_http_response):
         control_body_length = self.control['http_request']['body_length']
-        experiment_body_length = len(experiment_http_response.body)
+        experiment_body_length = experiment_http_response.bodyLength
 
         if control_body_length == experiment_body_length:
             rel = float(1)
@@ -344,10 +369,10 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
         if len(control_addrs.intersection(experiment_addrs)) > 0:
             return True
 
-        experiment_asns = set(map(lambda x: geoip.IPToLocation(x)['asn'],
-                              experiment_addrs))
-        control_asns = set(map(lambda x: geoip.IPToLocation(x)['asn'],
-                           control_addrs))
+        locations = geoip.IPToLocations(experiment_addrs | control_addrs)
+        experiment_asns = set(locations[addr]['asn']
+                              for addr in experiment_addrs)
+        control_asns = set(locations[addr]['asn'] for addr in control_addrs)
 
         # Remove the instance of AS0 when we fail to find the ASN
         control_asns.discard('AS0')
@@ -441,7 +466,8 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
     def test_web_connectivity(self):
         log.msg("")
         log.msg("Starting test for {}".format(self.input))
-        experiment_dns = self.experiment_dns_query()
+        experiment_dns = self.timed('dns_experiment',
+                                    self.experiment_dns_query())
 
         @experiment_dns.addErrback
         def dns_experiment_err(failure):
@@ -461,13 +487,31 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
             if is_public_ipv4_address(ip_address) is True:
                 sockets.append("{}:{}".format(ip_address, port))
 
+        def start_control_request():
+            control_request = self.timed('control_request',
+                                         self.control_request(sockets))
+            @control_request.addErrback
+            def control_err(failure):
+                failure_string = failureToString(failure)
+                log.err("Failed to perform control lookup: %s" % failure_string)
+                self.report['control_failure'] = failure_string
+            return control_request
+
+        # The control request only depends on the sockets we have resolved,
+        # so unless asked not to we wait for the backend while performing the
+        # other experiments.
+        control_request = None
+        if not self.localOptions['no-pipeline']:
+            control_request = start_control_request()
+
         # STEALTH in here we should make changes to make the test more stealth
         dl = []
         for socket in sockets:
             dl.append(self.experiment_tcp_connect(socket))
-        results = yield defer.DeferredList(dl)
+        results = yield self.timed('tcp_connect', defer.DeferredList(dl))
 
-        experiment_http = self.experiment_http_get_request()
+        experiment_http = self.timed('http_experiment',
+                                     self.experiment_http_get_request())
         @experiment_http.addErrback
         def http_experiment_err(failure):
             failure_string = failureToString(failure)
@@ -476,13 +520,8 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
 
         experiment_http_response = yield experiment_http
 
-        control_request = self.control_request(sockets)
-        @control_request.addErrback
-        def control_err(failure):
-            failure_string = failureToString(failure)
-            log.err("Failed to perform control lookup: %s" % failure_string)
-            self.report['control_failure'] = failure_string
-
+        if control_request is None:
+            control_request = start_control_request()
         yield control_request
 
         if self.report['control_failure'] is None:
@@ -552,3 +591,5 @@ class WebConnectivityTest(httpt.HTTPTest, dnst.DNSTest):
                 log.msg("-----------------------------"+'-'*len(reason))
                 for url in urls:
                     log.msg("* {}".format(url))
+
+        dnst.DNSTest.displaySummary(self, summary)
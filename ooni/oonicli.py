@@ -33,11 +33,15 @@ class Options(usage.Options):
                               "nettests"],
                 ["printdeck", "p", "Print the equivalent deck for the "
                                    "provided command"],
-                ["verbose", "v", "Show more verbose information"]
+                ["verbose", "v", "Show more verbose information"],
+                ["profile-startup", None, "Print how long it took to import "
+                                          "the modules needed to start"]
                 ]
 
     optParameters = [
         ["reportfile", "o", None, "Specify the report file name to write to."],
+        ["reportformat", "F", None, "Specify the format of the report file "
+                                    "(yaml or jsonl, defaults to yaml)."],
         ["testdeck", "i", None, "Specify as input a test deck: a yaml file "
                                 "containing the tests to run and their "
                                 "arguments."],
@@ -102,6 +106,14 @@ This will tell you how to run ooniprobe :)
         except:
             raise usage.UsageError("No test filename specified!")
 
+    def postOptions(self):
+        from ooni.reporter import file_reporters
+        if self['reportformat'] is not None and \
+                self['reportformat'] not in file_reporters:
+            raise usage.UsageError("Invalid report format %s, must be one "
+                                   "of: %s" % (self['reportformat'],
+                                               ', '.join(file_reporters)))
+
 
 def parseOptions():
     print "WARNING: running ooniprobe involves some risk that varies greatly"
@@ -327,10 +339,15 @@ def runTestWithDirector(director, global_options, url=None, start_tor=True):
                 collector_client = setupCollector(global_options,
                                                   net_test_loader.collector)
 
+            # The report format given on the command line takes precedence
+            # over the one specified in the deck.
+            report_format = (global_options['reportformat'] or
+                             net_test_loader.reportFormat or 'yaml')
             yield director.startNetTest(net_test_loader,
                                         global_options['reportfile'],
                                         collector_client,
-                                        global_options['no-yamloo'])
+                                        global_options['no-yamloo'],
+                                        report_format)
 
     d.addCallback(setup_nettest)
     d.addCallback(post_director_start)
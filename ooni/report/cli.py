@@ -19,7 +19,9 @@ class Options(usage.Options):
     optFlags = [
         ["default-collector", "d", "Upload the reports to the default "
                                    "collector that is looked up with the "
-                                   "canonical bouncer."]
+                                   "canonical bouncer."],
+        ["profile-startup", None, "Print how long it took to import the "
+                                  "modules needed to start"]
     ]
 
     optParameters = [
@@ -28,7 +30,9 @@ class Options(usage.Options):
         ["collector", "c", None,
          "Specify the collector to upload the result to."],
         ["bouncer", "b", None,
-         "Specify the bouncer to query for a collector."]
+         "Specify the bouncer to query for a collector."],
+        ["concurrency", "n", 4,
+         "How many reports to upload at the same time.", int]
     ]
 
     def opt_version(self):
@@ -52,6 +56,10 @@ class Options(usage.Options):
             except IndexError:
                 self['report_file'] = None
 
+    def postOptions(self):
+        if self['concurrency'] < 1:
+            raise usage.UsageError("The concurrency must be at least 1")
+
 
 def tor_check():
     if not config.tor.socks_port:
@@ -83,7 +91,8 @@ def run():
     elif options['command'] == "upload":
         tor_check()
         return tool.upload_all(options['collector'],
-                               options['bouncer'])
+                               options['bouncer'],
+                               options['concurrency'])
     elif options['command'] == "status":
         return tool.status()
     else:
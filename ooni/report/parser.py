@@ -1,7 +1,88 @@
+import os
+import json
 import yaml
+import struct
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+class ReportIndex(object):
+    """
+    A sidecar file with the byte offset of every document of a YAML report,
+    header included, so that entries can be counted and skipped without
+    reading the report.
+
+    The index is a sequence of unsigned 64 bit integers: the size of the
+    report when the index was built, followed by the offsets. It is only used
+    when the size still matches the one of the report.
+    """
+    _record = struct.Struct('<Q')
+
+    def __init__(self, report_filename):
+        self.report_filename = report_filename
+        self.index_filename = report_filename + '.idx'
+        self._fp = None
+
+    @property
+    def valid(self):
+        try:
+            with open(self.index_filename, 'rb') as f:
+                data = f.read(self._record.size)
+        except IOError:
+            return False
+        if len(data) != self._record.size:
+            return False
+        size, = self._record.unpack(data)
+        return size == os.path.getsize(self.report_filename)
+
+    def build(self, offsets):
+        """
+        Writes the index for the given iterable of document offsets.
+        """
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self._record.pack(
+                os.path.getsize(self.report_filename)))
+            for offset in offsets:
+                f.write(self._record.pack(offset))
+        os.rename(tmp_filename, self.index_filename)
+
+    def open(self):
+        self._fp = open(self.index_filename, 'rb')
+
+    def __len__(self):
+        size = os.fstat(self._fp.fileno()).st_size
+        return size / self._record.size - 1
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        self._fp.seek((idx + 1) * self._record.size)
+        offset, = self._record.unpack(self._fp.read(self._record.size))
+        return offset
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
 
 
 class ReportLoader(object):
+    """
+    Loads the entries of a YAML report one document at a time.
+
+    Documents are found by their ``---`` and ``...`` markers, which always
+    start at the beginning of a line, and only the text of the document being
+    returned is parsed, so memory usage does not depend on the size of the
+    report.
+
+    When use_index is True an offset index is kept next to the report (see
+    :class:ReportIndex), and is built on first use, so that the number of
+    entries is known and entries can be skipped without reading them.
+    """
     _header_keys = (
         'probe_asn',
         'probe_cc',
@@ -15,21 +96,185 @@ class ReportLoader(object):
         'software_version'
     )
 
-    def __init__(self, report_filename):
-        self._fp = open(report_filename)
-        self._yfp = yaml.safe_load_all(self._fp)
+    def __init__(self, report_filename, use_index=False):
+        self._fp = open(report_filename, 'rb')
+        self._index = None
+        # The number of entries that have been returned or skipped
+        self.position = 0
+        if use_index:
+            self._index = ReportIndex(report_filename)
+            if not self._index.valid:
+                self._index.build(self._offsets())
+                self._fp.seek(0)
+            self._index.open()
 
-        self.header = self._yfp.next()
+        try:
+            self.header = self._nextDocument()
+        except StopIteration:
+            self.header = None
+
+    def _readDocument(self, keep=True):
+        """
+        Returns the offset and text of the next document or None if there
+        are no more documents. The text is only accumulated when keep is
+        True.
+        """
+        offset = None
+        lines = []
+        while True:
+            line_offset = self._fp.tell()
+            line = self._fp.readline()
+            if not line:
+                break
+            if line.startswith('---'):
+                if offset is not None:
+                    # A new document starts without the previous one being
+                    # explicitly ended.
+                    self._fp.seek(line_offset)
+                    break
+                offset = line_offset
+            elif offset is None:
+                # Comments in between documents
+                continue
+            elif line.startswith('...'):
+                break
+            if keep:
+                lines.append(line)
+        if offset is None:
+            return None
+        return offset, ''.join(lines)
+
+    def _offsets(self):
+        while True:
+            document = self._readDocument(keep=False)
+            if document is None:
+                return
+            yield document[0]
+
+    def _nextDocument(self):
+        document = self._readDocument()
+        if document is None:
+            raise StopIteration
+        return yaml.load(document[1], Loader=SafeLoader)
+
+    def __len__(self):
+        """
+        The number of entries in the report, header excluded. This requires
+        the index.
+        """
+        if self._index is None:
+            raise TypeError("The number of entries is only known when "
+                            "using an index")
+        return max(len(self._index) - 1, 0)
+
+    def skip(self, count):
+        """
+        Skips the next count entries, without parsing them.
+        """
+        if self._index is not None:
+            position = min(self.position + count, len(self))
+            if position < len(self):
+                self._fp.seek(self._index[position + 1])
+            else:
+                self._fp.seek(0, os.SEEK_END)
+            self.position = position
+            return
+        for _ in range(count):
+            if self._readDocument(keep=False) is None:
+                break
+            self.position += 1
 
     def __iter__(self):
         return self
 
     def next(self):
         try:
-            return self._yfp.next()
+            entry = self._nextDocument()
         except StopIteration:
+            self.close()
+            raise
+        self.position += 1
+        return entry
+
+    def close(self):
+        self._fp.close()
+        if self._index is not None:
+            self._index.close()
+
+
+class JSONLReportLoader(object):
+    """
+    Loads a report written by :class:ooni.reporter.JSONLReporter.
+
+    Every line is a measurement in the JSON envelope, which also carries the
+    test details. The header is taken from the first measurement and the
+    entries are turned back into the same dicts the nettest produced, so that
+    they can be handed to a reporter like the ones of a YAML report.
+    """
+    _entry_keys = (
+        'input',
+        'test_start_time',
+        'measurement_start_time',
+        'test_runtime'
+    )
+
+    def __init__(self, report_filename):
+        self._fp = open(report_filename)
+        self._first = self._nextMeasurement()
+        self.header = {}
+        if self._first is not None:
+            self.header = dict((k, v) for k, v in self._first.items()
+                               if k not in ('id', 'report_id', 'test_keys',
+                                            'input', 'measurement_start_time',
+                                            'test_runtime'))
+
+    def _nextLine(self):
+        for line in self._fp:
+            if line.strip():
+                return line
+        return None
+
+    def _nextMeasurement(self):
+        line = self._nextLine()
+        if line is None:
+            return None
+        return json.loads(line)
+
+    def skip(self, count):
+        """
+        Skips the next count entries, without parsing them.
+        """
+        for _ in range(count):
+            if self._first is not None:
+                self._first = None
+            elif self._nextLine() is None:
+                break
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._first is not None:
+            measurement, self._first = self._first, None
+        else:
+            measurement = self._nextMeasurement()
+        if measurement is None:
             self.close()
             raise StopIteration
+        entry = dict(measurement['test_keys'])
+        for key in self._entry_keys:
+            entry[key] = measurement.get(key)
+        return entry
 
     def close(self):
         self._fp.close()
+
+
+def open_report(report_filename, use_index=False):
+    """
+    Returns a loader for the report, picking it based on its extension.
+    use_index only applies to YAML reports (see :class:ReportLoader).
+    """
+    if report_filename.endswith('.jsonl'):
+        return JSONLReportLoader(report_filename)
+    return ReportLoader(report_filename, use_index=use_index)
@@ -1,15 +1,14 @@
 from __future__ import print_function
-import yaml
 import sys
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from ooni import canonical_bouncer
-from ooni.reporter import OONIBReporter, OONIBReportLog
+from ooni.reporter import OONIBReporter, OONIBReportLog, create_oonib_sink
 
 from ooni.utils import log
 from ooni.report import parser
-from ooni.settings import config
 from ooni.backend_client import BouncerClient, CollectorClient
 
 @defer.inlineCallbacks
@@ -29,73 +28,265 @@ def lookup_collector_client(report_header, bouncer):
     )
     defer.returnValue(collector_client)
 
+class UploadMonitor(object):
+    """
+    Tells the upload loop when the sink of the report it is uploading has
+    room for more entries again.
+    """
+    def __init__(self):
+        self._drained = None
+
+    def sinkFull(self, sink):
+        self._drained = defer.Deferred()
+
+    def sinkDrained(self, sink):
+        drained, self._drained = self._drained, None
+        if drained is not None:
+            drained.callback(None)
+
+    def wait(self):
+        if self._drained is None:
+            return defer.succeed(None)
+        return self._drained
+
+
+class UploadCheckpoint(object):
+    """
+    Keeps track of the entries the collector has acknowledged, which may be
+    out of order when several of them are being written at the same time,
+    and records in the report log how many of the first entries have all
+    been acknowledged.
+    """
+    def __init__(self, report_log, report_file, uploaded):
+        self.report_log = report_log
+        self.report_file = report_file
+        self.uploaded = uploaded
+        self._acknowledged = set()
+
+    def acknowledged(self, offset):
+        self._acknowledged.add(offset)
+        uploaded = self.uploaded
+        while uploaded in self._acknowledged:
+            self._acknowledged.remove(uploaded)
+            uploaded += 1
+        if uploaded != self.uploaded:
+            self.uploaded = uploaded
+            return self.report_log.uploaded(self.report_file, uploaded)
+
+
+def get_collector_client(report_file, value):
+    collector_settings = value['collector']
+    if isinstance(collector_settings, dict):
+        return CollectorClient(settings=collector_settings)
+    elif isinstance(collector_settings, basestring):
+        return CollectorClient(address=collector_settings)
+    log.msg("Skipping uploading of %s since this measurement was run by "
+            "specifying no collector." % report_file)
+    return None
+
+
+@defer.inlineCallbacks
+def write_entries(report, oonib_reporter, checkpoint):
+    """
+    Writes the entries of the report through a
+    :class:ooni.reporter.ReportSink, so that, like when ooniprobe reports
+    measurements, several of them are in flight or batched up at the same
+    time. The loader is only read as fast as the collector acknowledges the
+    entries.
+    """
+    monitor = UploadMonitor()
+    sink = create_oonib_sink(oonib_reporter, monitor=monitor)
+    failures = []
+
+    def written(_, offset):
+        sys.stdout.write('.')
+        sys.stdout.flush()
+        return checkpoint.acknowledged(offset)
+
+    def failed(failure):
+        failures.append(failure)
+
+    offset = checkpoint.uploaded
+    for entry in report:
+        d = sink.write(entry)
+        d.addCallback(written, offset)
+        d.addErrback(failed)
+        offset += 1
+        yield monitor.wait()
+        if failures:
+            break
+    if oonib_reporter.batching:
+        # There is no point in waiting for more entries to fill the batch
+        oonib_reporter.flushBatch()
+    yield sink.flush()
+    if failures:
+        report.close()
+        failures[0].raiseException()
+
+
 @defer.inlineCallbacks
-def upload(report_file, collector=None, bouncer=None):
+def upload(report_file, collector=None, bouncer=None, report_log=None):
+    """
+    Uploads the report to a collector.
+
+    If the upload of the report has been interrupted before, and no
+    collector or bouncer is given, the entries that the collector has not
+    acknowledged yet are written to the report that had been created then.
+    """
+    if report_log is not None:
+        yield _upload(report_file, collector, bouncer, report_log)
+        return
     oonib_report_log = OONIBReportLog()
+    try:
+        yield _upload(report_file, collector, bouncer, oonib_report_log)
+    finally:
+        oonib_report_log.close()
+
+
+@defer.inlineCallbacks
+def _upload(report_file, collector, bouncer, oonib_report_log):
     collector_client = None
     if collector:
         collector_client = CollectorClient(address=collector)
 
     log.msg("Attempting to upload %s" % report_file)
 
-    with open(config.report_log_file) as f:
-        report_log = yaml.safe_load(f)
+    value = oonib_report_log.get(report_file)
+    resume = collector_client is None and not bouncer and \
+        value is not None and value['upload'] is not None and \
+        bool(value['report_id']) and \
+        value['status'] in ('created', 'incomplete')
+
+    # The entries that have already been uploaded are skipped through the
+    # index of the report instead of being read again.
+    report = parser.open_report(report_file, use_index=resume)
+    if not report.header:
+        log.msg("Skipping uploading of %s since it contains no "
+                "measurements." % report_file)
+        report.close()
+        defer.returnValue(None)
+
+    def close_report(failure):
+        report.close()
+        return failure
 
-    report = parser.ReportLoader(report_file)
     if bouncer and collector_client is None:
-        collector_client = yield lookup_collector_client(report.header,
-                                                         bouncer)
-
-    if collector_client is None:
-        try:
-            collector_settings = report_log[report_file]['collector']
-            if collector_settings is None:
-                log.msg("Skipping uploading of %s since this measurement "
-                        "was run by specifying no collector." %
-                        report_file)
-                defer.returnValue(None)
-            elif isinstance(collector_settings, dict):
-                collector_client = CollectorClient(settings=collector_settings)
-            elif isinstance(collector_settings, str):
-                collector_client = CollectorClient(address=collector_settings)
-        except KeyError:
-            log.msg("Could not find %s in reporting.yaml. Looking up "
-                    "collector with canonical bouncer." % report_file)
-            collector_client = yield lookup_collector_client(report.header,
-                                                             canonical_bouncer)
-
-    oonib_reporter = OONIBReporter(report.header, collector_client)
-    log.msg("Creating report for %s with %s" % (report_file,
-                                                collector_client.settings))
-    report_id = yield oonib_reporter.createReport()
-    report.header['report_id'] = report_id
-    yield oonib_report_log.created(report_file,
-                                   collector_client.settings,
-                                   report_id)
+        collector_client = yield lookup_collector_client(
+            report.header, bouncer).addErrback(close_report)
+
+    if resume:
+        collector_client = get_collector_client(report_file, value)
+        if collector_client is None:
+            report.close()
+            defer.returnValue(None)
+        oonib_reporter = OONIBReporter(report.header, collector_client)
+        oonib_reporter.resume(value['report_id'],
+                              value['upload']['supported_formats'],
+                              value['upload']['batching'])
+        report.header['report_id'] = value['report_id']
+        log.msg("Resuming report %s for %s after %d entries" % (
+            value['report_id'], report_file, value['uploaded']))
+        report.skip(value['uploaded'])
+        yield oonib_report_log.resumed(report_file)
+        checkpoint = UploadCheckpoint(oonib_report_log, report_file,
+                                      value['uploaded'])
+    else:
+        if collector_client is None:
+            if value is not None:
+                collector_client = get_collector_client(report_file, value)
+                if collector_client is None:
+                    report.close()
+                    defer.returnValue(None)
+            else:
+                log.msg("Could not find %s in the report log. Looking up "
+                        "collector with canonical bouncer." % report_file)
+                collector_client = yield lookup_collector_client(
+                    report.header, canonical_bouncer).addErrback(close_report)
+
+        oonib_reporter = OONIBReporter(report.header, collector_client)
+        log.msg("Creating report for %s with %s" % (report_file,
+                                                    collector_client.settings))
+        report_id = yield oonib_reporter.createReport().addErrback(
+            close_report)
+        report.header['report_id'] = report_id
+        yield oonib_report_log.created(report_file,
+                                       collector_client.settings,
+                                       report_id,
+                                       upload={
+                                           'supported_formats':
+                                               oonib_reporter.supportedFormats,
+                                           'batching': oonib_reporter.batching
+                                       })
+        checkpoint = UploadCheckpoint(oonib_report_log, report_file, 0)
+
     log.msg("Writing report entries")
-    for entry in report:
-        yield oonib_reporter.writeReportEntry(entry)
-        sys.stdout.write('.')
-        sys.stdout.flush()
+    try:
+        yield write_entries(report, oonib_reporter, checkpoint)
+    except Exception:
+        failure = Failure()
+        log.err("Failed to upload %s after %d entries" % (
+            report_file, checkpoint.uploaded))
+        yield oonib_report_log.incomplete(report_file)
+        failure.raiseException()
     log.msg("Closing report")
     yield oonib_reporter.finish()
     yield oonib_report_log.closed(report_file)
 
 
 @defer.inlineCallbacks
-def upload_all(collector=None, bouncer=None):
-    oonib_report_log = OONIBReportLog()
+def upload_all(collector=None, bouncer=None, concurrency=4,
+               report_log=None):
+    """
+    Uploads the reports that could not be created and the ones whose upload
+    has been interrupted, concurrency of them at the same time.
+    """
+    oonib_report_log = report_log or OONIBReportLog()
+    semaphore = defer.DeferredSemaphore(concurrency)
 
-    for report_file, value in oonib_report_log.reports_to_upload:
-        try:
-            yield upload(report_file, collector, bouncer)
-        except Exception as exc:
-            log.exception(exc)
+    def upload_report(report_file):
+        d = upload(report_file, collector, bouncer,
+                   report_log=oonib_report_log)
+        d.addErrback(lambda failure: log.exception(failure))
+        return d
+
+    try:
+        report_files = [report_file for report_file, value in
+                        oonib_report_log.reports_to_resume +
+                        oonib_report_log.reports_to_upload]
+        yield defer.gatherResults([semaphore.run(upload_report, report_file)
+                                   for report_file in report_files])
+    finally:
+        if report_log is None:
+            oonib_report_log.close()
+
+
+def count_entries(report_file):
+    """
+    Returns the number of entries of report_file, using its index, or None
+    if it can not be known without reading the whole report.
+    """
+    try:
+        report = parser.open_report(report_file, use_index=True)
+    except IOError:
+        return None
+    try:
+        return len(report)
+    except TypeError:
+        return None
+    finally:
+        report.close()
 
 
 def print_report(report_file, value):
     print("* %s" % report_file)
     print("  %s" % value['created_at'])
+    entries = count_entries(report_file)
+    if entries is None:
+        return
+    if value['uploaded'] is not None:
+        print("  %d of %d entries uploaded" % (value['uploaded'], entries))
+    else:
+        print("  %d entries" % entries)
 
 
 def status():
@@ -115,3 +306,5 @@ def status():
     print("------------------")
     for report_file, value in oonib_report_log.reports_incomplete:
         print_report(report_file, value)
+
+    oonib_report_log.close()
@@ -1,8 +1,12 @@
+import sys
 import uuid
 import yaml
+import json
 import os
+import sqlite3
 
-from copy import deepcopy
+from base64 import b64encode
+from collections import deque
 
 from datetime import datetime
 from contextlib import contextmanager
@@ -11,20 +15,17 @@ from yaml.representer import SafeRepresenter
 from yaml.emitter import Emitter
 from yaml.serializer import Serializer
 from yaml.resolver import Resolver
+try:
+    from yaml.cyaml import CEmitter
+except ImportError:
+    CEmitter = None
 
 from twisted.python.util import untilConcludes
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.internet.error import ConnectionRefusedError
 
 from ooni.utils import log
 from ooni.tasks import Measurement
-try:
-    from scapy.packet import Packet
-except ImportError:
-    log.err("Scapy is not installed.")
-
-    class Packet(object):
-        pass
 
 from ooni import errors
 
@@ -33,8 +34,6 @@ from ooni.utils import generate_filename
 
 from ooni.settings import config
 
-from ooni.tasks import ReportEntry
-
 
 def createPacketReport(packet_list):
     """
@@ -50,6 +49,15 @@ def createPacketReport(packet_list):
     return report
 
 
+def isPacket(data):
+    """
+    Whether data is a scapy packet. Scapy is only imported by the tests that
+    need it, so if it has not been loaded there can not be any packet.
+    """
+    scapy_packet = sys.modules.get('scapy.packet')
+    return scapy_packet is not None and isinstance(data, scapy_packet.Packet)
+
+
 class OSafeRepresenter(SafeRepresenter):
 
     """
@@ -68,7 +76,7 @@ class OSafeRepresenter(SafeRepresenter):
         base of class of a Scapy packet.
         XXX fully debug this problem
         """
-        if isinstance(data, Packet):
+        if isPacket(data):
             data = createPacketReport(data)
         return SafeRepresenter.represent_data(self, data)
 
@@ -81,7 +89,10 @@ class OSafeRepresenter(SafeRepresenter):
             data = u'%r+%rj' % (data.real, data.imag)
         else:
             data = u'%r%rj' % (data.real, data.imag)
-        return self.represent_scalar(u'tag:yaml.org,2002:python/complex', data)
+        # The style is explicit so that libyaml quotes the value like the
+        # pure python emitter does instead of emitting a tagged plain scalar.
+        return self.represent_scalar(u'tag:yaml.org,2002:python/complex',
+                                     data, style="'")
 
 OSafeRepresenter.add_representer(complex,
                                  OSafeRepresenter.represent_complex)
@@ -113,11 +124,100 @@ class OSafeDumper(Emitter, Serializer, OSafeRepresenter, Resolver):
         Resolver.__init__(self)
 
 
+if CEmitter is not None:
+    class OCSafeDumper(CEmitter, OSafeRepresenter, Resolver):
+
+        """
+        This is the same as OSafeDumper, but the emitting is done by libyaml.
+
+        The output is the same as the one of OSafeDumper, except that long
+        double quoted scalars are folded on spaces instead of escaped line
+        breaks, which loads back to the same value.
+        """
+
+        def __init__(self, stream,
+                     default_style=None, default_flow_style=None,
+                     canonical=None, indent=None, width=None,
+                     allow_unicode=None, line_break=None,
+                     encoding=None, explicit_start=None, explicit_end=None,
+                     version=None, tags=None):
+
+            CEmitter.__init__(self, stream, canonical=canonical,
+                              indent=indent, width=width, encoding=encoding,
+                              allow_unicode=allow_unicode,
+                              line_break=line_break,
+                              explicit_start=explicit_start,
+                              explicit_end=explicit_end,
+                              version=version, tags=tags)
+            OSafeRepresenter.__init__(self, default_style=default_style,
+                                      default_flow_style=default_flow_style)
+            Resolver.__init__(self)
+
+    DefaultDumper = OCSafeDumper
+else:
+    OCSafeDumper = None
+    DefaultDumper = OSafeDumper
+
+
 def safe_dump(data, stream=None, **kw):
     """
     Safely dump to a yaml file the specified data.
+
+    This uses libyaml when it is available and falls back to the pure python
+    OSafeDumper otherwise.
+    """
+    return yaml.dump_all([data], stream, Dumper=DefaultDumper, **kw)
+
+
+def json_safe(data):
+    """
+    Returns a copy of data that can be serialised to JSON. Byte strings that
+    are not valid UTF-8 are base64 encoded, like the HTTP bodies, and scapy
+    packets are represented like in the YAML reports.
+    """
+    if isPacket(data):
+        data = createPacketReport(data)
+    if isinstance(data, str):
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'format': 'base64', 'data': b64encode(data)}
+    if isinstance(data, dict):
+        safe_data = {}
+        for key, value in data.items():
+            if isinstance(key, str):
+                key = key.decode('utf-8', 'replace')
+            safe_data[key] = json_safe(value)
+        return safe_data
+    if isinstance(data, (list, tuple)):
+        return [json_safe(item) for item in data]
+    return data
+
+
+def json_envelope(entry, test_details):
+    """
+    Wraps a measurement in the envelope of the JSON data format, with the keys
+    that are common to every measurement at the top level and the ones that
+    are specific to the test in test_keys.
     """
-    return yaml.dump_all([data], stream, Dumper=OSafeDumper, **kw)
+    if isinstance(entry, Measurement):
+        entry = entry.testInstance.report
+    if not isinstance(entry, dict):
+        raise Exception("Failed to serialise entry")
+    # We make a shallow copy so that the other reporters still get to see the
+    # keys we pop.
+    entry = dict(entry)
+    report_entry = {
+        'input': entry.pop('input', None),
+        'id': str(uuid.uuid4()),
+        'test_start_time': entry.pop('test_start_time', None),
+        'measurement_start_time': entry.pop('measurement_start_time', None),
+        'test_runtime': entry.pop('test_runtime', None),
+        'test_keys': entry
+    }
+    report_entry = json_safe(report_entry)
+    report_entry.update(test_details)
+    return report_entry
 
 
 class OReporter(object):
@@ -141,20 +241,45 @@ class OReporter(object):
         pass
 
 
-class YAMLReporter(OReporter):
+class FileReporter(OReporter):
 
     """
-    These are useful functions for reporting to YAML format.
+    The base class of the reporters that write the report to a local file.
+
+    By default every entry is flushed to the report file as soon as it is
+    written. When flushSize or flushInterval are set, entries are instead
+    accumulated in memory and committed to the file together once flushSize
+    bytes are buffered or flushInterval seconds after the first buffered
+    entry, whichever comes first, and always at finish(). When fsync is set
+    every commit is also synced to disk.
+    """
+    extension = None
 
-    report_destination:
-        the destination directory of the report
+    flushSize = 0
+    flushInterval = 0
+    fsync = False
 
-    """
+    # So that we can test the callLater calls
+    clock = reactor
 
     def __init__(self, test_details, report_filename):
         self.report_path = report_filename
+        self._stream = None
+        self._buffer = []
+        self._buffered = 0
+        self._flushTimer = None
+        if config.advanced.report_flush_size is not None:
+            self.flushSize = config.advanced.report_flush_size
+        if config.advanced.report_flush_interval is not None:
+            self.flushInterval = config.advanced.report_flush_interval
+        if config.advanced.report_fsync is not None:
+            self.fsync = config.advanced.report_fsync
         OReporter.__init__(self, test_details)
 
+    @property
+    def buffering(self):
+        return self.flushSize > 0 or self.flushInterval > 0
+
     def _writeln(self, line):
         self._write("%s\n" % line)
 
@@ -166,30 +291,70 @@ class YAMLReporter(OReporter):
         s = str(format_string)
         assert isinstance(s, type(''))
         if args:
-            self._stream.write(s % args)
-        else:
-            self._stream.write(s)
+            s = s % args
+        self._buffer.append(s)
+        self._buffered += len(s)
+        if not self.buffering or \
+                (self.flushSize > 0 and self._buffered >= self.flushSize):
+            self.flush()
+        elif self.flushInterval > 0 and self._flushTimer is None:
+            self._flushTimer = self.clock.callLater(self.flushInterval,
+                                                    self.flush)
+
+    def flush(self):
+        """
+        Commits all the buffered entries to the report file.
+        """
+        if self._flushTimer is not None:
+            if self._flushTimer.active():
+                self._flushTimer.cancel()
+            self._flushTimer = None
+        if not self._buffer or self._stream is None or self._stream.closed:
+            return
+        self._stream.write(''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
         untilConcludes(self._stream.flush)
+        if self.fsync:
+            untilConcludes(os.fsync, self._stream.fileno())
+
+    def createReport(self):
+        log.debug("Creating %s" % self.report_path)
+        self._stream = open(self.report_path, 'w+')
+
+    def finish(self):
+        self.flush()
+        self._stream.close()
+
+
+class YAMLReporter(FileReporter):
+
+    """
+    These are useful functions for reporting to YAML format.
+
+    report_destination:
+        the destination directory of the report
+
+    """
+    extension = 'yamloo'
 
     def writeReportEntry(self, entry):
         log.debug("Writing report with YAML reporter")
-        content = '---\n'
+        # The entry is only read while it is serialised, so there is no need
+        # to copy it first.
         if isinstance(entry, Measurement):
-            report_entry = deepcopy(entry.testInstance.report)
+            report_entry = entry.testInstance.report
         elif isinstance(entry, dict):
-            report_entry = deepcopy(entry)
+            report_entry = entry
         else:
             raise Exception("Failed to serialise entry")
-        content += safe_dump(report_entry)
-        content += '...\n'
-        self._write(content)
+        self._write('---\n' + safe_dump(report_entry) + '...\n')
 
     def createReport(self):
         """
         Writes the report header and fire callbacks on self.created
         """
-        log.debug("Creating %s" % self.report_path)
-        self._stream = open(self.report_path, 'w+')
+        FileReporter.createReport(self)
 
         self._writeln("###########################################")
 
@@ -203,43 +368,68 @@ class YAMLReporter(OReporter):
 
         self.writeReportEntry(self.testDetails)
 
-    def finish(self):
-        self._stream.close()
+
+class JSONLReporter(FileReporter):
+
+    """
+    Writes the report in the JSON Lines format: every line of the report file
+    is a measurement in the same JSON envelope that is sent to the collector,
+    which also carries the test details. As a consequence there is no separate
+    header.
+    """
+    extension = 'jsonl'
+
+    def writeReportEntry(self, entry):
+        log.debug("Writing report with JSONL reporter")
+        self._write(json.dumps(json_envelope(entry, self.testDetails)) + '\n')
+
+
+# The formats in which we can write the report to a local file
+file_reporters = {
+    'yaml': YAMLReporter,
+    'jsonl': JSONLReporter
+}
 
 
 class OONIBReporter(OReporter):
+    """
+    Reports to an oonib collector.
+
+    If the collector advertises batch_upload support when the report is
+    created, entries are not sent one at a time, but are accumulated and sent
+    in a single request once they reach batchSize bytes or batchInterval
+    seconds after the first entry of the batch was written. Batches are sent
+    one after the other so that the order of the entries is preserved.
+    """
+    batchSize = 1024 * 1024
+    batchInterval = 5
+
+    # So that we can test the callLater calls
+    clock = reactor
 
     def __init__(self, test_details, collector_client):
         self.collector_client = collector_client
 
         self.reportId = None
         self.supportedFormats = ["yaml"]
+        self.batching = False
+
+        if config.advanced.reporting_batch_size is not None:
+            self.batchSize = config.advanced.reporting_batch_size
+        if config.advanced.reporting_batch_interval is not None:
+            self.batchInterval = config.advanced.reporting_batch_interval
+
+        self._batch = []
+        self._batchBytes = 0
+        self._batchTimer = None
+        self._pendingBatches = deque()
+        self._sendingBatch = False
+        self._batchesSent = None
         OReporter.__init__(self, test_details)
 
     def serializeEntry(self, entry, serialisation_format="yaml"):
         if serialisation_format == "json":
-            if isinstance(entry, Measurement):
-                report_entry = {
-                    'input': entry.testInstance.report.pop('input', None),
-                    'id': str(uuid.uuid4()),
-                    'test_start_time': entry.testInstance.report.pop('test_start_time', None),
-                    'measurement_start_time': entry.testInstance.report.pop('measurement_start_time', None),
-                    'test_runtime': entry.testInstance.report.pop('test_runtime', None),
-                    'test_keys': entry.testInstance.report
-                }
-            elif isinstance(entry, dict):
-                report_entry = {
-                    'input': entry.pop('input', None),
-                    'id': str(uuid.uuid4()),
-                    'test_start_time': entry.pop('test_start_time', None),
-                    'measurement_start_time': entry.pop('measurement_start_time', None),
-                    'test_runtime': entry.pop('test_runtime', None),
-                    'test_keys': entry
-                }
-            else:
-                raise Exception("Failed to serialise entry")
-            report_entry.update(self.testDetails)
-            return report_entry
+            return json_envelope(entry, self.testDetails)
         else:
             content = '---\n'
             if isinstance(entry, Measurement):
@@ -259,8 +449,12 @@ class OONIBReporter(OReporter):
         else:
             serialization_format = 'yaml'
 
-        log.debug("Updating report with id %s" % (self.reportId))
         entry_content = self.serializeEntry(entry, serialization_format)
+        if self.batching:
+            yield self._addToBatch(json.dumps(entry_content))
+            return
+
+        log.debug("Updating report with id %s" % (self.reportId))
         try:
             yield self.collector_client.updateReport(self.reportId,
                                                      serialization_format,
@@ -270,11 +464,83 @@ class OONIBReporter(OReporter):
             log.exception(exc)
             raise errors.OONIBReportUpdateError
 
+    def _addToBatch(self, serialized_entry):
+        d = defer.Deferred()
+        self._batch.append((serialized_entry, d))
+        self._batchBytes += len(serialized_entry)
+        if self._batchBytes >= self.batchSize:
+            self.flushBatch()
+        elif self._batchTimer is None:
+            self._batchTimer = self.clock.callLater(self.batchInterval,
+                                                    self.flushBatch)
+        return d
+
+    def flushBatch(self):
+        """
+        Sends the entries that have been accumulated so far.
+
+        Returns:
+            a deferred that fires once all the batches queued up to now have
+            been sent.
+        """
+        if self._batchTimer is not None:
+            if self._batchTimer.active():
+                self._batchTimer.cancel()
+            self._batchTimer = None
+        if self._batch:
+            self._pendingBatches.append(self._batch)
+            self._batch = []
+            self._batchBytes = 0
+        if self._batchesSent is None:
+            self._batchesSent = defer.Deferred()
+        batches_sent = self._batchesSent
+        self._sendNextBatch()
+        return batches_sent
+
+    def _sendNextBatch(self):
+        if self._sendingBatch:
+            return
+        if not self._pendingBatches:
+            if self._batchesSent is not None:
+                batches_sent, self._batchesSent = self._batchesSent, None
+                batches_sent.callback(None)
+            return
+
+        batch = self._pendingBatches.popleft()
+        self._sendingBatch = True
+        log.debug("Updating report with id %s with %d entries" %
+                  (self.reportId, len(batch)))
+        d = self.collector_client.updateReportBatch(
+            self.reportId, [entry for entry, _ in batch])
+
+        # The deferreds of the entries may have been cancelled in the
+        # meantime (for example by the timeout of a ReportSink).
+        @d.addCallback
+        def cb(_):
+            for _, entry_written in batch:
+                if not entry_written.called:
+                    entry_written.callback(None)
+
+        @d.addErrback
+        def eb(failure):
+            log.err("Error in writing %d report entries" % len(batch))
+            log.exception(failure)
+            for _, entry_written in batch:
+                if not entry_written.called:
+                    entry_written.errback(errors.OONIBReportUpdateError())
+
+        @d.addBoth
+        def next_batch(_):
+            self._sendingBatch = False
+            self._sendNextBatch()
+
     @defer.inlineCallbacks
     def createReport(self):
         """
         Creates a report on the oonib collector.
         """
+        from txsocksx.errors import HostUnreachable
+
         log.msg("Creating report with OONIB Reporter. Please be patient.")
         log.msg("This may take up to 1-2 minutes...")
 
@@ -286,7 +552,7 @@ class OONIBReporter(OReporter):
             log.err("Connection to reporting backend failed "
                     "(ConnectionRefusedError)")
             raise errors.OONIBReportCreationError
-        except errors.HostUnreachable:
+        except HostUnreachable:
             log.err("Host is not reachable (HostUnreachable error")
             raise errors.OONIBReportCreationError
         except (errors.OONIBInvalidInputHash,
@@ -305,175 +571,512 @@ class OONIBReporter(OReporter):
         self.backendVersion = response['backend_version']
 
         self.supportedFormats = response.get('supported_formats', ["yaml"])
+        self.batching = bool(response.get('batch_upload', False)) and \
+            "json" in self.supportedFormats and self.batchSize > 0
 
         log.debug("Created report with id %s" % response['report_id'])
         defer.returnValue(response['report_id'])
 
+    def resume(self, report_id, supported_formats, batching):
+        """
+        Continues writing entries to a report that has been created before,
+        in the same way as they were being written then, as told by the
+        supportedFormats and batching attributes the reporter had.
+        """
+        self.reportId = report_id
+        self.supportedFormats = supported_formats
+        self.batching = batching
+
     def finish(self):
         log.debug("Closing report with id %s" % self.reportId)
-        return self.collector_client.closeReport(self.reportId)
+        if not self.batching:
+            return self.collector_client.closeReport(self.reportId)
+        d = self.flushBatch()
+        d.addCallback(lambda _:
+                      self.collector_client.closeReport(self.reportId))
+        return d
 
 class OONIBReportLog(object):
 
     """
     Used to keep track of report creation on a collector backend.
+
+    The status of every report is a row of an SQLite database, indexed by
+    status, so that updating it or listing the reports in a given status
+    does not depend on how many reports there are. The database is in WAL
+    mode, which lets ooniprobe and oonireport use it at the same time.
+
+    Writes only wait busyTimeout seconds for another process to release the
+    database. If it is still locked they are retried later with run, so
+    that the reactor is not blocked, for up to lockTimeout seconds.
+
+    The report log used to be a YAML file. If one is found, either at
+    file_name or next to it as reporting.yml, it is renamed with a .migrated
+    suffix and its reports are imported.
+
+    The reports uploaded by oonireport also have an upload field, with how
+    they are being written to the collector, and an uploaded one, with how
+    many of their entries the collector has acknowledged, so that their
+    upload can be resumed.
     """
 
+    fields = ('status', 'pid', 'created_at', 'collector', 'report_id',
+              'upload', 'uploaded')
+
+    busyTimeout = 0.1
+    # Creating the tables only happens once, so it can wait a bit longer.
+    setupTimeout = 5
+    retryDelay = 0.1
+    maxRetryDelay = 2
+    lockTimeout = 30
+
+    # So that we can test the callLater calls
+    clock = reactor
+
     def __init__(self, file_name=None):
         if file_name is None:
             file_name = config.report_log_file
         self.file_name = file_name
+        self._db = None
+        self._lock = defer.DeferredLock()
         self.create_report_log()
 
+    def _legacy_file_names(self):
+        """
+        The YAML report logs to import: file_name itself, if it is one, and
+        reporting.yml in the same directory.
+        """
+        legacy_file_names = []
+        if os.path.exists(self.file_name):
+            with open(self.file_name, 'rb') as f:
+                header = f.read(16)
+            if header and header != 'SQLite format 3\0':
+                legacy_file_names.append(self.file_name)
+        default_file_name = os.path.join(os.path.dirname(self.file_name),
+                                         'reporting.yml')
+        if default_file_name != self.file_name and \
+                os.path.exists(default_file_name):
+            legacy_file_names.append(default_file_name)
+        return legacy_file_names
+
+    def create_report_log(self):
+        if self._db is not None:
+            return
+        legacy_reports = {}
+        for legacy_file_name in self._legacy_file_names():
+            migrated_file_name = legacy_file_name + '.migrated'
+            log.msg("Moving the reports of %s to %s and renaming it to %s" % (
+                legacy_file_name, self.file_name, migrated_file_name))
+            # The file is renamed before it is read, so that when two
+            # processes start at the same time only one of them imports it.
+            try:
+                os.rename(legacy_file_name, migrated_file_name)
+            except OSError as exc:
+                log.msg("Could not rename %s, skipping it: %s" % (
+                    legacy_file_name, exc))
+                continue
+            with open(migrated_file_name) as f:
+                legacy_reports.update(yaml.safe_load(f) or {})
+
+        self._db = sqlite3.connect(
+            self.file_name, timeout=self.setupTimeout, isolation_level=None,
+            detect_types=sqlite3.PARSE_DECLTYPES)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS reports ("
+                         "report_file TEXT PRIMARY KEY, "
+                         "status TEXT NOT NULL, "
+                         "pid INTEGER, "
+                         "created_at TIMESTAMP, "
+                         "collector TEXT, "
+                         "report_id TEXT, "
+                         "upload TEXT, "
+                         "uploaded INTEGER)")
+        columns = [row[1] for row in
+                   self._db.execute("PRAGMA table_info(reports)")]
+        for column, column_type in (('upload', 'TEXT'),
+                                    ('uploaded', 'INTEGER')):
+            if column not in columns:
+                self._db.execute("ALTER TABLE reports ADD COLUMN %s %s" % (
+                    column, column_type))
+        self._db.execute("CREATE INDEX IF NOT EXISTS reports_status "
+                         "ON reports (status)")
+
+        if legacy_reports:
+            with self._transaction():
+                for report_file, value in legacy_reports.items():
+                    self._set(report_file, value['status'],
+                              value.get('collector'), value.get('report_id'),
+                              pid=value.get('pid'),
+                              created_at=value.get('created_at'))
+
+        self._db.execute("PRAGMA busy_timeout = %d" %
+                         (self.busyTimeout * 1000))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _value(self, row):
+        value = dict(zip(self.fields, row))
+        value['collector'] = json.loads(value['collector'])
+        if value['upload'] is not None:
+            value['upload'] = json.loads(value['upload'])
+        return value
+
+    def _select(self, statuses):
+        cursor = self._db.execute(
+            "SELECT report_file, %s FROM reports WHERE status IN (%s)" % (
+                ', '.join(self.fields), ', '.join('?' * len(statuses))),
+            statuses)
+        return [(row[0], self._value(row[1:])) for row in cursor]
+
+    def get(self, report_file):
+        """
+        Returns the status of report_file or None if it is not in the log.
+        """
+        row = self._db.execute(
+            "SELECT %s FROM reports WHERE report_file = ?" %
+            ', '.join(self.fields), (report_file,)).fetchone()
+        if row is None:
+            return None
+        return self._value(row)
+
     def get_report_log(self):
-        with open(self.file_name) as f:
-            report_log = yaml.safe_load(f)
-        if not report_log:
-            report_log = {}  # consumers expect dictionary structure
-        return report_log
+        return dict(self._select(('not-created', 'created', 'creation-failed',
+                                  'incomplete')))
+
+    @staticmethod
+    def _running(pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except:
+            return False
 
     @property
     def reports_incomplete(self):
-        reports = []
-        report_log = self.get_report_log()
-        for report_file, value in report_log.items():
-            if value['status'] in ('created'):
-                try:
-                    os.kill(value['pid'], 0)
-                except:
-                    reports.append((report_file, value))
-            elif value['status'] in ('incomplete'):
-                reports.append((report_file, value))
-        return reports
+        return [(report_file, value)
+                for report_file, value in self._select(('created',
+                                                        'incomplete'))
+                if value['status'] == 'incomplete' or
+                not self._running(value['pid'])]
 
     @property
     def reports_in_progress(self):
-        reports = []
-        report_log = self.get_report_log()
-        for report_file, value in report_log.items():
-            if value['status'] in ('created'):
-                try:
-                    os.kill(value['pid'], 0)
-                    reports.append((report_file, value))
-                except:
-                    pass
-        return reports
+        return [(report_file, value)
+                for report_file, value in self._select(('created',))
+                if self._running(value['pid'])]
 
     @property
     def reports_to_upload(self):
-        reports = []
-        report_log = self.get_report_log()
-        for report_file, value in report_log.items():
-            if value['status'] in ('creation-failed', 'not-created'):
-                reports.append((report_file, value))
-        return reports
-
-    def run(self, f, *arg, **kw):
-        lock = defer.DeferredFilesystemLock(self.file_name + '.lock')
-        d = lock.deferUntilLocked()
-
-        def unlockAndReturn(r):
-            lock.unlock()
-            return r
+        return self._select(('creation-failed', 'not-created'))
 
-        def execute(_):
+    @property
+    def reports_to_resume(self):
+        """
+        The reports whose upload by oonireport has been interrupted.
+        """
+        return [(report_file, value)
+                for report_file, value in self._select(('created',
+                                                        'incomplete'))
+                if value['upload'] is not None and
+                (value['status'] == 'incomplete' or
+                 not self._running(value['pid']))]
+
+    @staticmethod
+    def _locked(failure):
+        return failure.check(sqlite3.OperationalError) and \
+            'locked' in str(failure.value)
+
+    def _run(self, f, *arg, **kw):
+        deadline = self.clock.seconds() + self.lockTimeout
+
+        def attempt(delay):
             d = defer.maybeDeferred(f, *arg, **kw)
-            d.addBoth(unlockAndReturn)
-            return d
 
-        d.addCallback(execute)
-        return d
-
-    def create_report_log(self):
-        if not os.path.exists(self.file_name):
-            with open(self.file_name, 'w+') as f:
-                f.write(yaml.safe_dump({}))
+            @d.addErrback
+            def eb(failure):
+                if not self._locked(failure) or \
+                        self.clock.seconds() + delay > deadline:
+                    return failure
+                log.debug("%s is locked, retrying in %s seconds" % (
+                    self.file_name, delay))
+                return task.deferLater(self.clock, delay, attempt,
+                                       min(delay * 2, self.maxRetryDelay))
+            return d
+        return attempt(self.retryDelay)
 
-    @contextmanager
-    def edit_log(self):
-        with open(self.file_name) as rfp:
-            report = yaml.safe_load(rfp)
-        # This should never happen.
-        if report is None:
-            report = {}
-        with open(self.file_name, 'w+') as wfp:
-            try:
-                yield report
-            finally:
-                wfp.write(yaml.safe_dump(report))
+    def run(self, f, *arg, **kw):
+        """
+        Calls f, retrying it while the database is locked by another
+        process. The calls are made one at a time, in order, so that a
+        retried write is not overtaken by the following ones.
+        """
+        return self._lock.run(self._run, f, *arg, **kw)
+
+    def _set(self, report_file, status, collector_settings, report_id=None,
+             pid=None, created_at=None, upload=None):
+        assert report_file is not None
+        uploaded = None
+        if upload is not None:
+            upload, uploaded = json.dumps(upload), 0
+        self._db.execute(
+            "INSERT OR REPLACE INTO reports (report_file, %s) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ', '.join(self.fields),
+            (report_file, status, pid or os.getpid(),
+             created_at or datetime.now(), json.dumps(collector_settings),
+             report_id, upload, uploaded))
 
     def _not_created(self, report_file):
-        with self.edit_log() as report:
-            report[report_file] = {
-                'pid': os.getpid(),
-                'created_at': datetime.now(),
-                'status': 'not-created',
-                'collector': None
-            }
+        self._set(report_file, 'not-created', None)
 
     def not_created(self, report_file):
         return self.run(self._not_created, report_file)
 
-    def _created(self, report_file, collector_settings, report_id):
-        with self.edit_log() as report:
-            assert report_file is not None
-            report[report_file] = {
-                'pid': os.getpid(),
-                'created_at': datetime.now(),
-                'status': 'created',
-                'collector': collector_settings,
-                'report_id': report_id
-            }
+    def _created(self, report_file, collector_settings, report_id,
+                 upload=None):
+        self._set(report_file, 'created', collector_settings, report_id,
+                  upload=upload)
         return report_id
 
-    def created(self, report_file, collector_settings, report_id):
+    def created(self, report_file, collector_settings, report_id,
+                upload=None):
         return self.run(self._created, report_file,
-                        collector_settings, report_id)
+                        collector_settings, report_id, upload)
+
+    def _resumed(self, report_file):
+        self._db.execute(
+            "UPDATE reports SET status = 'created', pid = ? "
+            "WHERE report_file = ?", (os.getpid(), report_file))
+
+    def resumed(self, report_file):
+        return self.run(self._resumed, report_file)
+
+    def _uploaded(self, report_file, count):
+        self._db.execute("UPDATE reports SET uploaded = ? "
+                         "WHERE report_file = ?", (count, report_file))
+
+    def uploaded(self, report_file, count):
+        """
+        Records that the collector has acknowledged the first count entries
+        of report_file.
+        """
+        return self.run(self._uploaded, report_file, count)
 
     def _creation_failed(self, report_file, collector_settings):
-        with self.edit_log() as report:
-            report[report_file] = {
-                'pid': os.getpid(),
-                'created_at': datetime.now(),
-                'status': 'creation-failed',
-                'collector': collector_settings
-            }
+        self._set(report_file, 'creation-failed', collector_settings)
 
     def creation_failed(self, report_file, collector_settings):
         return self.run(self._creation_failed, report_file,
                         collector_settings)
 
     def _incomplete(self, report_file):
-        with self.edit_log() as report:
-            if report[report_file]['status'] != "created":
-                raise errors.ReportNotCreated()
-            report[report_file]['status'] = 'incomplete'
+        cursor = self._db.execute(
+            "UPDATE reports SET status = 'incomplete' "
+            "WHERE report_file = ? AND status IN ('created', 'incomplete')",
+            (report_file,))
+        if cursor.rowcount == 0:
+            raise errors.ReportNotCreated()
 
     def incomplete(self, report_file):
         return self.run(self._incomplete, report_file)
 
     def _closed(self, report_file):
-        with self.edit_log() as report:
-            rs = report[report_file]['status']
-            if  rs != "created" and rs != "incomplete":
-                raise errors.ReportNotCreated()
-            del report[report_file]
+        cursor = self._db.execute(
+            "DELETE FROM reports WHERE report_file = ? AND "
+            "status IN ('created', 'incomplete')", (report_file,))
+        if cursor.rowcount == 0:
+            raise errors.ReportNotCreated()
 
     def closed(self, report_file):
         return self.run(self._closed, report_file)
 
 
+class ReportSink(object):
+    """
+    Writes report entries to a single reporter.
+
+    Entries are put on a queue and handed to the reporter in the order they
+    were written, with at most maxInFlight writes outstanding at any time. A
+    failed write is retried up to `retries` times and is given up on if it
+    takes longer than `timeout` seconds.
+
+    Once more than maxPending entries are queued or being written the sink is
+    considered full and the monitor (a
+    :class:ooni.managers.ReportEntryManager) is told so, in order to stop
+    scheduling new measurements until the sink has drained. on_full, if
+    given, is called at the same time, for reporters that hold entries back
+    until they are asked to send them.
+    """
+    maxPending = 100
+
+    # So that we can test the callLater calls
+    clock = reactor
+
+    def __init__(self, reporter, max_in_flight=1, retries=0, timeout=None,
+                 monitor=None, on_full=None):
+        self.reporter = reporter
+        self.maxInFlight = max_in_flight
+        self.retries = retries
+        self.timeout = timeout
+        self.monitor = monitor
+        self.onFull = on_full
+
+        if config.advanced.reporting_queue_size:
+            self.maxPending = config.advanced.reporting_queue_size
+
+        self._queue = deque()
+        self._inFlight = 0
+        self._draining = False
+        self._isFull = False
+        self._flushed = []
+
+    def __repr__(self):
+        return "<ReportSink %s pending=%d>" % (self.reporter.__class__.__name__,
+                                               self.pending)
+
+    @property
+    def pending(self):
+        return len(self._queue) + self._inFlight
+
+    @property
+    def full(self):
+        return self.pending >= self.maxPending
+
+    def write(self, entry):
+        """
+        Queues entry to be written.
+
+        Returns:
+            a deferred that fires once the entry has been written or errbacks
+            if all the attempts to write it have failed.
+        """
+        d = defer.Deferred()
+        self._queue.append((entry, d))
+        self._drain()
+        if not self._isFull and self.full:
+            self._isFull = True
+            if self.monitor:
+                self.monitor.sinkFull(self)
+            if self.onFull:
+                self.onFull()
+        return d
+
+    def flush(self):
+        """
+        Returns a deferred that fires once all the queued entries have been
+        written.
+        """
+        if self.pending == 0:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._flushed.append(d)
+        return d
+
+    def _drain(self):
+        # Reporters that write synchronously will call us again from within
+        # the loop, by not re-entering we keep the stack from growing.
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self._queue and self._inFlight < self.maxInFlight:
+                entry, d = self._queue.popleft()
+                self._inFlight += 1
+                self._writeEntry(entry, d, 0)
+        finally:
+            self._draining = False
+
+    def _writeEntry(self, entry, d, attempt):
+        written = defer.maybeDeferred(self.reporter.writeReportEntry, entry)
+        if self.timeout and not written.called:
+            timer = self.clock.callLater(self.timeout, written.cancel)
+
+            def cancel_timer(result):
+                if timer.active():
+                    timer.cancel()
+                return result
+            written.addBoth(cancel_timer)
+        written.addCallbacks(self._written, self._writeFailed,
+                             callbackArgs=(d,),
+                             errbackArgs=(entry, d, attempt))
+
+    def _written(self, _, d):
+        self._inFlight -= 1
+        d.callback(None)
+        self._entryDone()
+
+    def _writeFailed(self, failure, entry, d, attempt):
+        if attempt < self.retries:
+            log.debug("Failed to write report entry, retrying")
+            self._writeEntry(entry, d, attempt + 1)
+            return
+        self._inFlight -= 1
+        d.errback(failure)
+        self._entryDone()
+
+    def _entryDone(self):
+        if self._isFull and not self.full:
+            self._isFull = False
+            if self.monitor:
+                self.monitor.sinkDrained(self)
+        if self.pending == 0:
+            flushed, self._flushed = self._flushed, []
+            for d in flushed:
+                d.callback(None)
+        self._drain()
+
+
+def create_oonib_sink(oonib_reporter, monitor=None):
+    """
+    Returns a :class:ReportSink for an OONIBReporter whose report has been
+    created, configured from the reporting_* advanced options.
+    """
+    if oonib_reporter.batching:
+        # The reporter keeps the entries in order while it batches them
+        # up, so we hand them over as soon as we can. An entry that is
+        # retried or cancelled would still be in its batch and would reach
+        # the collector twice and out of order, so a failed batch fails all
+        # of its entries instead. The entries stay in flight until their
+        # batch is sent, so once the sink is full the batch is sent right
+        # away instead of stalling the measurements until batchInterval.
+        return ReportSink(oonib_reporter,
+                          max_in_flight=(config.advanced.reporting_queue_size
+                                         or ReportSink.maxPending),
+                          monitor=monitor,
+                          on_full=oonib_reporter.flushBatch)
+    return ReportSink(oonib_reporter,
+                      max_in_flight=config.advanced.reporting_concurrency or 1,
+                      retries=config.advanced.reporting_retries or 0,
+                      timeout=config.advanced.reporting_timeout,
+                      monitor=monitor)
+
+
 class Report(object):
     reportId = None
 
     def __init__(self, test_details, report_filename,
                  reportEntryManager, collector_client=None,
-                 no_yamloo=False):
+                 no_yamloo=False, report_format='yaml'):
         """
         This is an abstraction layer on top of all the configured reporters.
 
         It allows to lazily write to the reporters that are to be used.
 
+        Every reporter is fed by its own :class:ooni.reporter.ReportSink.
+
         Args:
 
             test_details:
@@ -483,33 +1086,47 @@ class Report(object):
                 The file path for the report to be written.
 
             reportEntryManager:
-                an instance of :class:ooni.tasks.ReportEntryManager
+                an instance of :class:ooni.managers.ReportEntryManager that
+                is told when the sinks of this report fall behind. May be
+                None.
 
             collector:
                 The address of the oonib collector for this report.
 
             no_yamloo:
                 If we should disable reporting to disk.
+
+            report_format:
+                The format of the report written to disk, one of the keys of
+                :data:ooni.reporter.file_reporters.
         """
         self.test_details = test_details
         self.collector_client = collector_client
+        if report_format not in file_reporters:
+            raise errors.InvalidReportFormat(report_format)
+        self.report_format = report_format
         if report_filename is None:
             report_filename = self.generateReportFilename()
         self.report_filename = report_filename
 
         self.report_log = OONIBReportLog()
 
-        self.yaml_reporter = None
+        self.file_reporter = None
         self.oonib_reporter = None
         self.no_yamloo = no_yamloo
 
+        self.sinks = []
+        self.file_sink = None
+        self.oonib_sink = None
+
         self.done = defer.Deferred()
         self.reportEntryManager = reportEntryManager
 
     def generateReportFilename(self):
+        extension = file_reporters[self.report_format].extension
         report_filename = generate_filename(self.test_details,
                                             prefix='report',
-                                            extension='yamloo')
+                                            extension=extension)
         report_path = os.path.join('.', report_filename)
         return os.path.abspath(report_path)
 
@@ -532,6 +1149,10 @@ class Report(object):
         d.addCallback(created)
         return d
 
+    def _createOONIBSink(self):
+        return create_oonib_sink(self.oonib_reporter,
+                                 monitor=self.reportEntryManager)
+
     @defer.inlineCallbacks
     def open(self):
         """
@@ -542,13 +1163,21 @@ class Report(object):
             self.oonib_reporter = OONIBReporter(self.test_details,
                                                 self.collector_client)
             self.test_details['report_id'] = yield self.open_oonib_reporter()
+            if self.oonib_reporter:
+                self.oonib_sink = self._createOONIBSink()
+                self.sinks.append(self.oonib_sink)
 
         if not self.no_yamloo:
-            self.yaml_reporter = YAMLReporter(self.test_details,
-                                              self.report_filename)
+            file_reporter = file_reporters[self.report_format]
+            self.file_reporter = file_reporter(self.test_details,
+                                               self.report_filename)
             if not self.oonib_reporter:
                 yield self.report_log.not_created(self.report_filename)
-            yield defer.maybeDeferred(self.yaml_reporter.createReport)
+            yield defer.maybeDeferred(self.file_reporter.createReport)
+            self.file_sink = ReportSink(self.file_reporter,
+                                        monitor=self.reportEntryManager)
+            # The local report is written first
+            self.sinks.insert(0, self.file_sink)
 
         defer.returnValue(self.reportId)
 
@@ -566,75 +1195,50 @@ class Report(object):
             a deferred that will fire once all the report entries have
             been written or errbacks when no more reporters
         """
-
-        d = defer.Deferred()
         deferreds = []
 
-        def yaml_report_failed(failure):
-            d.errback(failure)
-
         def oonib_report_failed(failure):
             return self.report_log.incomplete(self.report_filename)
 
-        def all_reports_written(_):
-            if not d.called:
-                d.callback(None)
-
-        if self.yaml_reporter:
-            write_yaml_report = ReportEntry(self.yaml_reporter, measurement)
-            self.reportEntryManager.schedule(write_yaml_report)
-            write_yaml_report.done.addErrback(yaml_report_failed)
-            deferreds.append(write_yaml_report.done)
-
-        if self.oonib_reporter:
-            write_oonib_report = ReportEntry(self.oonib_reporter, measurement)
-            self.reportEntryManager.schedule(write_oonib_report)
-            write_oonib_report.done.addErrback(oonib_report_failed)
-            deferreds.append(write_oonib_report.done)
+        if self.file_sink:
+            deferreds.append(self.file_sink.write(measurement))
 
-        dl = defer.DeferredList(deferreds)
-        dl.addCallback(all_reports_written)
+        if self.oonib_sink:
+            write_oonib_report = self.oonib_sink.write(measurement)
+            write_oonib_report.addErrback(oonib_report_failed)
+            deferreds.append(write_oonib_report)
 
+        if len(deferreds) == 1:
+            d = deferreds[0]
+        else:
+            d = defer.gatherResults(deferreds, consumeErrors=True)
+            d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(lambda _: None)
         return d
 
+    @defer.inlineCallbacks
     def close(self):
         """
-        Close the report by calling it's finish method.
+        Close the report by waiting for all the queued entries to be written
+        and then calling the finish method of every reporter.
 
         Returns:
-            a :class:twisted.internet.defer.DeferredList that will fire when
+            a :class:twisted.internet.defer.Deferred that will fire when
             all the reports have been closed.
 
         """
-        d = defer.Deferred()
-        deferreds = []
-
-        def yaml_report_failed(failure):
-            d.errback(failure)
-
-        def oonib_report_closed(result):
-            return self.report_log.closed(self.report_filename)
-
-        def oonib_report_failed(result):
-            log.exception(result)
-            log.err("Failed to close oonib report.")
-
-        def all_reports_closed(_):
-            if not d.called:
-                d.callback(None)
-
-        if self.yaml_reporter:
-            close_yaml = defer.maybeDeferred(self.yaml_reporter.finish)
-            close_yaml.addErrback(yaml_report_failed)
-            deferreds.append(close_yaml)
-
-        if self.oonib_reporter:
-            close_oonib = self.oonib_reporter.finish()
-            close_oonib.addCallback(oonib_report_closed)
-            close_oonib.addErrback(oonib_report_failed)
-            deferreds.append(close_oonib)
-
-        dl = defer.DeferredList(deferreds)
-        dl.addCallback(all_reports_closed)
+        try:
+            yield defer.gatherResults([sink.flush() for sink in self.sinks])
 
-        return d
+            if self.oonib_reporter:
+                try:
+                    yield self.oonib_reporter.finish()
+                    yield self.report_log.closed(self.report_filename)
+                except Exception as exc:
+                    log.exception(exc)
+                    log.err("Failed to close oonib report.")
+
+            if self.file_reporter:
+                yield defer.maybeDeferred(self.file_reporter.finish)
+        finally:
+            self.report_log.close()
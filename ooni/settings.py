@@ -113,7 +113,7 @@ class OConfig(object):
             self.report_log_file = self.advanced.report_log_file
         else:
             self.report_log_file = os.path.join(self.ooni_home,
-                                                'reporting.yml')
+                                                'reporting.sqlite')
 
         if self.global_options.get('configfile'):
             config_file = self.global_options['configfile']
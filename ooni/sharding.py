@@ -0,0 +1,361 @@
+import os
+import sys
+import struct
+import cPickle
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.protocols.basic import Int32StringReceiver
+
+from ooni.utils import log
+from ooni.nettest import NetTest
+from ooni.settings import config
+
+
+def plainSettings(settings):
+    """
+    Returns the settings whose values are of the types that can be found in
+    ooniprobe.conf, leaving out any object that has been set at runtime.
+    """
+    plain_types = (basestring, int, long, float, bool, list, dict,
+                   type(None))
+    return dict((key, value) for key, value in settings.items()
+                if isinstance(value, plain_types))
+
+
+def mergeSummary(summary, other):
+    """
+    Merges the summary of a NetTest run by a worker process into summary.
+    The lists are concatenated, the dicts merged and the numbers added up,
+    any other value replaces the one in summary.
+    """
+    for key, value in other.items():
+        if key not in summary:
+            summary[key] = value
+        elif isinstance(value, dict) and isinstance(summary[key], dict):
+            mergeSummary(summary[key], value)
+        elif isinstance(value, list) and isinstance(summary[key], list):
+            summary[key].extend(value)
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            summary[key] += value
+        else:
+            summary[key] = value
+
+
+def packMessage(*message):
+    """
+    Every message is a pickled tuple, prefixed by its length like the strings
+    of :class:twisted.protocols.basic.Int32StringReceiver.
+    """
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    return struct.pack('!I', len(data)) + data
+
+
+class ShardChannel(Int32StringReceiver):
+    """
+    Used by a worker process to send messages to the parent, over a
+    non-blocking transport so that the reactor of the worker keeps running
+    its measurements while the parent is busy.
+
+    The parent sends back pause and resume messages when it has too many
+    entries waiting to be written. While paused the channel is reported as a
+    full sink to the monitor (a :class:ooni.managers.ReportEntryManager), so
+    that no new measurements are scheduled.
+    """
+    implements(IHalfCloseableProtocol)
+
+    monitor = None
+
+    def __init__(self):
+        self.closed = defer.Deferred()
+
+    def send(self, *message):
+        self.transport.write(packMessage(*message))
+
+    def stringReceived(self, data):
+        message = cPickle.loads(data)
+        if self.monitor is None:
+            return
+        if message[0] == 'pause':
+            self.monitor.sinkFull(self)
+        elif message[0] == 'resume':
+            self.monitor.sinkDrained(self)
+
+    def close(self):
+        """
+        Closes the channel once all the messages have been sent and returns
+        a Deferred that fires when it is done.
+        """
+        self.transport.loseConnection()
+        return self.closed
+
+    def readConnectionLost(self):
+        # The parent does not have anything more to tell us, but we still
+        # have entries to send.
+        pass
+
+    def writeConnectionLost(self):
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if not self.closed.called:
+            self.closed.callback(None)
+
+
+class ShardMessageReceiver(Int32StringReceiver):
+    # Report entries can carry whole HTTP bodies
+    MAX_LENGTH = 256 * 1024 * 1024
+
+    def __init__(self, shard_protocol):
+        self.shardProtocol = shard_protocol
+
+    def stringReceived(self, data):
+        self.shardProtocol.messageReceived(cPickle.loads(data))
+
+    def lengthLimitExceeded(self, length):
+        log.err("Message of %d bytes from shard %d is too large" % (
+            length, self.shardProtocol.index))
+        self.shardProtocol.transport.signalProcess('KILL')
+
+
+class ShardProcessProtocol(protocol.ProcessProtocol):
+    """
+    Talks to one of the worker processes of a :class:ShardedNetTest.
+
+    The job is written to the standard input of the worker, which then sends
+    back its messages on file descriptor 3, so that whatever the nettest
+    prints does not get in the way. The pause and resume messages for the
+    worker are written to its file descriptor 4.
+    """
+    messageFD = 3
+    controlFD = 4
+
+    def __init__(self, sharded_net_test, index):
+        self.shardedNetTest = sharded_net_test
+        self.index = index
+        self.finished = False
+        self.paused = False
+        self._receiver = ShardMessageReceiver(self)
+
+    def connectionMade(self):
+        try:
+            job = cPickle.dumps(self.shardedNetTest.job(self.index),
+                                cPickle.HIGHEST_PROTOCOL)
+        except cPickle.PicklingError as exc:
+            log.err("Failed to send the job to shard %d" % self.index)
+            log.exception(exc)
+            self.transport.signalProcess('KILL')
+            return
+        self.transport.write(job)
+        self.transport.closeStdin()
+
+    def pause(self):
+        self.paused = True
+        self.transport.writeToChild(self.controlFD, packMessage('pause'))
+
+    def resume(self):
+        self.paused = False
+        self.transport.writeToChild(self.controlFD, packMessage('resume'))
+
+    def childDataReceived(self, child_fd, data):
+        if child_fd == self.messageFD:
+            self._receiver.dataReceived(data)
+        elif child_fd == 1:
+            for line in data.splitlines():
+                log.debug("[shard %d] %s" % (self.index, line))
+        else:
+            for line in data.splitlines():
+                log.err("[shard %d] %s" % (self.index, line))
+
+    def messageReceived(self, message):
+        kind = message[0]
+        if kind == 'entry':
+            self.shardedNetTest.entryReceived(message[1], message[2])
+        elif kind == 'measurement':
+            self.shardedNetTest.measurementReceived(message[1], message[2])
+        elif kind == 'summary':
+            self.shardedNetTest.summaryReceived(message[1], message[2])
+        elif kind == 'done':
+            self.finished = True
+
+    def processEnded(self, reason):
+        if not self.finished:
+            log.err("Shard %d of %s exited before completing: %s" % (
+                self.index, self.shardedNetTest, reason.getErrorMessage()))
+        self.shardedNetTest.shardEnded(self.index)
+
+
+class ShardedNetTest(NetTest):
+    """
+    Runs a NetTest in a number of worker processes, each with its own reactor
+    and MeasurementManager.
+
+    The report entries are numbered in the order in which the inputs are
+    generated and every worker measures only the entries whose number modulo
+    the number of shards is its index (see NetTest.shard). The entries it
+    produces are sent back here and written to the report in their original
+    order, so the report is the same regardless of how the work got split.
+    The outcome of every measurement is also forwarded to the director, so
+    that its statistics cover all the shards, and the summaries of the
+    workers are merged into the one of the ShardedNetTest.
+
+    To keep the memory used to reorder the entries bounded, the workers that
+    are more than maxPending entries ahead are told to stop scheduling new
+    measurements until the others catch up.
+    """
+    maxPending = 1000
+
+    # The sections of the configuration that are handed to the workers, so
+    # that they run with the same settings as the parent, including the ones
+    # that have been changed at runtime.
+    configSections = ('basic', 'advanced', 'privacy', 'tor', 'reports')
+
+    # So that we can test the spawnProcess calls
+    reactor = reactor
+
+    def __init__(self, net_test_loader, test_details, report, shards):
+        NetTest.__init__(self, net_test_loader.getTestCases(), test_details,
+                         report)
+        self.netTestLoader = net_test_loader
+        self.shards = shards
+        self.processes = []
+
+        self._pending = {}
+        self._nextEntry = 0
+        self._ended = set()
+        self._paused = False
+        self._scheduler = None
+
+    @classmethod
+    def supports(cls, net_test_loader):
+        """
+        Whether the NetTest can be split across worker processes. The workers
+        need to load the nettest from its file and they can not share the Tor
+        instance or the packet capture of the parent.
+        """
+        return (net_test_loader.testFile is not None and
+                not net_test_loader.requiresTor and
+                not config.privacy.includepcap)
+
+    def job(self, index):
+        return {
+            'test_file': self.netTestLoader.testFile,
+            'options': self.netTestLoader.options,
+            'annotations': self.netTestLoader.annotations,
+            'local_options': dict(self.netTestLoader.localOptions),
+            'test_details': self.testDetails,
+            'shard': (index, self.shards),
+            'global_options': dict(config.global_options),
+            'ooni_home': os.path.abspath(config.ooni_home),
+            'config': dict((section, plainSettings(getattr(config, section)))
+                           for section in self.configSections),
+            'geodata': config.probe_ip.geodata
+        }
+
+    def initialize(self):
+        return defer.succeed(None)
+
+    def start(self):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        for index in range(self.shards):
+            process_protocol = ShardProcessProtocol(self, index)
+            self.reactor.spawnProcess(
+                process_protocol, sys.executable,
+                [sys.executable, '-m', 'ooni.shardworker'], env=env,
+                childFDs={0: 'w', 1: 'r', 2: 'r',
+                          ShardProcessProtocol.messageFD: 'r',
+                          ShardProcessProtocol.controlFD: 'w'})
+            self.processes.append(process_protocol)
+
+    def _shardOf(self, entry_index):
+        return entry_index % self.shards
+
+    def _writeReady(self):
+        while True:
+            if self._nextEntry in self._pending:
+                entry = self._pending.pop(self._nextEntry)
+            elif self._shardOf(self._nextEntry) in self._ended:
+                # The worker has exited, so we are not going to get any more
+                # entries from it.
+                if not self._pending:
+                    break
+                entry = None
+            else:
+                break
+            if entry is not None and self.report:
+                d = self.report.write(entry)
+                d.addErrback(self.writeReportFailed, self._nextEntry)
+            self._nextEntry += 1
+        self._throttle()
+
+    def _throttle(self):
+        """
+        Pauses the workers while too many entries are waiting to be written,
+        except the one whose entry we are waiting for. A paused worker
+        completes the measurements it is running but does not start new ones.
+        """
+        if len(self._pending) > self.maxPending:
+            self._paused = True
+        elif len(self._pending) <= self.maxPending / 2:
+            self._paused = False
+        waiting_for = self._shardOf(self._nextEntry)
+        for process_protocol in self.processes:
+            if process_protocol.index in self._ended:
+                continue
+            pause = self._paused and process_protocol.index != waiting_for
+            if pause and not process_protocol.paused:
+                process_protocol.pause()
+            elif not pause and process_protocol.paused:
+                process_protocol.resume()
+
+    def entryReceived(self, entry_index, entry):
+        """
+        Called when a worker has completed the measurements for the
+        entry_index-th entry. The entry is None if it could not be produced.
+        """
+        if entry is None:
+            log.err("Shard %d failed to produce the report entry %d" % (
+                self._shardOf(entry_index), entry_index))
+        self._pending[entry_index] = entry
+        self._writeReady()
+
+    def measurementReceived(self, outcome, runtime):
+        if self.director:
+            self.director.shardMeasurementDone(outcome, runtime)
+
+    def summaryReceived(self, summary, scheduler):
+        """
+        Called when a worker has completed its measurements, with its
+        summary and the one of its HostScheduler, if it had one.
+        """
+        mergeSummary(self.summary, summary)
+        if scheduler is None:
+            return
+        if self._scheduler is None:
+            self._scheduler = {'destinations': set(),
+                               'max_active_per_destination': 0,
+                               'throttled': 0}
+        # Every worker gets its share of the per destination concurrency,
+        # so the concurrency of all of them is their sum.
+        self._scheduler['destinations'].update(scheduler['destinations'])
+        self._scheduler['max_active_per_destination'] += \
+            scheduler['max_active_per_destination']
+        self._scheduler['throttled'] += scheduler['throttled']
+
+    def schedulerSummary(self):
+        if self._scheduler is None:
+            return None
+        return dict(self._scheduler,
+                    destinations=len(self._scheduler['destinations']))
+
+    def shardEnded(self, index):
+        self._ended.add(index)
+        self._writeReady()
+        if len(self._ended) == self.shards:
+            # The report takes care of waiting for the queued entries to be
+            # written when it gets closed.
+            self.done.callback(None)
@@ -0,0 +1,112 @@
+"""
+The worker process of a :class:ooni.sharding.ShardedNetTest.
+
+It reads its job from the standard input, runs its shard of the NetTest with
+its own Director and sends the report entries, the outcome of the
+measurements and its summary back to the parent on file descriptor 3. The
+parent tells it to pause and resume the scheduling of new measurements on
+file descriptor 4.
+"""
+import sys
+import cPickle
+
+from twisted.internet import defer, reactor, stdio
+
+from ooni.settings import config
+from ooni.director import Director
+from ooni.nettest import NetTest, NetTestLoader
+from ooni.sharding import ShardChannel, ShardProcessProtocol
+
+
+class ShardDirector(Director):
+    def __init__(self, channel):
+        Director.__init__(self)
+        self.channel = channel
+        self.channel.monitor = self.reportEntryManager
+
+    def measurementTimedOut(self, measurement):
+        Director.measurementTimedOut(self, measurement)
+        self.channel.send('measurement', 'timed_out', 0)
+
+    def measurementSucceeded(self, result, measurement):
+        result = Director.measurementSucceeded(self, result, measurement)
+        self.channel.send('measurement', 'succeeded', measurement.runtime)
+        return result
+
+    def measurementFailed(self, failure, measurement):
+        result = Director.measurementFailed(self, failure, measurement)
+        self.channel.send('measurement', 'failed', measurement.runtime)
+        return result
+
+
+class ShardNetTest(NetTest):
+    """
+    Sends the report entries to the parent instead of writing them.
+    """
+    def writeReport(self, entry, entry_index):
+        self.report.send('entry', entry_index, entry)
+
+    def writeReportFailed(self, failure, entry_index):
+        NetTest.writeReportFailed(self, failure, entry_index)
+        self.report.send('entry', entry_index, None)
+
+    def doneNetTest(self, result):
+        # The parent merges the summaries of all the workers and prints them
+        scheduler = None
+        if self.hostScheduler:
+            scheduler = dict(self.hostScheduler.summary,
+                             destinations=self.hostScheduler.destinations)
+        self.report.send('summary', self.summary, scheduler)
+
+
+@defer.inlineCallbacks
+def runShard(job, channel):
+    net_test_loader = NetTestLoader(job['options'],
+                                    test_file=job['test_file'],
+                                    annotations=job['annotations'])
+    # The options have already been checked by the parent, which might have
+    # also filled in the addresses of the test helpers.
+    net_test_loader.parseLocalOptions()
+    net_test_loader.localOptions.update(job['local_options'])
+
+    director = ShardDirector(channel)
+    net_test = ShardNetTest(net_test_loader.getTestCases(),
+                            job['test_details'], channel)
+    net_test.shard = job['shard']
+    net_test.director = director
+
+    yield net_test.initialize()
+    director.activeNetTests.append(net_test)
+    director.measurementManager.schedule(
+        net_test.measurementSource(director.measurementManager.wakeUp))
+    yield net_test.done
+    channel.send('done')
+
+
+def main():
+    job = cPickle.load(sys.stdin)
+    channel = ShardChannel()
+    stdio.StandardIO(channel, stdin=ShardProcessProtocol.controlFD,
+                     stdout=ShardProcessProtocol.messageFD)
+
+    config.global_options = job['global_options']
+    config.initialize_ooni_home(job['ooni_home'])
+    for section, settings in job['config'].items():
+        getattr(config, section).update(settings)
+    config.set_paths()
+    config.probe_ip.geodata = job['geodata']
+
+    def failed(failure):
+        sys.stderr.write(failure.getTraceback())
+
+    def run():
+        d = runShard(job, channel)
+        d.addErrback(failed)
+        d.addBoth(lambda _: channel.close())
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
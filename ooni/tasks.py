@@ -19,8 +19,13 @@ class BaseTask(object):
         """
         self.failures = 0
 
-        self.startTime = time.time()
+        # Set when the task is first started, tasks may be created well
+        # before they are scheduled.
+        self.startTime = None
         self.runtime = 0
+        # The same, for the last time the task was started
+        self.attemptStartTime = None
+        self.attemptRuntime = 0
 
         # This is a deferred that gets called when a test has reached it's
         # final status, this means: all retries have been attempted or the test
@@ -34,11 +39,16 @@ class BaseTask(object):
         return failure
 
     def _succeeded(self, result):
-        self.runtime = time.time() - self.startTime
+        now = time.time()
+        self.runtime = now - self.startTime
+        self.attemptRuntime = now - self.attemptStartTime
         self.succeeded(result)
         return result
 
     def start(self):
+        self.attemptStartTime = time.time()
+        if self.startTime is None:
+            self.startTime = self.attemptStartTime
         self._running = defer.maybeDeferred(self.run)
         self._running.addErrback(self._failed)
         self._running.addCallback(self._succeeded)
@@ -110,8 +120,6 @@ class Measurement(TaskWithTimeout):
         """
         self.testInstance = test_instance
         self.testInstance.input = test_input
-        if not hasattr(self.testInstance, '_start_time'):
-            self.testInstance._start_time = time.time()
 
         self.testInstance.setUp()
         if 'input' not in self.testInstance.report.keys():
@@ -137,19 +145,11 @@ class Measurement(TaskWithTimeout):
         pass
 
     def run(self):
+        # The test instance is shared by the measurements of every test
+        # method for the same input, its runtime starts with the first one.
+        if not hasattr(self.testInstance, '_start_time'):
+            self.testInstance._start_time = time.time()
         if 'measurement_start_time' not in self.testInstance.report.keys():
             self.testInstance.report['measurement_start_time'] = otime.timestampNowLongUTC()
         return self.netTestMethod()
 
-
-class ReportEntry(TaskWithTimeout):
-    def __init__(self, reporter, entry):
-        self.reporter = reporter
-        self.entry = entry
-
-        if config.advanced.reporting_timeout:
-            self.timeout = config.advanced.reporting_timeout
-        TaskWithTimeout.__init__(self)
-
-    def run(self):
-        return self.reporter.writeReportEntry(self.entry)
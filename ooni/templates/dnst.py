@@ -5,11 +5,14 @@
 
 from twisted.internet import udp, error, base
 from twisted.internet.defer import TimeoutError
-from twisted.names import client, dns
+from twisted.names import cache, client, dns, resolve
 from twisted.names.client import Resolver
 
 from ooni.utils import log
+from ooni.utils.dnscache import dns_cache, cacheSummary
+from ooni.utils.dnsengine import dns_engine
 from ooni.nettest import NetTestCase
+from ooni.settings import config
 from ooni.errors import failureToString
 
 import socket
@@ -57,6 +60,19 @@ def connectionLost(self, reason=None):
         del self.d
 udp.Port.connectionLost = connectionLost
 
+def systemResolver(bypass_cache=False):
+    """
+    Returns the resolver that uses the system DNS settings. If bypass_cache is
+    True the cache of Twisted is left out of it.
+    """
+    resolver = client.getResolver()
+    if bypass_cache and isinstance(resolver, resolve.ResolverChain):
+        resolver = resolve.ResolverChain([
+            r for r in resolver.resolvers
+            if not isinstance(r, cache.CacheResolver)
+        ])
+    return resolver
+
 def representAnswer(answer):
     answer_types = {
         dns.SOA: 'SOA',
@@ -92,12 +108,21 @@ class DNSTest(NetTestCase):
     requiresRoot = False
     queryTimeout = [1]
 
+    # How the queries to a given dns_server are sent, "resolver" or
+    # "engine" (see ooni.utils.dnsengine). None means the dns_backend
+    # setting.
+    dnsBackend = None
+
     def _setUp(self):
         super(DNSTest, self)._setUp()
 
         self.report['queries'] = []
 
-    def performPTRLookup(self, address, dns_server = None):
+    def getDNSBackend(self):
+        return self.dnsBackend or config.advanced.dns_backend or 'resolver'
+
+    def performPTRLookup(self, address, dns_server = None,
+                         use_cache=False, queries=None):
         """
         Does a reverse DNS lookup on the input ip address
 
@@ -107,11 +132,16 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :use_cache: see dnsLookup
+
+        :queries: see dnsLookup
         """
         ptr = '.'.join(address.split('.')[::-1]) + '.in-addr.arpa'
-        return self.dnsLookup(ptr, 'PTR', dns_server)
+        return self.dnsLookup(ptr, 'PTR', dns_server, use_cache, queries)
 
-    def performALookup(self, hostname, dns_server = None):
+    def performALookup(self, hostname, dns_server = None,
+                       use_cache=False, queries=None):
         """
         Performs an A lookup and returns an array containg all the dotted quad
         IP addresses in the response.
@@ -122,10 +152,15 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :use_cache: see dnsLookup
+
+        :queries: see dnsLookup
         """
-        return self.dnsLookup(hostname, 'A', dns_server)
+        return self.dnsLookup(hostname, 'A', dns_server, use_cache, queries)
 
-    def performNSLookup(self, hostname, dns_server = None):
+    def performNSLookup(self, hostname, dns_server = None,
+                        use_cache=False, queries=None):
         """
         Performs a NS lookup and returns an array containg all nameservers in
         the response.
@@ -136,10 +171,15 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :use_cache: see dnsLookup
+
+        :queries: see dnsLookup
         """
-        return self.dnsLookup(hostname, 'NS', dns_server)
+        return self.dnsLookup(hostname, 'NS', dns_server, use_cache, queries)
 
-    def performSOALookup(self, hostname, dns_server = None):
+    def performSOALookup(self, hostname, dns_server = None,
+                         use_cache=False, queries=None):
         """
         Performs a SOA lookup and returns the response (name,serial).
 
@@ -148,10 +188,15 @@ class DNSTest(NetTestCase):
                      tuple of ip port (ex. ("127.0.0.1", 53))
 
                      if None, system dns settings will be used
+
+        :use_cache: see dnsLookup
+
+        :queries: see dnsLookup
         """
-        return self.dnsLookup(hostname,'SOA',dns_server)
+        return self.dnsLookup(hostname, 'SOA', dns_server, use_cache, queries)
 
-    def dnsLookup(self, hostname, dns_type, dns_server = None):
+    def dnsLookup(self, hostname, dns_type, dns_server = None,
+                  use_cache=False, queries=None):
         """
         Performs a DNS lookup and returns the response.
 
@@ -159,6 +204,14 @@ class DNSTest(NetTestCase):
         :dns_type: type of lookup 'NS'/'A'/'SOA'
         :dns_server: is the dns_server that should be used for the lookup as a
                      tuple of ip port (ex. ("127.0.0.1", 53))
+        :use_cache: if True the lookup is answered from the cache shared by
+                    all the measurements, as long as the TTL of the answers
+                    allows. The outcome is only counted in the summary, so
+                    that the report does not change. Measurements must reach
+                    the wire, so it is only meant for control lookups.
+        :queries: the list the query is added to, the queries of the report
+                  if None. Useful to tell apart the queries of concurrent
+                  lookups.
         """
         types = {
             'NS': dns.NS,
@@ -197,33 +250,56 @@ class DNSTest(NetTestCase):
                     answers.append(representAnswer(authority))
 
             DNSTest.addToReport(self, query, resolver=dns_server,
-                                query_type=dns_type, answers=answers)
+                                query_type=dns_type, answers=answers,
+                                queries=queries)
             return addrs
 
         def gotError(failure):
             failure.trap(gaierror, TimeoutError)
             DNSTest.addToReport(self, query, resolver=dns_server,
-                                query_type=dns_type, failure=failure)
+                                query_type=dns_type, failure=failure,
+                                queries=queries)
             return failure
 
-        if dns_server:
-            resolver = Resolver(servers=[dns_server])
-            d = resolver.queryUDP(query, timeout=self.queryTimeout)
-        else:
+        def sendQuery():
+            if dns_server and self.getDNSBackend() == 'engine':
+                return dns_engine.query(query, dns_server,
+                                        timeout=self.queryTimeout)
+            elif dns_server:
+                resolver = Resolver(servers=[dns_server])
+                return resolver.queryUDP(query, timeout=self.queryTimeout)
+            # Twisted's own cache is only left out when the answers are
+            # already cached by dns_cache.
+            resolver = systemResolver(bypass_cache=use_cache)
             lookupFunction = {
-                'NS': client.lookupNameservers,
-                'SOA': client.lookupAuthority,
-                'A': client.lookupAddress,
-                'PTR': client.lookupPointer
+                'NS': resolver.lookupNameservers,
+                'SOA': resolver.lookupAuthority,
+                'A': resolver.lookupAddress,
+                'PTR': resolver.lookupPointer
             }
-            d = lookupFunction[dns_type](hostname)
-
+            return lookupFunction[dns_type](hostname)
+
+        # The case of the names is not folded, some tests rely on it to
+        # detect the resolvers that tamper with the queries.
+        cache_key = (hostname, dns_type, dns_server and tuple(dns_server))
+        stats = {}
+        d = dns_cache.lookup(cache_key, sendQuery, bypass=not use_cache,
+                             stats=stats)
+        self._countCacheLookup(stats)
         d.addCallback(gotResponse)
         d.addErrback(gotError)
         return d
 
+    def _countCacheLookup(self, stats):
+        # The summary is only there when run by a NetTest
+        if not hasattr(self, 'summary'):
+            return
+        counter = self.summary.setdefault('dns_cache', {})
+        for outcome, count in stats.items():
+            counter[outcome] = counter.get(outcome, 0) + count
+
     def addToReport(self, query, resolver=None, query_type=None,
-                    answers=None, failure=None):
+                    answers=None, failure=None, queries=None):
         log.debug("Adding %s to report)" % query)
         result = {
             'resolver_hostname': None,
@@ -242,4 +318,17 @@ class DNSTest(NetTestCase):
         if answers:
             result['answers'] = answers
 
-        self.report['queries'].append(result)
+        if queries is None:
+            queries = self.report['queries']
+        queries.append(result)
+
+    def displaySummary(self, summary):
+        if 'dns_cache' not in summary:
+            return
+        stats = cacheSummary(summary['dns_cache'])
+        log.msg("")
+        log.msg("DNS lookups: %d (%d answered from the cache, %d waited for "
+                "another one, %d bypassed the cache), cache hit ratio "
+                "%.1f%%" % (stats['lookups'], stats['hits'],
+                            stats['coalesced'], stats['bypassed'],
+                            stats['hit_ratio'] * 100))
@@ -1,15 +1,11 @@
 import random
 
-from txtorcon.interface import StreamListenerMixin
-
-from twisted.web.client import readBody, PartialDownloadError
+from twisted.web.client import PartialDownloadError
 from twisted.web.client import ContentDecoderAgent
 
 from twisted.internet import reactor
 from twisted.internet.endpoints import TCP4ClientEndpoint
 
-from ooni.utils.socks import TrueHeadersSOCKS5Agent
-
 from ooni.nettest import NetTestCase
 from ooni.utils import log
 from ooni.settings import config
@@ -17,26 +13,39 @@ from ooni.settings import config
 from ooni.utils.net import StringProducer, userAgents
 from ooni.common.txextra import TrueHeaders
 from ooni.common.txextra import FixedRedirectAgent, TrueHeadersAgent
+from ooni.common.txextra import readBody
 from ooni.common.http_utils import representBody
 from ooni.errors import handleAllFailures
 
 class InvalidSocksProxyOption(Exception):
     pass
 
-class StreamListener(StreamListenerMixin):
+_StreamListener = None
 
-    def __init__(self, request):
-        self.request = request
+def StreamListener(request):
+    """
+    Returns a listener that records the exit of the circuit used by a request
+    made over Tor. txtorcon is only imported once Tor is actually used.
+    """
+    global _StreamListener
+    if _StreamListener is None:
+        from txtorcon.interface import StreamListenerMixin
 
-    def stream_succeeded(self, stream):
-        host=self.request['url'].split('/')[2]
-        try:
-            if stream.target_host == host and self.request['tor']['exit_ip'] is None:
-                self.request['tor']['exit_ip'] = stream.circuit.path[-1].ip
-                self.request['tor']['exit_name'] = stream.circuit.path[-1].name
-                config.tor_state.stream_listeners.remove(self)
-        except:
-            log.err("Tor Exit ip detection failed")
+        class _StreamListener(StreamListenerMixin):
+
+            def __init__(self, request):
+                self.request = request
+
+            def stream_succeeded(self, stream):
+                host=self.request['url'].split('/')[2]
+                try:
+                    if stream.target_host == host and self.request['tor']['exit_ip'] is None:
+                        self.request['tor']['exit_ip'] = stream.circuit.path[-1].ip
+                        self.request['tor']['exit_name'] = stream.circuit.path[-1].name
+                        config.tor_state.stream_listeners.remove(self)
+                except:
+                    log.err("Tor Exit ip detection failed")
+    return _StreamListener(request)
 
 
 def _representHeaders(headers):
@@ -71,12 +80,18 @@ class HTTPTest(NetTestCase):
     # contentDecoders = [('gzip', GzipDecoder)]
     contentDecoders = []
 
+    # Only this many bytes of the response bodies are kept, in memory and in
+    # the report. None means the max_http_body_size setting.
+    maxBodySize = None
+
     baseParameters = [['socksproxy', 's', None,
         'Specify a socks proxy to use for requests (ip:port)']]
 
     def _setUp(self):
         super(HTTPTest, self)._setUp()
 
+        from ooni.utils.socks import TrueHeadersSOCKS5Agent
+
         try:
             import OpenSSL
         except:
@@ -121,6 +136,11 @@ class HTTPTest(NetTestCase):
         self.processInputs()
         log.debug("Finished test setup")
 
+    def getMaxBodySize(self):
+        if self.maxBodySize is not None:
+            return self.maxBodySize
+        return config.advanced.max_http_body_size
+
     def randomize_useragent(self, request):
         user_agent = random.choice(userAgents)
         request['headers']['User-Agent'] = [user_agent]
@@ -154,8 +174,9 @@ class HTTPTest(NetTestCase):
             'response': None
         }
         if response:
+            body_truncated = getattr(response, 'bodyTruncated', False)
             if self.localOptions.get('withoutbody', 0) is 0:
-                response_body = representBody(response_body)
+                response_body = representBody(response_body, body_truncated)
             else:
                 response_body = ''
             # Attempt to redact the IP address of the probe from the responses
@@ -168,6 +189,9 @@ class HTTPTest(NetTestCase):
             session['response'] = {
                 'headers': _representHeaders(response.headers),
                 'body': response_body,
+                'body_length': getattr(response, 'bodyLength', None),
+                'body_sha256': getattr(response, 'bodySHA256', None),
+                'body_is_truncated': body_truncated,
                 'code': response.code
             }
         session['failure'] = None
@@ -279,7 +303,7 @@ class HTTPTest(NetTestCase):
         else:
             self.processResponseHeaders(response_headers_dict)
 
-        finished = readBody(response)
+        finished = readBody(response, self.getMaxBodySize())
         finished.addErrback(self._processResponseBodyFail, request,
                             response)
         finished.addCallback(self._processResponseBody, request,
@@ -4,8 +4,6 @@ from ooni.utils import log
 from ooni.settings import config
 from ooni.utils.net import hasRawSocketPermission
 
-from ooni.utils.txscapy import ScapySender, ScapyFactory
-
 
 def _representPacket(packet):
     return {
@@ -49,6 +47,7 @@ class BaseScapyTest(NetTestCase):
         super(BaseScapyTest, self)._setUp()
 
         if config.scapyFactory is None:
+            from ooni.utils.txscapy import ScapyFactory
             log.debug("Scapy factory not set, registering it.")
             config.scapyFactory = ScapyFactory(config.advanced.interface)
 
@@ -107,6 +106,7 @@ class BaseScapyTest(NetTestCase):
         Wrapper around scapy.sendrecv.sr for sending and receiving of packets
         at layer 3.
         """
+        from ooni.utils.txscapy import ScapySender
         scapySender = ScapySender(timeout=timeout)
 
         config.scapyFactory.registerProtocol(scapySender)
@@ -129,6 +129,7 @@ class BaseScapyTest(NetTestCase):
                 log.err("Got no response...")
                 return packets
 
+        from ooni.utils.txscapy import ScapySender
         scapySender = ScapySender()
         scapySender.expected_answers = 1
 
@@ -145,6 +146,7 @@ class BaseScapyTest(NetTestCase):
         """
         Wrapper around scapy.sendrecv.send for sending of packets at layer 3
         """
+        from ooni.utils.txscapy import ScapySender
         scapySender = ScapySender()
 
         config.scapyFactory.registerProtocol(scapySender)
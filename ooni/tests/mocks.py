@@ -125,13 +125,25 @@ class MockFailOnceMeasurement(MockMeasurement):
             return defer.fail(mockFailure)
 
 
+class MockTimeoutOnceMeasurement(MockMeasurement):
+    def run(self):
+        if self.failures >= 1:
+            return defer.succeed(42)
+        else:
+            return defer.Deferred()
+
+
 class MockDirector(object):
     def __init__(self):
         self.successes = []
+        self.timedOut = []
 
     def measurementFailed(self, failure, measurement):
         pass
 
+    def measurementTimedOut(self, measurement):
+        self.timedOut.append(measurement)
+
     def measurementSucceeded(self, measurement):
         self.successes.append(measurement)
 
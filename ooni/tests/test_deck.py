@@ -1,10 +1,13 @@
 import os
+from mock import patch
 
 from twisted.internet import defer
 from twisted.trial import unittest
 
 from hashlib import sha256
+from ooni import deck as deck_module
 from ooni.deck import InputFile, Deck
+from ooni.utils.reachability import ReachabilityCache
 from ooni.tests.mocks import MockBouncerClient, MockCollectorClient
 
 net_test_string = """
@@ -91,6 +94,39 @@ class TestInputFile(BaseTestCase):
         input_file = InputFile(invalid_hash, base_path='.')
         self.assertRaises(AssertionError, input_file.verify)
 
+    def test_verification_is_memoized(self):
+        self.filename = file_hash = sha256(self.dummy_deck_content).hexdigest()
+        with open(file_hash, 'w+') as f:
+            f.write(self.dummy_deck_content)
+        self.addCleanup(os.remove, file_hash + '.verified')
+        input_file = InputFile(file_hash, base_path='.')
+        with patch.object(deck_module, 'sha256_file',
+                          wraps=deck_module.sha256_file) as sha256_file:
+            input_file.verify()
+            input_file.verify()
+            self.assertEqual(sha256_file.call_count, 1)
+
+            with open(file_hash, 'a') as f:
+                f.write("spam")
+            self.assertRaises(AssertionError, input_file.verify)
+            self.assertEqual(sha256_file.call_count, 2)
+
+    def test_verify_downloaded_file(self):
+        self.filename = file_hash = sha256(self.dummy_deck_content).hexdigest()
+        with open(file_hash, 'w+') as f:
+            f.write(self.dummy_deck_content)
+        self.addCleanup(os.remove, file_hash + '.verified')
+        input_file = InputFile(file_hash, base_path='.')
+        with patch.object(deck_module, 'sha256_file') as sha256_file:
+            input_file.verify(file_hash)
+            assert input_file.fileCached
+            self.assertFalse(sha256_file.called)
+
+        os.remove(file_hash + '.verified')
+        self.assertRaises(AssertionError, input_file.verify, 'a' * 64)
+        self.assertFalse(os.path.exists(file_hash + '.verified'))
+        input_file.verify(file_hash)
+
     def test_save_descriptor(self):
         descriptor = {
             'name': 'spam',
@@ -166,6 +202,37 @@ class TestDeck(BaseTestCase):
                          '127.0.0.1')
 
 
+    @defer.inlineCallbacks
+    def test_cached_bouncer_response(self):
+        self.filename = 'reachability.json'
+        deck = Deck(bouncer="httpo://foo.onion",
+                    decks_directory=".")
+        deck._BouncerClient = MockBouncerClient
+        deck._CollectorClient = MockCollectorClient
+        deck._ReachabilityCache = lambda: ReachabilityCache(
+            path='reachability.json', ttl=60)
+        deck.loadDeck(self.deck_file)
+        yield deck.lookupCollectorAndTestHelpers()
+
+        class UnreachableBouncerClient(MockBouncerClient):
+            def lookupTestCollector(self, net_tests):
+                raise AssertionError("The bouncer should not be queried")
+
+        class UnreachableCollectorClient(MockCollectorClient):
+            def isReachable(self):
+                raise AssertionError("The collector should not be checked")
+
+        deck = Deck(bouncer="httpo://foo.onion",
+                    decks_directory=".")
+        deck._BouncerClient = UnreachableBouncerClient
+        deck._CollectorClient = UnreachableCollectorClient
+        deck._ReachabilityCache = lambda: ReachabilityCache(
+            path='reachability.json', ttl=60)
+        deck.loadDeck(self.deck_file)
+        yield deck.lookupCollectorAndTestHelpers()
+        self.assertEqual(deck.netTestLoaders[0].collector.settings['address'],
+                         'http://thirteenchars123.onion')
+
     def test_deck_with_many_tests(self):
         os.remove(self.deck_file)
         deck_hash = sha256(self.dummy_deck_content_with_many_tests).hexdigest()
@@ -2,6 +2,7 @@ from mock import patch, MagicMock
 
 from ooni.settings import config
 from ooni.director import Director
+from ooni.backend_client import closeConnectionPools
 from ooni.nettest import NetTestLoader
 from ooni.tests.bases import ConfigTestCase
 
@@ -68,8 +69,17 @@ class TestDirector(ConfigTestCase):
         assert 'http_header_field_manipulation' in nettests
         assert 'traceroute' in nettests
 
-    @patch('ooni.director.TorState', mock_TorState)
-    @patch('ooni.director.launch_tor', mock_launch_tor)
+    def test_net_tests_are_discovered_lazily(self):
+        director = Director()
+        with patch.object(director, 'getNetTests',
+                          return_value={'spam': {}}) as get_net_tests:
+            self.assertEqual(get_net_tests.call_count, 0)
+            self.assertEqual(director.netTests, {'spam': {}})
+            self.assertEqual(director.netTests, {'spam': {}})
+            self.assertEqual(get_net_tests.call_count, 1)
+
+    @patch('txtorcon.TorState', mock_TorState)
+    @patch('txtorcon.launch_tor', mock_launch_tor)
     def test_start_tor(self):
         @defer.inlineCallbacks
         def director_start_tor():
@@ -80,6 +90,16 @@ class TestDirector(ConfigTestCase):
 
         return director_start_tor()
 
+    @defer.inlineCallbacks
+    def test_close_connection_pools_at_shutdown(self):
+        director = Director()
+        with patch('ooni.director.reactor') as reactor, \
+                patch.dict(config.global_options, {'no-geoip': True}):
+            yield director.start()
+            yield director.start()
+        reactor.addSystemEventTrigger.assert_called_once_with(
+            'before', 'shutdown', closeConnectionPools)
+
     def test_run_test_fails_twice(self):
         finished = defer.Deferred()
 
@@ -0,0 +1,131 @@
+from twisted.internet import defer
+from twisted.internet.defer import TimeoutError
+from twisted.python import usage
+from twisted.trial import unittest
+
+from ooni.nettests.blocking.dns_consistency import DNSConsistencyTest
+from ooni.nettests.blocking.dns_consistency import UsageOptions
+
+
+class StubDNSConsistencyTest(DNSConsistencyTest):
+    """
+    Its lookups only complete when told so, with the answers in the answers
+    dict, keyed by (name, resolver address), or a TimeoutError if there is
+    none.
+    """
+    def __init__(self, answers):
+        DNSConsistencyTest.__init__(self)
+        self.answers = answers
+        self.pending = []
+
+        self.report = {'queries': []}
+        self.localOptions = {'concurrency': 20}
+        self.control_dns_server = ('8.8.8.8', 53)
+        self.input = 'example.com'
+
+    def _lookup(self, query_type, name, dns_server, queries):
+        d = defer.Deferred()
+        self.pending.append((query_type, name, dns_server, queries, d))
+        return d
+
+    def performALookup(self, hostname, dns_server=None, use_cache=False,
+                       queries=None):
+        return self._lookup('A', hostname, dns_server, queries)
+
+    def performPTRLookup(self, address, dns_server=None, use_cache=False,
+                         queries=None):
+        return self._lookup('PTR', address, dns_server, queries)
+
+    def complete(self, name, resolver):
+        """
+        Completes the pending lookup of name sent to resolver.
+        """
+        for pending in self.pending:
+            query_type, pending_name, dns_server, queries, d = pending
+            if pending_name == name and dns_server[0] == resolver:
+                break
+        else:
+            raise AssertionError("No lookup of %s to %s" % (name, resolver))
+        self.pending.remove(pending)
+        if queries is None:
+            queries = self.report['queries']
+        queries.append((query_type, name, resolver))
+        answer = self.answers.get((name, resolver))
+        if answer is None:
+            d.errback(TimeoutError())
+        else:
+            d.callback(answer)
+
+
+class TestDNSConsistency(unittest.TestCase):
+    def test_out_of_order(self):
+        dns_test = StubDNSConsistencyTest({
+            ('example.com', '8.8.8.8'): ['93.184.216.34'],
+            ('example.com', '10.0.0.1'): ['93.184.216.34'],
+            ('example.com', '10.0.0.2'): ['10.10.10.10'],
+            ('example.com', '10.0.0.3'): ['93.184.216.34'],
+            ('10.10.10.10', '10.0.0.2'): 'blocked.example.net',
+            ('93.184.216.34', '8.8.8.8'): 'example.com'
+        })
+        dns_test.test_resolvers = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+        d = dns_test.test_a_lookup()
+        dns_test.complete('example.com', '8.8.8.8')
+        # The resolvers are all queried at the same time
+        self.assertEqual(len(dns_test.pending), 3)
+
+        dns_test.complete('example.com', '10.0.0.3')
+        dns_test.complete('example.com', '10.0.0.2')
+        dns_test.complete('example.com', '10.0.0.1')
+        dns_test.complete('10.10.10.10', '10.0.0.2')
+        dns_test.complete('93.184.216.34', '8.8.8.8')
+        self.assertTrue(d.called)
+
+        self.assertEqual(dns_test.report['queries'], [
+            ('A', 'example.com', '8.8.8.8'),
+            ('A', 'example.com', '10.0.0.1'),
+            ('A', 'example.com', '10.0.0.2'),
+            ('PTR', '10.10.10.10', '10.0.0.2'),
+            ('PTR', '93.184.216.34', '8.8.8.8'),
+            ('A', 'example.com', '10.0.0.3')
+        ])
+        self.assertEqual(dns_test.report['successful'],
+                         ['10.0.0.1', '10.0.0.3'])
+        self.assertEqual(dns_test.report['inconsistent'], ['10.0.0.2'])
+        self.assertEqual(dns_test.report['failures'], [])
+        return d
+
+    def test_reverse_lookup_error(self):
+        dns_test = StubDNSConsistencyTest({
+            ('example.com', '8.8.8.8'): ['93.184.216.34'],
+            ('example.com', '10.0.0.1'): ['10.10.10.10'],
+            ('example.com', '10.0.0.2'): ['93.184.216.34']
+        })
+        dns_test.test_resolvers = ['10.0.0.1', '10.0.0.2']
+        d = dns_test.test_a_lookup()
+        dns_test.complete('example.com', '8.8.8.8')
+        dns_test.complete('example.com', '10.0.0.2')
+        dns_test.complete('example.com', '10.0.0.1')
+        dns_test.complete('10.10.10.10', '10.0.0.1')
+        self.failureResultOf(d, TimeoutError)
+
+        # The measurement fails on the first resolver, as it did when they
+        # were queried one after the other.
+        self.assertEqual(dns_test.report['failures'], [])
+        self.assertEqual(dns_test.report['successful'], [])
+        self.assertEqual(dns_test.report['queries'], [
+            ('A', 'example.com', '8.8.8.8'),
+            ('A', 'example.com', '10.0.0.1'),
+            ('PTR', '10.10.10.10', '10.0.0.1')
+        ])
+
+
+class TestUsageOptions(unittest.TestCase):
+    def test_concurrency(self):
+        options = UsageOptions()
+        options.parseOptions(['-c', '5'])
+        self.assertEqual(options['concurrency'], 5)
+
+    def test_invalid_concurrency(self):
+        for concurrency in ('0', 'many'):
+            self.assertRaises(usage.UsageError,
+                              UsageOptions().parseOptions, ['-c', concurrency])
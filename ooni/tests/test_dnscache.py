@@ -0,0 +1,175 @@
+from mock import patch, MagicMock
+
+from twisted.internet import defer, task
+from twisted.names import cache, dns, error, resolve
+from twisted.trial import unittest
+
+from ooni.templates import dnst
+from ooni.utils.dnscache import DNSCache
+
+
+def aRecord(name, address, ttl):
+    return dns.RRHeader(name=name, type=dns.A, ttl=ttl,
+                        payload=dns.Record_A(address, ttl=ttl))
+
+
+def soaRecord(name, ttl, minimum):
+    return dns.RRHeader(name=name, type=dns.SOA, ttl=ttl,
+                        payload=dns.Record_SOA(minimum=minimum, ttl=ttl))
+
+
+class TestDNSCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = DNSCache()
+        self.cache.clock = task.Clock()
+        self.queries = []
+
+    def query(self):
+        d = defer.Deferred()
+        self.queries.append(d)
+        return d
+
+    def lookup(self, key='example.com', bypass=False, stats=None):
+        return self.cache.lookup(key, self.query, bypass=bypass, stats=stats)
+
+    @defer.inlineCallbacks
+    def test_answers_cached_for_their_ttl(self):
+        answers = ([aRecord('example.com', '127.0.0.1', 10),
+                    aRecord('example.com', '127.0.0.2', 30)], [], [])
+        d = self.lookup()
+        self.queries[0].callback(answers)
+        result = yield d
+        self.assertEqual(result, answers)
+
+        result = yield self.lookup()
+        self.assertEqual(result, answers)
+        self.assertEqual(len(self.queries), 1)
+
+        self.cache.clock.advance(10)
+        self.lookup()
+        self.assertEqual(len(self.queries), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    @defer.inlineCallbacks
+    def test_concurrent_lookups_are_coalesced(self):
+        answers = ([aRecord('example.com', '127.0.0.1', 10)], [], [])
+        lookups = [self.lookup() for _ in range(3)]
+        self.assertEqual(len(self.queries), 1)
+        self.queries[0].callback(answers)
+        results = yield defer.gatherResults(lookups)
+        self.assertEqual(results, [answers] * 3)
+        self.assertEqual(self.cache.coalesced, 2)
+
+    def test_bypass(self):
+        stats = {}
+        self.lookup(stats=stats)
+        self.lookup(bypass=True, stats=stats)
+        self.queries[0].callback(
+            ([aRecord('example.com', '127.0.0.1', 10)], [], []))
+        self.lookup(bypass=True, stats=stats)
+        self.assertEqual(len(self.queries), 3)
+        self.assertEqual(stats, {'misses': 1, 'bypassed': 2})
+
+    @defer.inlineCallbacks
+    def test_negative_answers(self):
+        message = dns.Message(rCode=dns.ENAME)
+        message.authority = [soaRecord('example.com', 300, 5)]
+        d = self.lookup()
+        self.queries[0].errback(error.DNSNameError(message))
+        yield self.assertFailure(d, error.DNSNameError)
+        yield self.assertFailure(self.lookup(), error.DNSNameError)
+        self.assertEqual(len(self.queries), 1)
+
+        self.cache.clock.advance(5)
+        self.lookup()
+        self.assertEqual(len(self.queries), 2)
+
+    @defer.inlineCallbacks
+    def test_timeouts_are_not_cached(self):
+        lookups = [self.lookup(), self.lookup()]
+        self.queries[0].errback(defer.TimeoutError())
+        for d in lookups:
+            yield self.assertFailure(d, defer.TimeoutError)
+        self.lookup()
+        self.assertEqual(len(self.queries), 2)
+
+
+class TestDNSTestCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = DNSCache()
+        patcher = patch('ooni.templates.dnst.dns_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        message = dns.Message()
+        message.answers = [aRecord('example.com', '93.184.216.34', 60)]
+        resolver = MagicMock()
+        resolver.queryUDP.side_effect = lambda *args, **kw: defer.succeed(message)
+        patcher = patch('ooni.templates.dnst.Resolver',
+                        return_value=resolver)
+        self.resolver = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @defer.inlineCallbacks
+    def test_lookups_are_cached(self):
+        dns_test = dnst.DNSTest()
+        dns_test._setUp()
+        dns_test.summary = {}
+        dns_server = ('8.8.8.8', 53)
+        for _ in range(2):
+            result = yield dns_test.performALookup('example.com', dns_server,
+                                                   use_cache=True)
+            self.assertEqual(result, ['93.184.216.34'])
+        result = yield dns_test.performALookup('example.com', dns_server)
+        self.assertEqual(result, ['93.184.216.34'])
+
+        self.assertEqual(self.resolver.call_count, 2)
+        self.assertEqual(len(dns_test.report['queries']), 3)
+        self.assertEqual(dns_test.summary['dns_cache'],
+                         {'misses': 1, 'hits': 1, 'bypassed': 1})
+        self.assertNotIn('dns_cache', dns_test.report)
+
+    @defer.inlineCallbacks
+    def test_lookups_are_not_cached_by_default(self):
+        dns_test = dnst.DNSTest()
+        dns_test._setUp()
+        dns_server = ('8.8.8.8', 53)
+        for _ in range(2):
+            yield dns_test.performALookup('example.com', dns_server)
+        self.assertEqual(self.resolver.call_count, 2)
+        self.assertNotIn('dns_cache', dns_test.report)
+
+    @defer.inlineCallbacks
+    def test_case_is_not_folded(self):
+        # Some tests randomise the case of the names to detect tampering
+        dns_test = dnst.DNSTest()
+        dns_test._setUp()
+        dns_server = ('8.8.8.8', 53)
+        for hostname in ('example.com', 'ExAmPlE.cOm'):
+            yield dns_test.performALookup(hostname, dns_server,
+                                          use_cache=True)
+        self.assertEqual(self.resolver.call_count, 2)
+
+    @defer.inlineCallbacks
+    def test_system_resolver(self):
+        answers = ([aRecord('example.com', '93.184.216.34', 60)], [], [])
+        dns_test = dnst.DNSTest()
+        dns_test._setUp()
+        with patch('ooni.templates.dnst.systemResolver') as system_resolver:
+            system_resolver.return_value.lookupAddress.side_effect = \
+                lambda hostname: defer.succeed(answers)
+            result = yield dns_test.performALookup('example.com')
+            self.assertEqual(result, ['93.184.216.34'])
+            # The cache of Twisted is only left out when dns_cache is used
+            system_resolver.assert_called_with(bypass_cache=False)
+            yield dns_test.performALookup('example.com', use_cache=True)
+            system_resolver.assert_called_with(bypass_cache=True)
+
+    def test_system_resolver_chain(self):
+        resolvers = [cache.CacheResolver(), MagicMock()]
+        with patch('ooni.templates.dnst.client.getResolver',
+                   return_value=resolve.ResolverChain(resolvers)):
+            self.assertEqual(dnst.systemResolver().resolvers, resolvers)
+            self.assertEqual(
+                dnst.systemResolver(bypass_cache=True).resolvers,
+                resolvers[1:])
@@ -0,0 +1,97 @@
+from twisted.internet import defer, protocol, reactor, task
+from twisted.names import dns, error
+from twisted.trial import unittest
+
+from ooni.templates import dnst
+from ooni.utils.dnsengine import DNSEngine, dns_engine
+
+
+class StandInServer(protocol.DatagramProtocol):
+    """
+    Answers every A query with 127.0.0.1, once it has received them all, in
+    the reverse order.
+    """
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = []
+        self.wrongQuestion = False
+        self.dropped = False
+
+    def datagramReceived(self, data, addr):
+        if self.dropped:
+            return
+        message = dns.Message()
+        message.fromStr(data)
+        self.received.append((message, addr))
+        if len(self.received) < self.expected:
+            return
+        for message, addr in reversed(self.received):
+            if self.wrongQuestion:
+                self.transport.write(self.answer(message, 'wrong.example.com'),
+                                     addr)
+            self.transport.write(self.answer(message), addr)
+
+    def answer(self, message, name=None):
+        answer = dns.Message(message.id, answer=1)
+        if name is None:
+            name = str(message.queries[0].name)
+        answer.queries = [dns.Query(name, dns.A, dns.IN)]
+        answer.answers = [dns.RRHeader(name=name, type=dns.A,
+                                       payload=dns.Record_A('127.0.0.1'))]
+        return answer.toStr()
+
+
+class TestDNSEngine(unittest.TestCase):
+    def setUp(self):
+        self.engine = DNSEngine()
+        self.server = StandInServer(1)
+        self.port = reactor.listenUDP(0, self.server, interface='127.0.0.1')
+        self.address = ('127.0.0.1', self.port.getHost().port)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.engine.stop()
+        yield self.port.stopListening()
+
+    def query(self, name, timeout=(5,)):
+        return self.engine.query([dns.Query(name, dns.A, dns.IN)],
+                                 self.address, timeout=timeout)
+
+    @defer.inlineCallbacks
+    def test_queries(self):
+        self.server.expected = 200
+        names = ['%d.example.com' % idx for idx in range(200)]
+        messages = yield defer.gatherResults(map(self.query, names))
+        self.assertEqual([str(message.answers[0].name)
+                          for message in messages], names)
+        self.assertEqual(len(set(addr for _, addr in self.server.received)),
+                         self.engine.sockets)
+        self.assertEqual(self.engine.outstanding, 0)
+
+    @defer.inlineCallbacks
+    def test_response_for_another_question(self):
+        self.server.wrongQuestion = True
+        message = yield self.query('example.com')
+        self.assertEqual(str(message.queries[0].name), 'example.com')
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        self.engine.clock = task.Clock()
+        self.server.dropped = True
+        d = self.query('example.com', timeout=(1, 3))
+        self.engine.clock.advance(1)
+        self.assertEqual(self.engine.outstanding, 1)
+        self.engine.clock.pump([0.1] * 40)
+        self.assertEqual(self.engine.outstanding, 0)
+        yield self.assertFailure(d, error.DNSQueryTimeoutError)
+
+    @defer.inlineCallbacks
+    def test_dns_test_backend(self):
+        self.addCleanup(dns_engine.stop)
+        dns_test = dnst.DNSTest()
+        dns_test._setUp()
+        dns_test.dnsBackend = 'engine'
+        answers = yield dns_test.performALookup('example.com', self.address)
+        self.assertEqual(answers, ['127.0.0.1'])
+        self.assertEqual(dns_test.report['queries'][0]['answers'],
+                         [{'answer_type': 'A', 'ipv4': '127.0.0.1'}])
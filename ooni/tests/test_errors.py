@@ -1,3 +1,6 @@
+import sys
+
+from twisted.python.failure import Failure
 from twisted.trial import unittest
 
 import ooni.errors
@@ -12,9 +15,26 @@ class TestErrors(unittest.TestCase):
         Fails if a subclass is listed after its parent Failure.
         """
 
+        import txsocksx.errors
+        known_failures = ooni.errors.knownFailures()
+
         # Check each Failure against all subsequent failures
-        for index, (failure, _) in enumerate(ooni.errors.known_failures):
-            for sub_failure, _ in ooni.errors.known_failures[index+1:]:
+        for index, (failure, _) in enumerate(known_failures):
+            for sub_failure, _ in known_failures[index+1:]:
 
                 # Fail if subsequent Failure inherits from the current Failure
                 self.assertNotIsInstance(sub_failure(None), failure)
+
+    def test_socks_failures(self):
+        from txsocksx.errors import HostUnreachable
+        failure = Failure(HostUnreachable())
+        self.assertEqual(ooni.errors.failureToString(failure),
+                         'socks_host_unreachable')
+        self.assertEqual(ooni.errors.handleAllFailures(failure),
+                         'socks_host_unreachable')
+
+    def test_socks_failures_without_txsocksx(self):
+        self.patch(sys, 'modules', dict(sys.modules))
+        sys.modules.pop('txsocksx.errors', None)
+        self.assertEqual(ooni.errors.knownFailures(),
+                         ooni.errors.known_failures)
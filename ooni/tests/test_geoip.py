@@ -1,7 +1,14 @@
+import os
+import shutil
+import tempfile
 
-from twisted.internet import defer
+from mock import patch
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
 
 from ooni.tests import is_internet_connected, bases
+from ooni.settings import config
 from ooni import geoip
 
 
@@ -31,3 +38,106 @@ class TestGeoIP(bases.ConfigTestCase):
         assert isinstance(version['GeoIP']['timestamp'], float)
         assert len(version['GeoIPASNum']['sha256']) == 64
         assert isinstance(version['GeoIPASNum']['timestamp'], float)
+
+
+class FakeGeoIP(object):
+    def __init__(self, path):
+        self.path = path
+        self.lookups = 0
+
+    def country_code_by_addr(self, address):
+        self.lookups += 1
+        return 'IT'
+
+    def org_by_addr(self, address):
+        self.lookups += 1
+        return 'AS1234 Example ISP'
+
+
+class TestIPLocator(unittest.TestCase):
+    def setUp(self):
+        self.data_directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.data_directory, 'GeoIP'))
+        for file_name in ('GeoIP.dat', 'GeoIPASNum.dat'):
+            self.writeDatabase(file_name, 'data')
+
+        self.opened = []
+
+        def open_database(path):
+            self.opened.append(path)
+            return FakeGeoIP(path)
+
+        def data_file_path(file_name):
+            path = os.path.join(self.data_directory, file_name)
+            if os.path.isfile(path):
+                return path
+
+        self.patches = [
+            patch('ooni.geoip.GeoIP', open_database),
+            patch.object(config, 'get_data_file_path', data_file_path)
+        ]
+        for p in self.patches:
+            p.start()
+
+        self.locator = geoip.IPLocator()
+        self.locator.clock = task.Clock()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.data_directory)
+
+    def writeDatabase(self, file_name, content):
+        path = os.path.join(self.data_directory, 'GeoIP', file_name)
+        # Replace the file like ooniresources does
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(path + '.tmp', path)
+
+    def test_lookup(self):
+        location = self.locator.lookup('8.8.8.8')
+        self.assertEqual(location, {'city': None, 'countrycode': 'IT',
+                                    'asn': 'AS1234'})
+
+        location['asn'] = 'AS0'
+        self.assertEqual(self.locator.lookup('8.8.8.8')['asn'], 'AS1234')
+        self.assertEqual(self.locator.countryDatabase.handle.lookups, 1)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_lookup_many(self):
+        locations = self.locator.lookupMany(['8.8.8.8', '8.8.4.4'])
+        self.assertEqual(set(locations.keys()), set(['8.8.8.8', '8.8.4.4']))
+        self.assertEqual(locations['8.8.4.4']['countrycode'], 'IT')
+
+    def test_cache_size(self):
+        self.locator.cacheSize = 2
+        self.locator.lookupMany(['1.1.1.1', '2.2.2.2'])
+        # 1.1.1.1 is now the most recently used address
+        self.locator.lookup('1.1.1.1')
+        self.locator.lookup('3.3.3.3')
+        handle = self.locator.countryDatabase.handle
+        self.assertEqual(handle.lookups, 3)
+
+        self.locator.lookup('1.1.1.1')
+        self.assertEqual(handle.lookups, 3)
+        self.locator.lookup('2.2.2.2')
+        self.assertEqual(handle.lookups, 4)
+
+    def test_reload_replaced_database(self):
+        self.locator.lookup('8.8.8.8')
+        self.writeDatabase('GeoIPASNum.dat', 'new data')
+
+        self.locator.lookup('8.8.8.8')
+        self.assertEqual(len(self.opened), 2)
+
+        self.locator.clock.advance(self.locator.checkInterval)
+        self.locator.lookup('8.8.8.8')
+        self.assertEqual(len(self.opened), 3)
+        self.assertEqual(self.locator.asnDatabase.handle.lookups, 1)
+
+    def test_missing_database(self):
+        os.remove(os.path.join(self.data_directory, 'GeoIP', 'GeoIP.dat'))
+        self.locator.reload()
+        location = self.locator.lookup('8.8.8.8')
+        self.assertEqual(location, {'city': None, 'countrycode': 'ZZ',
+                                    'asn': 'AS0'})
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from twisted.trial import unittest
+
+from ooni.utils.importprofiler import ImportProfiler, profileStartup
+
+
+class TestImportProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'profiled_outer.py'), 'w') as f:
+            f.write("import profiled_inner\n")
+        with open(os.path.join(self.directory, 'profiled_inner.py'), 'w') as f:
+            f.write("import time\ntime.sleep(0.05)\n")
+        sys.path.insert(0, self.directory)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        for module_name in ('profiled_outer', 'profiled_inner'):
+            sys.modules.pop(module_name, None)
+        shutil.rmtree(self.directory)
+
+    def test_import_times(self):
+        profiler = ImportProfiler()
+        profiler.install()
+        try:
+            __import__('profiled_outer')
+        finally:
+            profiler.uninstall()
+
+        self.assertTrue(profiler.own['profiled_inner'] >= 0.05)
+        self.assertTrue(profiler.cumulative['profiled_outer'] >= 0.05)
+        self.assertTrue(profiler.own['profiled_outer'] < 0.05)
+
+        output = StringIO()
+        profiler.report(output)
+        self.assertIn('profiled_outer', output.getvalue())
+
+    def test_uninstall(self):
+        profiler = ImportProfiler()
+        profiler.install()
+        profiler.uninstall()
+        __import__('profiled_outer')
+        self.assertEqual(profiler.cumulative, {})
+
+    def test_profile_startup_only_when_asked(self):
+        self.assertEqual(profileStartup(['ooniprobe', '-s']), None)
+        profiler = profileStartup(['ooniprobe', '--profile-startup'])
+        profiler.uninstall()
+        self.assertIsInstance(profiler, ImportProfiler)
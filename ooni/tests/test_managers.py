@@ -3,14 +3,15 @@ import os
 from twisted.trial import unittest
 from twisted.internet import defer, task
 
-from ooni.managers import MeasurementManager
+from ooni.managers import MeasurementManager, AIMDController, HostScheduler
 
 from ooni.tests.mocks import MockSuccessTask, MockFailTask, MockFailOnceTask, MockFailure
 from ooni.tests.mocks import MockSuccessTaskWithTimeout, MockFailTaskThatTimesOut
 from ooni.tests.mocks import MockTimeoutOnceTask, MockFailTaskWithTimeout
 from ooni.tests.mocks import MockTaskManager, mockFailure, MockDirector
 from ooni.tests.mocks import MockNetTest, MockSuccessMeasurement
-from ooni.tests.mocks import MockFailMeasurement
+from ooni.tests.mocks import MockFailMeasurement, MockTimeoutOnceMeasurement
+from ooni.tests.mocks import MockFailOnceMeasurement
 from ooni.settings import config
 
 
@@ -196,13 +197,64 @@ class TestTaskManager(unittest.TestCase):
 
         return d
 
+    def test_schedule_many_synchronous_tasks(self):
+        # Tasks that complete synchronously must not make the call stack grow
+        # with the number of scheduled tasks.
+        number = 5000
+        self.measurementManager.schedule(
+            MockSuccessTask() for _ in range(number))
+        self.assertEqual(len(self.measurementManager.successes), number)
+        self.assertEqual(self.measurementManager.availableSlots,
+                         self.measurementManager.concurrency)
+
+    def test_retry_backoff(self):
+        self.measurementManager.retryBackoff = 10
+        self.measurementManager.clock = self.clock
+
+        mock_task = MockFailOnceTask()
+        self.measurementManager.schedule(mock_task)
+
+        self.assertEqual(self.measurementManager.failures, 1)
+        self.assertEqual(self.measurementManager.pendingRetries, 1)
+        self.assertFalse(mock_task.done.called)
+
+        self.clock.advance(9)
+        self.assertFalse(mock_task.done.called)
+
+        self.clock.advance(1)
+        self.assertEqual(self.measurementManager.pendingRetries, 0)
+        self.assertEqual(self.measurementManager.successes,
+                         [(42, mock_task)])
+        return mock_task.done
+
+    def test_retries_run_before_new_tasks(self):
+        self.measurementManager.concurrency = 1
+        self.measurementManager.retryBackoff = 10
+        self.measurementManager.clock = self.clock
+
+        blocking_task = MockFailTaskThatTimesOut()
+        blocking_task.clock = self.clock
+        retried_task = MockFailOnceTask()
+        fresh_task = MockSuccessTask()
+        self.measurementManager.schedule([retried_task, blocking_task,
+                                          fresh_task])
+        self.assertEqual(self.measurementManager.pendingRetries, 1)
+
+        # The retry becomes due while the blocking task is holding the only
+        # slot, once it times out the retry must run before the fresh task.
+        self.measurementManager.retries = 0
+        self.clock.advance(blocking_task.timeout)
+        self.assertEqual(self.measurementManager.successes,
+                         [(42, retried_task), (42, fresh_task)])
+        blocking_task.done.addErrback(lambda x: None)
+
 
 class TestMeasurementManager(unittest.TestCase):
     def setUp(self):
-        mock_director = MockDirector()
+        self.mockDirector = MockDirector()
 
         self.measurementManager = MeasurementManager()
-        self.measurementManager.director = mock_director
+        self.measurementManager.director = self.mockDirector
 
         self.measurementManager.concurrency = 10
         self.measurementManager.retries = 2
@@ -238,3 +290,155 @@ class TestMeasurementManager(unittest.TestCase):
             self.assertEqual(len(self.mockNetTest.successes), 0)
 
         return mock_task.done
+
+    def test_adaptive_concurrency_timed_out(self):
+        self.measurementManager.controller = AIMDController(10, 2, 20)
+        self.measurementManager.retries = 0
+
+        clock = task.Clock()
+        mock_task = MockTimeoutOnceMeasurement(self.mockNetTest)
+        mock_task.clock = clock
+        mock_task.timeout = 5
+        self.measurementManager.schedule(mock_task)
+        clock.advance(5)
+
+        self.assertEqual(self.measurementManager.concurrency, 5)
+        self.assertEqual(self.mockDirector.timedOut, [mock_task])
+        mock_task.done.addErrback(lambda x: None)
+        return mock_task.done
+
+    def test_adaptive_concurrency_attempt_latency(self):
+        latencies = []
+
+        class Controller(AIMDController):
+            def succeeded(self, latency):
+                latencies.append(latency)
+                AIMDController.succeeded(self, latency)
+
+        self.measurementManager.controller = Controller(10, 2, 20)
+        self.measurementManager.clock = task.Clock()
+        self.measurementManager.retryBackoff = 10
+
+        mock_task = MockFailOnceMeasurement(self.mockNetTest)
+        self.measurementManager.schedule(mock_task)
+        # As if the first attempt had been made long ago
+        mock_task.startTime -= 100
+        self.measurementManager.clock.advance(10)
+
+        self.assertEqual(len(latencies), 1)
+        self.assertTrue(latencies[0] < 100)
+        self.assertTrue(mock_task.runtime >= 100)
+        return mock_task.done
+
+
+class TestAIMDController(unittest.TestCase):
+    def test_additive_increase(self):
+        controller = AIMDController(4, 1, 6)
+        for _ in range(4):
+            controller.succeeded(1)
+        self.assertEqual(controller.slots, 4)
+        controller.succeeded(1)
+        self.assertEqual(controller.slots, 5)
+        for _ in range(100):
+            controller.succeeded(1)
+        self.assertEqual(controller.slots, 6)
+
+    def test_multiplicative_decrease_once_per_round(self):
+        controller = AIMDController(16, 2, 32)
+        controller.timedOut()
+        self.assertEqual(controller.slots, 8)
+        # Further timeouts within the same round are ignored.
+        controller.timedOut()
+        controller.timedOut()
+        self.assertEqual(controller.slots, 8)
+
+        for _ in range(8):
+            controller.timedOut()
+        self.assertEqual(controller.slots, 4)
+
+        for _ in range(100):
+            controller.timedOut()
+        self.assertEqual(controller.slots, 2)
+
+    def test_failure_ratio(self):
+        controller = AIMDController(4, 1, 10)
+        controller.failed()
+        controller.failed()
+        controller.succeeded(1)
+        controller.succeeded(1)
+        self.assertEqual(controller.slots, 2)
+
+    def test_latency_increase(self):
+        controller = AIMDController(8, 1, 10)
+        controller.succeeded(1)
+        self.assertEqual(controller.slots, 8)
+        for _ in range(20):
+            controller.succeeded(10)
+        self.assertTrue(controller.slots < 8)
+
+
+class TestHostScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.taskManager = MockTaskManager()
+        self.taskManager.concurrency = 10
+
+    def makeTasks(self, task_type, hosts):
+        tasks = []
+        for host in hosts:
+            mock_task = task_type()
+            mock_task.host = host
+            tasks.append(mock_task)
+        return tasks
+
+    def makeScheduler(self, tasks, **kw):
+        scheduler = HostScheduler(tasks, lambda t: t.host, **kw)
+        scheduler.clock = self.clock
+        scheduler.onReady = self.taskManager.wakeUp
+        return scheduler
+
+    def test_interleave_by_host(self):
+        tasks = self.makeTasks(MockSuccessTask, ['a', 'a', 'a', 'b', 'b', 'c'])
+        scheduler = self.makeScheduler(tasks, concurrency=10)
+        order = [t.host for t in scheduler]
+        self.assertEqual(order, ['a', 'b', 'c', 'a', 'b', 'a'])
+        self.assertEqual(scheduler.summary['destinations'], 3)
+
+    def test_per_host_concurrency(self):
+        tasks = self.makeTasks(MockFailTaskThatTimesOut, ['a'] * 5 + ['b'])
+        for mock_task in tasks:
+            mock_task.clock = self.clock
+            mock_task.done.addErrback(lambda x: None)
+        scheduler = self.makeScheduler(tasks, concurrency=2)
+        self.taskManager.retries = 0
+        self.taskManager.schedule(scheduler)
+
+        self.assertEqual(len(self.taskManager._active_tasks), 3)
+        self.assertEqual(scheduler.maxActivePerDestination, 2)
+        self.assertTrue(scheduler.throttled > 0)
+
+        # Once the running tasks time out the remaining ones are started.
+        self.clock.advance(tasks[0].timeout)
+        self.assertEqual(len(self.taskManager._active_tasks), 2)
+        self.clock.advance(tasks[0].timeout)
+        self.assertEqual(len(self.taskManager._active_tasks), 1)
+        self.clock.advance(tasks[0].timeout)
+        self.assertEqual(len(self.taskManager._active_tasks), 0)
+        self.assertEqual(scheduler.maxActivePerDestination, 2)
+
+    def test_per_host_rate(self):
+        tasks = self.makeTasks(MockSuccessTask, ['a'] * 3 + ['b'])
+        scheduler = self.makeScheduler(tasks, rate=0.5, burst=1)
+        self.taskManager.schedule(scheduler)
+        self.assertEqual([t.host for _, t in self.taskManager.successes],
+                         ['a', 'b'])
+        # The time spent throttled is not part of the runtime
+        self.assertIs(tasks[1].startTime, None)
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.taskManager.successes), 2)
+        self.clock.advance(1)
+        self.assertEqual(len(self.taskManager.successes), 3)
+        self.clock.advance(2)
+        self.assertEqual(len(self.taskManager.successes), 4)
+        self.assertFalse(self.clock.getDelayedCalls())
@@ -1,5 +1,9 @@
 import os
-from tempfile import mkstemp
+import sys
+import shutil
+from tempfile import mkstemp, mkdtemp
+
+from mock import patch
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
@@ -7,7 +11,8 @@ from twisted.python.usage import UsageError
 
 from ooni.settings import config
 from ooni.errors import MissingRequiredOption, OONIUsageError, IncoherentOptions
-from ooni.nettest import NetTest, NetTestLoader
+from ooni.nettest import NetTest, NetTestLoader, NetTestCase
+from ooni.nettest import NetTestInformationCache, getNetTestInformation
 
 from ooni.director import Director
 
@@ -283,6 +288,47 @@ class TestNetTest(unittest.TestCase):
         measurements = list(net_test.generateMeasurements())
         self.assertEqual(len(measurements), 20)
 
+    @defer.inlineCallbacks
+    def test_measurement_source_with_host_limits(self):
+        ntl = NetTestLoader(dummyArgsWithFile)
+        ntl.loadNetTestString(net_test_string_with_file)
+        ntl.checkOptions()
+
+        net_test = NetTest(ntl.getTestCases(), ntl.getTestDetails(), None)
+        yield net_test.initialize()
+        self.assertEqual(len(list(net_test.measurementSource())), 20)
+        self.assertEqual(net_test.hostScheduler, None)
+
+        # Every input has two measurements towards the same destination
+        net_test.testCases[0][0].perHostConcurrency = 2
+        yield net_test.initialize()
+        measurements = list(net_test.measurementSource())
+        self.assertEqual(len(measurements), 20)
+        self.assertEqual(net_test.hostScheduler.summary['destinations'], 10)
+
+    @defer.inlineCallbacks
+    def test_measurement_source_with_shard(self):
+        ntl = NetTestLoader(dummyArgsWithFile)
+        ntl.loadNetTestString(net_test_string_with_file)
+        ntl.checkOptions()
+
+        net_test = NetTest(ntl.getTestCases(), ntl.getTestDetails(), None)
+        net_test.shard = (1, 3)
+        yield net_test.initialize()
+        measurements = list(net_test.measurementSource())
+        self.assertEqual([m.testInstance.input for m in measurements],
+                         ['1', '1', '4', '4', '7', '7'])
+
+    def test_destination_for_input(self):
+        test_case = NetTestCase()
+        self.assertEqual(test_case.destinationForInput(
+            'http://www.example.com:8080/path'), 'www.example.com')
+        self.assertEqual(test_case.destinationForInput('example.com:80'),
+                         'example.com')
+        self.assertEqual(test_case.destinationForInput('example.com'),
+                         'example.com')
+        self.assertEqual(test_case.destinationForInput(None), None)
+
     def test_net_test_completed_callback(self):
         ntl = NetTestLoader(dummyArgsWithFile)
         ntl.loadNetTestString(net_test_string_with_file)
@@ -363,3 +409,55 @@ class TestNettestTimeout(ConfigTestCase):
             assert director.failedMeasurements == 1
 
         return d
+
+
+class TestNetTestInformationCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.cache_file = os.path.join(self.directory, 'nettests.json')
+        self.net_test_file = os.path.join(self.directory, 'cached_dummy.py')
+        with open(self.net_test_file, 'w') as f:
+            f.write(net_test_string)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def getInformation(self):
+        cache = NetTestInformationCache(self.cache_file)
+        with patch('ooni.nettest.getNetTestInformation',
+                   side_effect=getNetTestInformation) as loader:
+            information = cache.get(self.net_test_file)
+        # So that the next import reads the file again
+        sys.modules.pop('cached_dummy', None)
+        cache.save()
+        return information, loader.call_count
+
+    def test_cache_hit(self):
+        information, imports = self.getInformation()
+        self.assertEqual(imports, 1)
+        self.assertEqual(information['id'], 'cached_dummy')
+        self.assertIn('spam', information['arguments'])
+
+        cached_information, imports = self.getInformation()
+        self.assertEqual(imports, 0)
+        self.assertEqual(cached_information, information)
+
+    def test_cache_touched_file(self):
+        self.getInformation()
+        os.utime(self.net_test_file, (0, 0))
+        _, imports = self.getInformation()
+        self.assertEqual(imports, 0)
+
+    def test_cache_modified_file(self):
+        self.getInformation()
+        with open(self.net_test_file, 'a') as f:
+            f.write("    name = 'Modified'\n")
+        information, imports = self.getInformation()
+        self.assertEqual(imports, 1)
+        self.assertEqual(information['name'], 'Modified')
+
+    def test_cache_corrupted(self):
+        with open(self.cache_file, 'w') as f:
+            f.write('{')
+        _, imports = self.getInformation()
+        self.assertEqual(imports, 1)
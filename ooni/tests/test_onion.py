@@ -15,6 +15,14 @@ class TestOnion(unittest.TestCase):
         assert isinstance(onion.tor_details, dict)
         assert onion.tor_details['version']
         assert onion.tor_details['binary']
+    def test_lazy_details(self):
+        find_details = Mock(return_value={'binary': '/fakebin',
+                                          'version': '1.0'})
+        details = onion.LazyDetails(find_details)
+        self.assertEqual(find_details.call_count, 0)
+        self.assertEqual(details['binary'], '/fakebin')
+        self.assertEqual(details['version'], '1.0')
+        self.assertEqual(find_details.call_count, 1)
     def test_transport_dicts(self):
         self.assertEqual( set(onion.transport_bin_name.keys()),
                           set(onion._transport_line_templates.keys()) )
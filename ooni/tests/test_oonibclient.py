@@ -1,13 +1,17 @@
 import os
+import json
 import shutil
 import socket
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.web import error
 
 from ooni import errors as e
 from ooni.settings import config
 from ooni.backend_client import CollectorClient, BouncerClient
+from ooni.backend_client import closeConnectionPools, WebConnectivityClient
+from ooni.backend_client import getControlBatcher
+from ooni import backend_client
 from ooni.tests.bases import ConfigTestCase
 
 input_id = '37e60e13536f6afe47a830bfb6b371b5cf65da66d7ad65137344679b24fdccd1'
@@ -142,3 +146,158 @@ class TestOONIBClient(ConfigTestCase):
 
         res = yield self.collector_client.queryBackend('POST', '/report/' + report_id +
                                         '/close')
+
+
+class TestConnectionPool(ConfigTestCase):
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        from twisted.internet import reactor
+        from twisted.web import resource, server
+
+        class Status(resource.Resource):
+            isLeaf = True
+
+            def render_GET(self, request):
+                return '{"status": "ok"}'
+
+        self.port = reactor.listenTCP(0, server.Site(Status()),
+                                      interface='127.0.0.1')
+        self.address = 'http://127.0.0.1:%d' % self.port.getHost().port
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield closeConnectionPools()
+        yield self.port.stopListening()
+        super(TestConnectionPool, self).tearDown()
+
+    @defer.inlineCallbacks
+    def test_connection_reuse(self):
+        collector_client = CollectorClient(self.address)
+        for _ in range(3):
+            response = yield collector_client.queryBackend('GET', '/status')
+            self.assertEqual(response['status'], 'ok')
+        self.assertEqual(collector_client.connectionPoolStats,
+                         {'hits': 2, 'misses': 1})
+
+        # Clients of the same backend share the pool
+        bouncer_client = BouncerClient(self.address)
+        yield bouncer_client.queryBackend('GET', '/status')
+        self.assertEqual(bouncer_client.connectionPoolStats['hits'], 3)
+
+
+class TestControlRequestBatcher(ConfigTestCase):
+    def setUp(self):
+        super(TestControlRequestBatcher, self).setUp()
+        from twisted.internet import reactor
+        from twisted.web import resource, server
+
+        class StandInHelper(resource.Resource):
+            isLeaf = True
+            batchControl = True
+            statusErrors = 0
+
+            def __init__(self):
+                resource.Resource.__init__(self)
+                self.requests = []
+
+            def control(self, request):
+                if request['http_request'] == 'http://invalid/':
+                    return {'error': 'invalid-request'}
+                return {'http_request': {'url': request['http_request']}}
+
+            def render_GET(self, request):
+                self.requests.append(request.path)
+                if self.statusErrors > 0:
+                    self.statusErrors -= 1
+                    request.setResponseCode(500)
+                    return 'Internal Server Error'
+                return json.dumps({'status': 'ok',
+                                   'batch_control': self.batchControl})
+
+            def render_POST(self, request):
+                self.requests.append(request.path)
+                body = json.loads(request.content.read())
+                if request.path == '/batch':
+                    return json.dumps({'responses': map(self.control,
+                                                        body['requests'])})
+                return json.dumps(self.control(body))
+
+        self.helper = StandInHelper()
+        self.port = reactor.listenTCP(0, server.Site(self.helper),
+                                      interface='127.0.0.1')
+        self.address = 'http://127.0.0.1:%d' % self.port.getHost().port
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        backend_client._control_batchers.clear()
+        yield closeConnectionPools()
+        yield self.port.stopListening()
+        super(TestControlRequestBatcher, self).tearDown()
+
+    def control(self, urls):
+        # Every measurement has its own client
+        return defer.gatherResults([
+            WebConnectivityClient(self.address).control(url, [])
+            for url in urls
+        ])
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        urls = ['http://example.com/%d' % idx for idx in range(3)]
+        controls = yield self.control(urls)
+        self.assertEqual([c['http_request']['url'] for c in controls], urls)
+        self.assertEqual(self.helper.requests, ['/status', '/batch'])
+
+        controls = yield self.control(urls[:1])
+        self.assertEqual(controls[0]['http_request']['url'], urls[0])
+        self.assertEqual(self.helper.requests,
+                         ['/status', '/batch', '/batch'])
+
+    @defer.inlineCallbacks
+    def test_batch_size(self):
+        config.advanced.control_batch_size = 2
+        yield self.control(['http://example.com/%d' % idx
+                            for idx in range(5)])
+        self.assertEqual(self.helper.requests.count('/batch'), 3)
+
+    @defer.inlineCallbacks
+    def test_batch_error(self):
+        client = WebConnectivityClient(self.address)
+        valid = client.control('http://example.com/', [])
+        invalid = client.control('http://invalid/', [])
+        yield self.assertFailure(invalid, e.OONIBInvalidRequest)
+        control = yield valid
+        self.assertEqual(control['http_request']['url'],
+                         'http://example.com/')
+
+    @defer.inlineCallbacks
+    def test_batch_unsupported(self):
+        self.helper.batchControl = False
+        urls = ['http://example.com/%d' % idx for idx in range(3)]
+        controls = yield self.control(urls)
+        self.assertEqual([c['http_request']['url'] for c in controls], urls)
+        self.assertEqual(self.helper.requests, ['/status', '/', '/', '/'])
+
+    @defer.inlineCallbacks
+    def test_batch_support_check_failed(self):
+        self.helper.statusErrors = 1
+        batcher = getControlBatcher(WebConnectivityClient(self.address))
+        batcher.clock = task.Clock()
+        batcher.batchSize = 3
+        urls = ['http://example.com/%d' % idx for idx in range(3)]
+
+        controls = yield self.control(urls)
+        self.assertEqual([c['http_request']['url'] for c in controls], urls)
+        self.assertEqual(self.helper.requests, ['/status', '/', '/', '/'])
+        self.assertIs(batcher.supported, None)
+
+        self.helper.requests = []
+        yield self.control(urls)
+        self.assertEqual(self.helper.requests, ['/', '/', '/'])
+
+        # Once supportRetryInterval has passed the support is checked again
+        self.helper.requests = []
+        batcher.clock.advance(batcher.supportRetryInterval)
+        yield self.control(urls)
+        self.assertEqual(self.helper.requests, ['/status', '/batch'])
+        self.assertTrue(batcher.supported)
@@ -0,0 +1,109 @@
+import os
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ooni.utils.reachability import ReachabilityCache, first_reachable
+
+
+class MockClient(object):
+    def __init__(self):
+        self.checks = []
+        self.cancelled = 0
+
+    def isReachable(self):
+        d = defer.Deferred(self.cancel)
+        self.checks.append(d)
+        return d
+
+    def cancel(self, d):
+        self.cancelled += 1
+
+
+class TestFirstReachable(unittest.TestCase):
+    def setUp(self):
+        self.clients = [MockClient() for _ in range(3)]
+        self.candidates = [('backend %d' % idx, client)
+                           for idx, client in enumerate(self.clients)]
+        self.cache = ReachabilityCache(path='reachability.json', ttl=60)
+        self.cache.clock = task.Clock()
+
+    def tearDown(self):
+        if os.path.exists('reachability.json'):
+            os.remove('reachability.json')
+
+    def test_checks_at_the_same_time(self):
+        d = first_reachable('backend', self.candidates)
+        self.assertEqual([len(client.checks) for client in self.clients],
+                         [1, 1, 1])
+        # The least preferred one answering first is not enough
+        self.clients[2].checks[0].callback(True)
+        self.assertFalse(d.called)
+        self.clients[1].checks[0].callback(True)
+        self.assertFalse(d.called)
+        self.clients[0].checks[0].callback(False)
+        self.assertIs(self.successResultOf(d), self.clients[1])
+
+    def test_cancels_the_other_checks(self):
+        d = first_reachable('backend', self.candidates)
+        self.clients[0].checks[0].callback(True)
+        self.assertIs(self.successResultOf(d), self.clients[0])
+        self.assertEqual([client.cancelled for client in self.clients],
+                         [0, 1, 1])
+
+    def test_none_reachable(self):
+        d = first_reachable('backend', self.candidates)
+        self.clients[0].checks[0].callback(False)
+        self.clients[1].checks[0].errback(Exception("connection refused"))
+        self.clients[2].checks[0].callback(False)
+        self.assertIs(self.successResultOf(d), None)
+
+    def test_cached_verdicts(self):
+        d = first_reachable('backend', self.candidates, self.cache)
+        self.clients[0].checks[0].callback(False)
+        self.clients[1].checks[0].callback(True)
+        self.assertIs(self.successResultOf(d), self.clients[1])
+
+        cache = ReachabilityCache(path='reachability.json', ttl=60)
+        cache.clock = self.cache.clock
+        d = first_reachable('backend', self.candidates, cache)
+        self.assertIs(self.successResultOf(d), self.clients[1])
+        self.assertEqual([len(client.checks) for client in self.clients],
+                         [1, 1, 1])
+
+        cache.clock.advance(61)
+        d = first_reachable('backend', self.candidates, cache)
+        self.assertEqual([len(client.checks) for client in self.clients],
+                         [2, 2, 2])
+
+    def test_check_again_when_none_is_cached_as_reachable(self):
+        for key, _ in self.candidates:
+            self.cache.set(key, False)
+        d = first_reachable('backend', self.candidates, self.cache)
+        self.assertEqual([len(client.checks) for client in self.clients],
+                         [1, 1, 1])
+        self.clients[0].checks[0].callback(True)
+        self.assertIs(self.successResultOf(d), self.clients[0])
+        self.assertTrue(self.cache.get('backend 0'))
+
+
+class TestReachabilityCache(unittest.TestCase):
+    def tearDown(self):
+        if os.path.exists('reachability.json'):
+            os.remove('reachability.json')
+
+    def test_disabled(self):
+        cache = ReachabilityCache(path='reachability.json', ttl=0)
+        cache.set('spam', True)
+        self.assertIs(cache.get('spam'), None)
+
+    def test_values_are_copied(self):
+        cache = ReachabilityCache(path='reachability.json', ttl=60)
+        response = {'net-tests': [{'collector': 'httpo://foo.onion'}]}
+        cache.set('bouncer', response)
+        response['net-tests'][0]['collector'] = object()
+        cache.get('bouncer')['net-tests'][0]['collector'] = object()
+        self.assertEqual(cache.get('bouncer'),
+                         {'net-tests': [{'collector': 'httpo://foo.onion'}]})
+        cache.remove('bouncer')
+        self.assertIs(cache.get('bouncer'), None)
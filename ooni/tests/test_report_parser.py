@@ -0,0 +1,72 @@
+import os
+
+from twisted.trial import unittest
+
+from ooni.reporter import YAMLReporter
+from ooni.report.parser import ReportLoader, ReportIndex
+
+test_details = {
+    'test_name': 'spam',
+    'test_version': '1.0',
+    'software_name': 'spam',
+    'software_version': '1.0',
+    'input_hashes': [],
+    'probe_asn': 'AS0',
+    'probe_cc': 'ZZ',
+    'test_start_time': '2016-01-01 22:33:11',
+    'data_format_version': '0.2.0'
+}
+
+
+class TestReportLoader(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'dummy-report.yamloo'
+        self.entries = [
+            {'input': 'http://example.com/%d' % idx,
+             'body': '---\n...\n' + 'A' * idx,
+             'empty': None}
+            for idx in range(10)
+        ]
+        reporter = YAMLReporter(test_details, self.filename)
+        reporter.createReport()
+        for entry in self.entries:
+            reporter.writeReportEntry(entry)
+        reporter.finish()
+
+    def tearDown(self):
+        for filename in (self.filename, self.filename + '.idx'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_load_report(self):
+        report = ReportLoader(self.filename)
+        self.assertEqual(report.header, test_details)
+        self.assertEqual(list(report), self.entries)
+        self.assertEqual(report.position, 10)
+
+    def test_skip_without_index(self):
+        report = ReportLoader(self.filename)
+        report.skip(3)
+        self.assertEqual(report.next(), self.entries[3])
+        self.assertRaises(TypeError, len, report)
+
+    def test_index(self):
+        report = ReportLoader(self.filename, use_index=True)
+        self.assertTrue(os.path.exists(self.filename + '.idx'))
+        self.assertEqual(len(report), 10)
+        self.assertEqual(report.header, test_details)
+        report.skip(7)
+        self.assertEqual(list(report), self.entries[7:])
+
+        index = ReportIndex(self.filename)
+        self.assertTrue(index.valid)
+        with open(self.filename, 'a') as f:
+            f.write('---\n{foo: bar}\n...\n')
+        self.assertFalse(index.valid)
+
+        report = ReportLoader(self.filename, use_index=True)
+        self.assertEqual(len(report), 11)
+        report.skip(10)
+        self.assertEqual(report.next(), {'foo': 'bar'})
+        report.skip(5)
+        self.assertEqual(list(report), [])
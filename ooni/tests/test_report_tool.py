@@ -0,0 +1,208 @@
+import os
+import json
+from StringIO import StringIO
+
+from mock import patch
+
+from twisted.internet import defer
+from twisted.python import usage
+from twisted.trial import unittest
+
+from ooni.settings import config
+from ooni.tests.bases import ConfigTestCase
+from ooni.tests.mocks import MockCollectorClient
+from ooni.tests.test_reporter import test_details, oonib_new_report_message
+from ooni.tests.test_reporter import oonib_new_report_batch_message
+from ooni.reporter import JSONLReporter, YAMLReporter, OONIBReportLog
+from ooni.errors import OONIBReportUpdateError
+from ooni.report import cli, parser, tool
+
+
+class MockCollector(object):
+    """
+    Stands in for the collector, failing to update the report once it has
+    received failAfter entries.
+    """
+    def __init__(self, new_report_message):
+        self.newReportMessage = new_report_message
+        self.failAfter = None
+        self.created = 0
+        self.closed = 0
+        self.entries = []
+
+        self.client = MockCollectorClient('http://example.com')
+        self.client._request = self.request
+
+    def request(self, method, urn, genReceiver, bodyProducer=None, *args,
+                **kw):
+        body = None
+        if bodyProducer is not None:
+            body = json.loads(bodyProducer.body)
+        if urn == '/report':
+            self.created += 1
+            response = self.newReportMessage
+        elif urn.endswith('/close'):
+            self.closed += 1
+            response = {}
+        elif self.failAfter is not None and \
+                len(self.entries) >= self.failAfter:
+            response = {'error': 'generic-error'}
+        else:
+            if isinstance(body['content'], list):
+                self.entries.extend(entry['input']
+                                    for entry in body['content'])
+            else:
+                self.entries.append(body['content']['input'])
+            response = {}
+        receiver = genReceiver(None, None)
+        return defer.maybeDeferred(receiver.body_processor,
+                                   json.dumps(response))
+
+
+class TestUpload(ConfigTestCase):
+    def setUp(self):
+        super(TestUpload, self).setUp()
+        # Failed batches would otherwise be retried batch_interval later
+        config.advanced.reporting_retries = 0
+
+        self.filename = 'dummy-report.jsonl'
+        reporter = JSONLReporter(test_details, self.filename)
+        reporter.createReport()
+        for idx in range(10):
+            reporter.writeReportEntry({'input': str(idx)})
+        reporter.finish()
+
+        self.report_log = OONIBReportLog('report_log')
+        self.collector = MockCollector(oonib_new_report_message)
+        collector_client = patch.object(tool, 'CollectorClient',
+                                        lambda *a, **kw: self.collector.client)
+        collector_client.start()
+        self.addCleanup(collector_client.stop)
+
+    def tearDown(self):
+        self.report_log.close()
+        for file_name in (self.filename, self.filename + '.idx',
+                          'report_log', 'report_log-wal', 'report_log-shm'):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        super(TestUpload, self).tearDown()
+
+    def upload(self, collector=None):
+        return tool.upload(self.filename, collector=collector,
+                           report_log=self.report_log)
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        yield self.upload('http://example.com')
+        self.assertEqual(self.collector.entries,
+                         [str(idx) for idx in range(10)])
+        self.assertEqual(self.collector.closed, 1)
+        self.assertEqual(self.report_log.get(self.filename), None)
+
+    @defer.inlineCallbacks
+    def test_upload_closes_report_log(self):
+        report_logs = []
+
+        def report_log():
+            report_logs.append(OONIBReportLog('report_log'))
+            return report_logs[-1]
+        with patch.object(tool, 'OONIBReportLog', report_log):
+            yield tool.upload(self.filename, collector='http://example.com')
+        self.assertEqual(self.collector.closed, 1)
+        self.assertIs(report_logs[0]._db, None)
+
+    @defer.inlineCallbacks
+    def test_create_report_failed(self):
+        self.collector.newReportMessage = {'error': 'generic-error'}
+        reports = []
+        original_open_report = parser.open_report
+
+        def open_report(*args, **kw):
+            reports.append(original_open_report(*args, **kw))
+            return reports[-1]
+        with patch.object(parser, 'open_report', open_report):
+            yield self.assertFailure(self.upload('http://example.com'),
+                                     Exception)
+        self.assertTrue(reports[0]._fp.closed)
+
+    @defer.inlineCallbacks
+    def test_resume_upload(self):
+        self.collector.failAfter = 4
+        yield self.assertFailure(self.upload('http://example.com'),
+                                 OONIBReportUpdateError)
+        value = self.report_log.get(self.filename)
+        self.assertEqual(value['status'], 'incomplete')
+        self.assertEqual(value['uploaded'], 4)
+        self.assertEqual(self.report_log.reports_to_resume,
+                         [(self.filename, value)])
+
+        self.collector.failAfter = None
+        yield tool.upload_all(report_log=self.report_log)
+        self.assertEqual(self.collector.created, 1)
+        self.assertEqual(self.collector.entries,
+                         [str(idx) for idx in range(10)])
+        self.assertEqual(self.collector.closed, 1)
+        self.assertEqual(self.report_log.get(self.filename), None)
+
+    @defer.inlineCallbacks
+    def test_resume_batch_upload(self):
+        self.collector.newReportMessage = oonib_new_report_batch_message
+        self.collector.failAfter = 0
+        yield self.assertFailure(self.upload('http://example.com'),
+                                 Exception)
+        self.assertEqual(self.report_log.get(self.filename)['upload'],
+                         {'supported_formats': ['yaml', 'json'],
+                          'batching': True})
+
+        self.collector.failAfter = None
+        yield self.upload()
+        self.assertEqual(self.collector.created, 1)
+        self.assertEqual(self.collector.entries,
+                         [str(idx) for idx in range(10)])
+
+    def use_yaml_report(self):
+        os.remove(self.filename)
+        self.filename = 'dummy-report.yamloo'
+        reporter = YAMLReporter(test_details, self.filename)
+        reporter.createReport()
+        for idx in range(10):
+            reporter.writeReportEntry({'input': str(idx)})
+        reporter.finish()
+
+    @defer.inlineCallbacks
+    def test_resume_yaml_upload(self):
+        self.use_yaml_report()
+        self.collector.failAfter = 4
+        yield self.assertFailure(self.upload('http://example.com'),
+                                 Exception)
+        self.assertFalse(os.path.exists(self.filename + '.idx'))
+
+        self.collector.failAfter = None
+        yield self.upload()
+        # The uploaded entries are skipped through the index
+        self.assertTrue(os.path.exists(self.filename + '.idx'))
+        self.assertEqual(self.collector.entries,
+                         [str(idx) for idx in range(10)])
+
+    @defer.inlineCallbacks
+    def test_status(self):
+        self.use_yaml_report()
+        self.collector.failAfter = 4
+        yield self.assertFailure(self.upload('http://example.com'),
+                                 Exception)
+        with patch.object(tool, 'OONIBReportLog', lambda: self.report_log), \
+                patch('sys.stdout', new_callable=StringIO) as stdout:
+            tool.status()
+        self.assertIn("* %s\n" % self.filename, stdout.getvalue())
+        self.assertIn("  4 of 10 entries uploaded\n", stdout.getvalue())
+
+
+class TestOptions(unittest.TestCase):
+    def test_concurrency(self):
+        options = cli.Options()
+        options.parseOptions(['-n', '2', 'upload'])
+        self.assertEqual(options['concurrency'], 2)
+        for concurrency in ('0', '-1', 'many'):
+            self.assertRaises(usage.UsageError,
+                              cli.Options().parseOptions,
+                              ['-n', concurrency, 'upload'])
@@ -1,15 +1,22 @@
 import os
 import yaml
 import json
+import base64
 import time
-from mock import MagicMock
+import sqlite3
+from datetime import datetime
+from mock import MagicMock, patch
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
 from ooni import errors as e
 from ooni.tests.mocks import MockCollectorClient
+from ooni.tests.bases import ConfigTestCase
 from ooni.reporter import YAMLReporter, OONIBReporter, OONIBReportLog
+from ooni.reporter import ReportSink, JSONLReporter, Report, create_oonib_sink
+from ooni.report.parser import JSONLReportLoader, open_report
+from ooni.managers import ReportEntryManager
 
 
 
@@ -37,6 +44,13 @@ oonib_new_report_message = {
     'supported_formats': ["yaml", "json"]
 }
 
+oonib_new_report_batch_message = {
+    'report_id': "20140129T202038Z_AS0_" + "A" * 50,
+    'backend_version': "1.0",
+    'supported_formats': ["yaml", "json"],
+    'batch_upload': True
+}
+
 # This is used for testing legacy collectors
 oonib_new_report_yaml_message = {
     'report_id': "20140129T202038Z_AS0_" + "A" * 50,
@@ -68,13 +82,263 @@ class TestYAMLReporter(unittest.TestCase):
             entry = report_entries.next()
             assert all(x in entry for x in ['test_name', 'test_version'])
 
+    def _readEntries(self, y_reporter):
+        with open(y_reporter.report_path) as f:
+            return list(yaml.safe_load_all(f))
+
+    def test_group_commit_interval(self):
+        y_reporter = YAMLReporter(test_details, 'dummy-report.yaml')
+        self.filename = y_reporter.report_path
+        y_reporter.clock = task.Clock()
+        y_reporter.flushInterval = 10
+        y_reporter.createReport()
+        y_reporter.writeReportEntry({'foo': 'bar'})
+        self.assertEqual(self._readEntries(y_reporter), [])
+        y_reporter.clock.advance(10)
+        entries = self._readEntries(y_reporter)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[1], {'foo': 'bar'})
+
+    def test_group_commit_size(self):
+        y_reporter = YAMLReporter(test_details, 'dummy-report.yaml')
+        self.filename = y_reporter.report_path
+        y_reporter.flushSize = 1024
+        y_reporter.createReport()
+        self.assertEqual(self._readEntries(y_reporter), [])
+        y_reporter.writeReportEntry({'foo': 'A' * 1024})
+        self.assertEqual(len(self._readEntries(y_reporter)), 2)
+        y_reporter.writeReportEntry({'foo': 'bar'})
+        self.assertEqual(len(self._readEntries(y_reporter)), 2)
+        y_reporter.finish()
+        self.assertEqual(len(self._readEntries(y_reporter)), 3)
+
+    def test_write_does_not_copy(self):
+        entry = {'foo': ['bar']}
+        y_reporter = YAMLReporter(test_details, 'dummy-report.yaml')
+        self.filename = y_reporter.report_path
+        y_reporter.fsync = True
+        y_reporter.createReport()
+        y_reporter.writeReportEntry(entry)
+        self.assertEqual(entry, {'foo': ['bar']})
+        self.assertEqual(self._readEntries(y_reporter)[1], entry)
+
+
+class TestJSONLReporter(unittest.TestCase):
+    def setUp(self):
+        self.filename = 'dummy-report.jsonl'
+        self.reporter = JSONLReporter(test_details, self.filename)
+        self.reporter.createReport()
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_write_report(self):
+        self.reporter.writeReportEntry({'input': 'http://example.com/',
+                                        'body': 'spam'})
+        self.reporter.writeReportEntry({'input': None, 'body': 'ham'})
+        self.reporter.finish()
+        with open(self.filename) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 2)
+        measurement = json.loads(lines[0])
+        self.assertEqual(measurement['input'], 'http://example.com/')
+        self.assertEqual(measurement['test_keys'], {'body': 'spam'})
+        self.assertEqual(measurement['test_name'], 'spam')
+        self.assertNotEqual(measurement['id'], json.loads(lines[1])['id'])
+
+    def test_write_binary_data(self):
+        from scapy.all import IP
+        packet = IP(dst='127.0.0.1')
+        self.reporter.writeReportEntry({'input': '127.0.0.1:80',
+                                        'received': ['\xff\xfe', 'spam'],
+                                        'sent_packets': [packet]})
+        self.reporter.finish()
+        with open(self.filename) as f:
+            measurement = json.loads(f.readline())
+        self.assertEqual(measurement['test_keys']['received'], [
+            {'format': 'base64', 'data': base64.b64encode('\xff\xfe')},
+            'spam'
+        ])
+        sent_packet = measurement['test_keys']['sent_packets'][0][0]
+        self.assertEqual(sent_packet['summary'], str([packet]))
+        self.assertEqual(sent_packet['raw_packet'],
+                         {'format': 'base64',
+                          'data': base64.b64encode(str(packet))})
+
+    def test_load_report(self):
+        entries = [
+            {'input': 'http://example.com/', 'body': 'spam',
+             'test_runtime': 0.5},
+            {'input': None, 'body': 'ham', 'test_runtime': 0.1}
+        ]
+        for entry in entries:
+            self.reporter.writeReportEntry(entry)
+        self.reporter.finish()
+        report = open_report(self.filename)
+        self.assertIsInstance(report, JSONLReportLoader)
+        self.assertEqual(report.header, test_details)
+        loaded = list(report)
+        self.assertEqual(len(loaded), 2)
+        for entry, loaded_entry in zip(entries, loaded):
+            self.assertEqual(loaded_entry['body'], entry['body'])
+            self.assertEqual(loaded_entry['input'], entry['input'])
+            self.assertEqual(loaded_entry['test_runtime'],
+                             entry['test_runtime'])
+
+    def test_load_empty_report(self):
+        self.reporter.finish()
+        report = open_report(self.filename)
+        self.assertEqual(report.header, {})
+        self.assertEqual(list(report), [])
+
+
+class TestReportFormat(ConfigTestCase):
+    def test_report_filename(self):
+        report = Report(dict(test_details), None, None,
+                        report_format='jsonl')
+        self.assertTrue(report.report_filename.endswith('.jsonl'))
+
+    def test_invalid_report_format(self):
+        self.assertRaises(e.InvalidReportFormat, Report, test_details,
+                          None, None, report_format='xml')
+
+
+class TestReport(ConfigTestCase):
+    @defer.inlineCallbacks
+    def test_oonib_entries_failed(self):
+        report = Report(dict(test_details), os.path.abspath('report.yamloo'),
+                        None, no_yamloo=True)
+        self.addCleanup(report.report_log.close)
+        yield report.report_log.created(report.report_filename,
+                                        'httpo://foo.onion', 'someid')
+        reporter = MockSlowReporter()
+        reporter.failures = 2
+        report.oonib_sink = ReportSink(reporter)
+
+        yield report.write(MockTest())
+        yield report.write(MockTest())
+        value = report.report_log.get(report.report_filename)
+        self.assertEqual(value['status'], 'incomplete')
+        yield report.report_log.closed(report.report_filename)
+
+    @defer.inlineCallbacks
+    def test_close_report_log(self):
+        report = Report(dict(test_details), os.path.abspath('report.yamloo'),
+                        None, no_yamloo=True)
+        yield report.close()
+        self.assertIs(report.report_log._db, None)
+
+
+class MockSlowReporter(object):
+    def __init__(self):
+        self.written = []
+        self.pending = []
+        self.failures = 0
+
+    def writeReportEntry(self, entry):
+        if self.failures > 0:
+            self.failures -= 1
+            raise e.OONIBReportUpdateError
+        d = defer.Deferred()
+        self.pending.append((entry, d))
+        return d
+
+    def completeOne(self):
+        entry, d = self.pending.pop(0)
+        self.written.append(entry)
+        d.callback(None)
+
+
+class MockParent(object):
+    def __init__(self):
+        self.filled = 0
+
+    def _fillSlots(self):
+        self.filled += 1
+
+
+class TestReportSink(unittest.TestCase):
+    def test_write_in_order(self):
+        reporter = MockSlowReporter()
+        sink = ReportSink(reporter)
+        written = [sink.write(i) for i in range(3)]
+        self.assertEqual(sink.pending, 3)
+        self.assertEqual(len(reporter.pending), 1)
+        for _ in range(3):
+            reporter.completeOne()
+        self.assertEqual(reporter.written, [0, 1, 2])
+        self.assertTrue(all(d.called for d in written))
+        self.assertEqual(sink.pending, 0)
+
+    def test_backpressure(self):
+        reporter = MockSlowReporter()
+        monitor = ReportEntryManager()
+        monitor.parent = MockParent()
+        sink = ReportSink(reporter, monitor=monitor)
+        sink.maxPending = 2
+
+        sink.write(0)
+        self.assertTrue(monitor.availableSlots > 0)
+        sink.write(1)
+        self.assertEqual(monitor.availableSlots, 0)
+
+        reporter.completeOne()
+        self.assertTrue(monitor.availableSlots > 0)
+        self.assertEqual(monitor.parent.filled, 1)
+
+    def test_retry_and_flush(self):
+        reporter = MockSlowReporter()
+        reporter.failures = 1
+        sink = ReportSink(reporter, retries=1)
+        d = sink.write(0)
+        flushed = sink.flush()
+        self.assertFalse(flushed.called)
+        reporter.completeOne()
+        self.assertTrue(flushed.called)
+        return d
+
+    def test_write_failure(self):
+        reporter = MockSlowReporter()
+        reporter.failures = 2
+        sink = ReportSink(reporter, retries=1)
+        return self.assertFailure(sink.write(0), e.OONIBReportUpdateError)
+
+    def test_timeout(self):
+        reporter = MockSlowReporter()
+        sink = ReportSink(reporter, timeout=10)
+        sink.clock = task.Clock()
+        d = sink.write(0)
+        sink.clock.advance(10)
+        self.assertEqual(sink.pending, 0)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_synchronous_writes(self):
+        # Reporters that write synchronously should not make the stack grow
+        # with the number of queued entries.
+        written = []
+
+        class SyncReporter(object):
+            def writeReportEntry(self, entry):
+                written.append(entry)
+
+        sink = ReportSink(SyncReporter())
+        for i in range(5000):
+            sink.write(i)
+        self.assertEqual(written, range(5000))
+
 
 class TestOONIBReporter(unittest.TestCase):
 
     def setUp(self):
         self.mock_response = {}
-
-        def mockRequest(method, urn, genReceiver, *args, **kw):
+        self.requests = []
+
+        def mockRequest(method, urn, genReceiver, bodyProducer=None, *args,
+                        **kw):
+            body = None
+            if bodyProducer is not None:
+                body = json.loads(bodyProducer.body)
+            self.requests.append((method, urn, body))
             receiver = genReceiver(None, None)
             return defer.maybeDeferred(receiver.body_processor,
                                        json.dumps(self.mock_response))
@@ -114,6 +378,83 @@ class TestOONIBReporter(unittest.TestCase):
         req = {'content': 'something'}
         yield self.oonib_reporter.writeReportEntry(req)
 
+    @defer.inlineCallbacks
+    def test_write_report_entries_in_batch(self):
+        self.mock_response = oonib_new_report_batch_message
+        self.oonib_reporter.clock = task.Clock()
+        self.oonib_reporter.batchSize = 10 ** 6
+        yield self.oonib_reporter.createReport()
+        self.assertTrue(self.oonib_reporter.batching)
+        self.requests = []
+
+        written = [self.oonib_reporter.writeReportEntry({'input': str(i)})
+                   for i in range(3)]
+        self.assertEqual(self.requests, [])
+        self.oonib_reporter.clock.advance(self.oonib_reporter.batchInterval)
+        yield defer.gatherResults(written)
+
+        self.assertEqual(len(self.requests), 1)
+        method, urn, body = self.requests[0]
+        self.assertEqual(urn, '/report/' + self.oonib_reporter.reportId)
+        self.assertEqual([entry['input'] for entry in body['content']],
+                         ['0', '1', '2'])
+
+        self.oonib_reporter.writeReportEntry({'input': '3'})
+        yield self.oonib_reporter.finish()
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.requests[1][2]['content'][0]['input'], '3')
+        self.assertTrue(self.requests[2][1].endswith('/close'))
+
+    @defer.inlineCallbacks
+    def test_write_report_entries_in_batch_by_size(self):
+        self.mock_response = oonib_new_report_batch_message
+        yield self.oonib_reporter.createReport()
+        self.oonib_reporter.batchSize = 1
+        self.requests = []
+        yield self.oonib_reporter.writeReportEntry({'input': 'spam'})
+        self.assertEqual(len(self.requests), 1)
+
+    @defer.inlineCallbacks
+    def test_write_report_entries_in_batch_failure(self):
+        self.mock_response = oonib_new_report_batch_message
+        yield self.oonib_reporter.createReport()
+        self.oonib_reporter.batchSize = 1
+        self.mock_response = oonib_generic_error_message
+        yield self.assertFailure(
+            self.oonib_reporter.writeReportEntry({'input': 'spam'}),
+            e.OONIBReportUpdateError)
+
+    @defer.inlineCallbacks
+    def test_batch_sink(self):
+        self.mock_response = oonib_new_report_batch_message
+        yield self.oonib_reporter.createReport()
+        sink = create_oonib_sink(self.oonib_reporter)
+        # Retrying or timing out an entry would leave it in its batch
+        self.assertEqual(sink.retries, 0)
+        self.assertIs(sink.timeout, None)
+        self.assertEqual(sink.maxInFlight, sink.maxPending)
+
+    @defer.inlineCallbacks
+    def test_batch_sink_full(self):
+        self.mock_response = oonib_new_report_batch_message
+        self.oonib_reporter.clock = task.Clock()
+        self.oonib_reporter.batchSize = 10 ** 6
+        yield self.oonib_reporter.createReport()
+        self.requests = []
+        monitor = ReportEntryManager()
+        monitor.parent = MockParent()
+        sink = create_oonib_sink(self.oonib_reporter, monitor=monitor)
+        sink.maxInFlight = sink.maxPending = 10
+
+        written = [sink.write({'input': str(i)}) for i in range(25)]
+        # The full batches have been sent without waiting for batchInterval
+        self.assertEqual(len(self.requests), 2)
+        self.assertTrue(all(d.called for d in written[:20]))
+        self.assertTrue(monitor.availableSlots > 0)
+        self.assertEqual(sink.pending, 5)
+        self.assertEqual(self.oonib_reporter.clock.seconds(), 0)
+
+
 class TestOONIBReportLog(unittest.TestCase):
 
     def setUp(self):
@@ -121,16 +462,19 @@ class TestOONIBReportLog(unittest.TestCase):
         self.report_log.create_report_log()
 
     def tearDown(self):
-        os.remove(self.report_log.file_name)
+        self.report_log.close()
+        for file_name in ('report_log', 'report_log-wal', 'report_log-shm'):
+            if os.path.exists(file_name):
+                os.remove(file_name)
 
     @defer.inlineCallbacks
     def test_report_created(self):
         yield self.report_log.created("path_to_my_report.yaml",
                                              'httpo://foo.onion',
                                              'someid')
-        with open(self.report_log.file_name) as f:
-            report = yaml.safe_load(f)
-            assert "path_to_my_report.yaml" in report
+        report = OONIBReportLog('report_log').get_report_log()
+        assert "path_to_my_report.yaml" in report
+        assert report["path_to_my_report.yaml"]["report_id"] == 'someid'
 
     @defer.inlineCallbacks
     def test_concurrent_edit(self):
@@ -141,10 +485,9 @@ class TestOONIBReportLog(unittest.TestCase):
                                             'httpo://foo.onion',
                                             'someid2')
         yield defer.DeferredList([d1, d2])
-        with open(self.report_log.file_name) as f:
-            report = yaml.safe_load(f)
-            assert "path_to_my_report1.yaml" in report
-            assert "path_to_my_report2.yaml" in report
+        report = self.report_log.get_report_log()
+        assert "path_to_my_report1.yaml" in report
+        assert "path_to_my_report2.yaml" in report
 
     @defer.inlineCallbacks
     def test_report_closed(self):
@@ -153,18 +496,34 @@ class TestOONIBReportLog(unittest.TestCase):
                                              'someid')
         yield self.report_log.closed("path_to_my_report.yaml")
 
-        with open(self.report_log.file_name) as f:
-            report = yaml.safe_load(f)
-            assert "path_to_my_report.yaml" not in report
+        report = self.report_log.get_report_log()
+        assert "path_to_my_report.yaml" not in report
+        yield self.assertFailure(
+            self.report_log.closed("path_to_my_report.yaml"),
+            e.ReportNotCreated)
 
     @defer.inlineCallbacks
     def test_report_creation_failed(self):
         yield self.report_log.creation_failed("path_to_my_report.yaml",
                                                      'httpo://foo.onion')
-        with open(self.report_log.file_name) as f:
-            report = yaml.safe_load(f)
+        report = self.report_log.get_report_log()
         assert "path_to_my_report.yaml" in report
         assert report["path_to_my_report.yaml"]["status"] == "creation-failed"
+        assert report["path_to_my_report.yaml"]["collector"] == \
+            'httpo://foo.onion'
+
+    @defer.inlineCallbacks
+    def test_report_incomplete(self):
+        yield self.report_log.created("path_to_my_report.yaml",
+                                      'httpo://foo.onion', 'someid')
+        yield self.report_log.incomplete("path_to_my_report.yaml")
+        assert len(self.report_log.reports_incomplete) == 1
+        # Every entry that fails to be written marks it as incomplete
+        yield self.report_log.incomplete("path_to_my_report.yaml")
+        assert len(self.report_log.reports_incomplete) == 1
+        yield self.assertFailure(
+            self.report_log.incomplete("not_created_report.yaml"),
+            e.ReportNotCreated)
 
     @defer.inlineCallbacks
     def test_list_reports(self):
@@ -176,3 +535,97 @@ class TestOONIBReportLog(unittest.TestCase):
         assert len(self.report_log.reports_in_progress) == 1
         assert len(self.report_log.reports_incomplete) == 0
         assert len(self.report_log.reports_to_upload) == 1
+
+    @defer.inlineCallbacks
+    def test_add_upload_columns(self):
+        self.report_log.close()
+        os.remove('report_log')
+        db = sqlite3.connect('report_log')
+        db.execute("CREATE TABLE reports (report_file TEXT PRIMARY KEY, "
+                   "status TEXT, pid INTEGER, created_at TIMESTAMP, "
+                   "collector TEXT, report_id TEXT)")
+        db.close()
+
+        self.report_log = OONIBReportLog('report_log')
+        yield self.report_log.created("path_to_my_report.yaml",
+                                      'httpo://foo.onion', 'someid',
+                                      upload={'supported_formats': ['json'],
+                                              'batching': False})
+        yield self.report_log.uploaded("path_to_my_report.yaml", 3)
+        value = self.report_log.get("path_to_my_report.yaml")
+        self.assertEqual(value['uploaded'], 3)
+        self.assertEqual(value['upload']['supported_formats'], ['json'])
+
+    def test_migrate_yaml_report_log(self):
+        self.report_log.close()
+        os.remove('report_log')
+        created_at = datetime(2016, 1, 1)
+        with open('report_log', 'w') as f:
+            yaml.safe_dump({
+                'created_report.yaml': {
+                    'pid': 1, 'created_at': created_at, 'status': 'created',
+                    'collector': {'address': 'httpo://foo.onion'},
+                    'report_id': 'XXXX'
+                },
+                'failed_report.yaml': {
+                    'pid': 1, 'created_at': created_at,
+                    'status': 'creation-failed', 'collector': None
+                }
+            }, f)
+        self.addCleanup(os.remove, 'report_log.migrated')
+
+        self.report_log = OONIBReportLog('report_log')
+        self.assertTrue(os.path.exists('report_log.migrated'))
+        self.assertEqual(self.report_log.get('created_report.yaml'), {
+            'pid': 1, 'created_at': created_at, 'status': 'created',
+            'collector': {'address': 'httpo://foo.onion'},
+            'report_id': 'XXXX', 'upload': None, 'uploaded': None
+        })
+        self.assertEqual([report_file for report_file, _ in
+                          self.report_log.reports_to_upload],
+                         ['failed_report.yaml'])
+
+    def test_migrate_yaml_report_log_rename_failed(self):
+        self.report_log.close()
+        os.remove('report_log')
+        with open('report_log', 'w') as f:
+            yaml.safe_dump({'failed_report.yaml': {
+                'pid': 1, 'status': 'creation-failed', 'collector': None
+            }}, f)
+
+        # Another ooniprobe has already migrated it
+        def rename(src, dst):
+            os.remove(src)
+            raise OSError(2, 'No such file or directory')
+        with patch('ooni.reporter.os.rename', side_effect=rename):
+            self.report_log = OONIBReportLog('report_log')
+        self.assertEqual(self.report_log.reports_to_upload, [])
+
+    def lock_report_log(self):
+        db = sqlite3.connect('report_log', isolation_level=None)
+        db.execute("BEGIN IMMEDIATE")
+        self.addCleanup(db.close)
+        return db
+
+    def test_locked_report_log(self):
+        self.report_log.clock = task.Clock()
+        db = self.lock_report_log()
+        d1 = self.report_log.created("path_to_my_report.yaml",
+                                     'httpo://foo.onion', 'someid')
+        d2 = self.report_log.closed("path_to_my_report.yaml")
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        db.execute("COMMIT")
+        self.report_log.clock.advance(self.report_log.retryDelay)
+        self.assertEqual(self.successResultOf(d1), 'someid')
+        self.successResultOf(d2)
+        self.assertEqual(self.report_log.get_report_log(), {})
+
+    def test_locked_report_log_timeout(self):
+        self.report_log.clock = task.Clock()
+        self.report_log.lockTimeout = 1
+        self.lock_report_log()
+        d = self.report_log.not_created("path_to_my_report.yaml")
+        self.report_log.clock.pump([self.report_log.retryDelay] * 20)
+        return self.assertFailure(d, sqlite3.OperationalError)
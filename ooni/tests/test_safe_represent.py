@@ -2,7 +2,7 @@ import yaml
 
 from twisted.trial import unittest
 
-from ooni.reporter import OSafeDumper
+from ooni.reporter import OSafeDumper, OCSafeDumper, safe_dump
 
 from scapy.all import IP, UDP
 
@@ -13,3 +13,62 @@ class TestScapyRepresent(unittest.TestCase):
         yaml.dump_all([data], Dumper=OSafeDumper)
 
 
+sample_entries = [
+    {
+        'input': 'http://example.com/',
+        'test_start_time': 1453887523.12,
+        'requests': [{
+            'request': {
+                'method': 'GET',
+                'url': 'http://example.com/',
+                'headers': {'User-Agent': ['Mozilla/5.0 (Windows NT 6.1) '
+                                           'AppleWebKit/537.36 (KHTML, like '
+                                           'Gecko) Chrome/47.0.2526.106 '
+                                           'Safari/537.36']},
+                'body': None
+            },
+            'response': {
+                'code': 200,
+                'headers': {'Content-Type': ['text/html'],
+                            'Set-Cookie': ['a=b', 'c=d']},
+                'body': '<html>\n<head><title>Example</title></head>\n'
+                        '<body><p>' + 'Lorem ipsum dolor sit amet, ' * 20 +
+                        '</p></body>\n</html>\n'
+            }
+        }],
+        'body_length_match': True,
+        'failure': None
+    },
+    {
+        'complex': [1 + 2j, 2j, 3.5 + 0j, 1.5 - 1j],
+        'binary': '\xff\xfe\x00\x01' * 40,
+        'utf8': 'caf\xc3\xa8',
+        'unicode': u'\u4e2d\u6587',
+        'empty': ['', [], {}],
+        'special': ['yes', 'null', '#comment', '- dash', 'a: b', ' lead'],
+        'numbers': [0, -1, 10 ** 30, 1e300, 0.1]
+    },
+    {'packets': IP() / UDP()},
+]
+
+
+class TestCSafeDumper(unittest.TestCase):
+    def setUp(self):
+        if OCSafeDumper is None:
+            self.skipTest("libyaml is not available")
+
+    def test_same_output(self):
+        for entry in sample_entries:
+            self.assertEqual(yaml.dump_all([entry], Dumper=OCSafeDumper),
+                             yaml.dump_all([entry], Dumper=OSafeDumper))
+
+    def test_folded_double_quoted(self):
+        entry = {'body': 'Lorem ipsum\tdolor sit amet,\r\n' * 20}
+        self.assertEqual(yaml.safe_load(safe_dump(entry)),
+                         yaml.safe_load(yaml.dump_all([entry],
+                                                      Dumper=OSafeDumper)))
+
+    def test_safe_dump_uses_libyaml(self):
+        self.assertEqual(safe_dump(sample_entries[0]),
+                         yaml.dump_all([sample_entries[0]],
+                                       Dumper=OCSafeDumper))
@@ -0,0 +1,251 @@
+import os
+import cPickle
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from ooni.settings import config
+from ooni.director import Director
+from ooni.nettest import NetTestLoader
+from ooni.reporter import Report
+from ooni.report.parser import ReportLoader
+from ooni.sharding import ShardedNetTest, ShardProcessProtocol
+from ooni.sharding import ShardChannel, mergeSummary, packMessage
+from ooni.tests.bases import ConfigTestCase
+
+net_test_string = """
+from ooni.nettest import NetTestCase
+
+class DummyTestCase(NetTestCase):
+    inputs = range(12)
+
+    def test_a(self):
+        self.report['square'] = self.input ** 2
+
+    def destinationForInput(self, test_input):
+        return 'host%d' % (test_input % 4)
+
+    def postProcessor(self, measurements):
+        self.summary.setdefault('squares', []).append(self.report['square'])
+        self.summary['count'] = self.summary.get('count', 0) + 1
+        return self.report
+"""
+
+
+class MockReport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, entry):
+        self.written.append(entry)
+        return defer.succeed(None)
+
+
+class MockTransport(object):
+    def __init__(self):
+        self.messages = []
+
+    def writeToChild(self, child_fd, data):
+        self.messages.append((child_fd, cPickle.loads(data[4:])))
+
+
+class MockMonitor(object):
+    def __init__(self):
+        self.full = set()
+
+    def sinkFull(self, sink):
+        self.full.add(sink)
+
+    def sinkDrained(self, sink):
+        self.full.discard(sink)
+
+
+class TestShardedNetTest(unittest.TestCase):
+    def setUp(self):
+        ntl = NetTestLoader([])
+        ntl.loadNetTestString(net_test_string)
+        ntl.checkOptions()
+        self.report = MockReport()
+        self.net_test = ShardedNetTest(ntl, {'report_id': None},
+                                       self.report, 3)
+        self.net_test.processes = []
+        for index in range(3):
+            process_protocol = ShardProcessProtocol(self.net_test, index)
+            process_protocol.transport = MockTransport()
+            self.net_test.processes.append(process_protocol)
+
+    def test_supports(self):
+        self.assertFalse(ShardedNetTest.supports(self.net_test.netTestLoader))
+
+    def test_write_in_order(self):
+        self.net_test.entryReceived(1, 'b')
+        self.net_test.entryReceived(2, 'c')
+        self.assertEqual(self.report.written, [])
+        self.net_test.entryReceived(0, 'a')
+        self.assertEqual(self.report.written, ['a', 'b', 'c'])
+
+    def test_failed_entry(self):
+        self.net_test.entryReceived(1, 'b')
+        self.net_test.entryReceived(0, None)
+        self.assertEqual(self.report.written, ['b'])
+
+    def test_shard_ended(self):
+        self.net_test.entryReceived(0, 'a')
+        self.net_test.entryReceived(2, 'c')
+        self.net_test.entryReceived(5, 'f')
+        self.net_test.shardEnded(2)
+        self.net_test.shardEnded(1)
+        self.assertEqual(self.report.written, ['a', 'c'])
+        self.net_test.entryReceived(3, 'd')
+        self.assertEqual(self.report.written, ['a', 'c', 'd', 'f'])
+        self.assertFalse(self.net_test.done.called)
+        self.net_test.shardEnded(0)
+        self.assertTrue(self.net_test.done.called)
+
+    def test_throttle(self):
+        self.net_test.maxPending = 4
+        for entry_index in range(1, 7):
+            self.net_test.entryReceived(entry_index, entry_index)
+        messages = [p.transport.messages for p in self.net_test.processes]
+        self.assertEqual(messages, [[], [(4, ('pause',))], [(4, ('pause',))]])
+        self.net_test.entryReceived(0, 0)
+        self.net_test.entryReceived(7, 7)
+        messages = [p.transport.messages for p in self.net_test.processes]
+        self.assertEqual(messages, [[],
+                                    [(4, ('pause',)), (4, ('resume',))],
+                                    [(4, ('pause',)), (4, ('resume',))]])
+        self.assertEqual(self.report.written, range(8))
+
+    def test_summary_received(self):
+        self.net_test.summaryReceived({'count': 2, 'squares': [0, 9]}, None)
+        self.assertIs(self.net_test.schedulerSummary(), None)
+        self.net_test.summaryReceived(
+            {'count': 1, 'squares': [1]},
+            {'destinations': set(['a', 'b']), 'throttled': 2,
+             'max_active_per_destination': 1})
+        self.net_test.summaryReceived(
+            {'count': 1, 'squares': [4]},
+            {'destinations': set(['b', 'c']), 'throttled': 1,
+             'max_active_per_destination': 2})
+        self.assertEqual(self.net_test.summary,
+                         {'count': 4, 'squares': [0, 9, 1, 4]})
+        self.assertEqual(self.net_test.schedulerSummary(),
+                         {'destinations': 3, 'throttled': 3,
+                          'max_active_per_destination': 3})
+
+
+class TestShardChannel(unittest.TestCase):
+    def setUp(self):
+        self.channel = ShardChannel()
+        self.channel.monitor = MockMonitor()
+        self.transport = proto_helpers.StringTransport()
+        self.channel.makeConnection(self.transport)
+
+    def test_send(self):
+        self.channel.send('entry', 0, {'foo': 'bar'})
+        data = self.transport.value()
+        self.assertEqual(cPickle.loads(data[4:]), ('entry', 0, {'foo': 'bar'}))
+        self.assertEqual(data, packMessage('entry', 0, {'foo': 'bar'}))
+
+    def test_pause(self):
+        self.channel.dataReceived(packMessage('pause'))
+        self.assertEqual(self.channel.monitor.full, set([self.channel]))
+        self.channel.dataReceived(packMessage('resume'))
+        self.assertEqual(self.channel.monitor.full, set())
+
+    def test_close(self):
+        d = self.channel.close()
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse(d.called)
+        self.channel.connectionLost(None)
+        self.assertTrue(d.called)
+
+
+class TestMergeSummary(unittest.TestCase):
+    def test_merge(self):
+        summary = {'accessible': ['a'], 'blocked': {'dns': ['b']},
+                   'total': 1, 'name': 'spam'}
+        mergeSummary(summary, {'accessible': ['c'],
+                               'blocked': {'dns': ['d'], 'tcp_ip': ['e']},
+                               'total': 2, 'name': 'ham', 'new': True})
+        self.assertEqual(summary, {
+            'accessible': ['a', 'c'],
+            'blocked': {'dns': ['b', 'd'], 'tcp_ip': ['e']},
+            'total': 3, 'name': 'ham', 'new': True
+        })
+
+
+class SummaryDirector(Director):
+    def __init__(self):
+        Director.__init__(self)
+        self.summaries = []
+
+    def netTestDone(self, net_test):
+        self.summaries.append((net_test.summary,
+                               net_test.schedulerSummary()))
+        Director.netTestDone(self, net_test)
+
+
+class TestShardedRun(ConfigTestCase):
+    timeout = 60
+
+    def setUp(self):
+        super(TestShardedRun, self).setUp()
+        self.test_file = os.path.abspath('dummy_sharded_test.py')
+        with open(self.test_file, 'w') as f:
+            f.write(net_test_string)
+        self.report_file = os.path.abspath('dummy_sharded_report.yamloo')
+        config.advanced.measurement_shards = 3
+
+    def tearDown(self):
+        config.advanced.measurement_shards = None
+        config.advanced.per_host_concurrency = None
+        for filename in (self.test_file, self.report_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+        super(TestShardedRun, self).tearDown()
+
+    @defer.inlineCallbacks
+    def test_sharded_run(self):
+        director = Director()
+        ntl = NetTestLoader([], test_file=self.test_file)
+        ntl.checkOptions()
+        yield director.startNetTest(ntl, self.report_file)
+        self.assertEqual(director.successfulMeasurements, 12)
+        report = ReportLoader(self.report_file)
+        self.assertEqual([entry['square'] for entry in report],
+                         [i ** 2 for i in range(12)])
+
+    @defer.inlineCallbacks
+    def test_sharded_run_paused(self):
+        self.patch(ShardedNetTest, 'maxPending', 1)
+        director = Director()
+        ntl = NetTestLoader([], test_file=self.test_file)
+        ntl.checkOptions()
+        yield director.startNetTest(ntl, self.report_file)
+        self.assertEqual(director.successfulMeasurements, 12)
+        report = ReportLoader(self.report_file)
+        self.assertEqual([entry['square'] for entry in report],
+                         [i ** 2 for i in range(12)])
+
+    @defer.inlineCallbacks
+    def test_sharded_summary(self):
+        config.advanced.per_host_concurrency = 6
+        summaries = []
+        for shards in (3, None):
+            config.advanced.measurement_shards = shards
+            director = SummaryDirector()
+            ntl = NetTestLoader([], test_file=self.test_file)
+            ntl.checkOptions()
+            yield director.startNetTest(ntl, self.report_file)
+            os.remove(self.report_file)
+            self.assertEqual(director.totalMeasurements, 12)
+            summaries.append(director.summaries[0])
+
+        (sharded, sharded_scheduler), (single, single_scheduler) = summaries
+        self.assertEqual(sharded['count'], single['count'])
+        self.assertEqual(sorted(sharded['squares']),
+                         sorted(single['squares']))
+        self.assertEqual(sharded_scheduler['destinations'],
+                         single_scheduler['destinations'])
@@ -1,3 +1,5 @@
+from hashlib import sha256
+
 from ooni.templates import httpt, dnst
 
 from ooni.tests import is_internet_connected
@@ -9,6 +11,8 @@ from twisted.trial import unittest
 
 base.DelayedCall.debug = True
 
+LARGE_BODY = u'\xe9'.encode('utf-8') * 100
+
 class TestHTTPT(unittest.TestCase):
     def setUp(self):
         from twisted.web.resource import Resource
@@ -18,6 +22,8 @@ class TestHTTPT(unittest.TestCase):
             isLeaf = True
 
             def render_GET(self, request):
+                if request.path == '/large':
+                    return LARGE_BODY
                 return "%s" % request.method
 
         r = DummyResource()
@@ -46,6 +52,22 @@ class TestHTTPT(unittest.TestCase):
         yield self.assertFailure(http_test.doRequest('http://invaliddomain/'), DNSLookupError)
         assert http_test.report['requests'][0]['failure'] == 'dns_lookup_error'
 
+    @defer.inlineCallbacks
+    def test_truncated_body(self):
+        http_test = httpt.HTTPTest()
+        http_test.localOptions['socksproxy'] = None
+        http_test.maxBodySize = 11
+        http_test._setUp()
+        response = yield http_test.doRequest('http://localhost:8880/large')
+        self.assertEqual(response.body, LARGE_BODY[:11])
+        self.assertEqual(response.bodyLength, len(LARGE_BODY))
+        session = http_test.report['requests'][0]
+        self.assertEqual(session['response']['body'], u'\xe9' * 5)
+        self.assertEqual(session['response']['body_length'], len(LARGE_BODY))
+        self.assertEqual(session['response']['body_sha256'],
+                         sha256(LARGE_BODY).hexdigest())
+        self.assertTrue(session['response']['body_is_truncated'])
+
 class TestDNST(unittest.TestCase):
     def setUp(self):
         if not is_internet_connected():
@@ -0,0 +1,244 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from ooni.utils import onion, torpool
+
+
+class MockTorProtocol(object):
+    def __init__(self):
+        self.commands = []
+        self.listeners = {}
+        self.on_disconnect = defer.Deferred()
+
+    def queue_command(self, command):
+        self.commands.append(command)
+        return defer.succeed('OK')
+
+    def add_event_listener(self, event, listener):
+        self.listeners[event] = listener
+        return defer.succeed(None)
+
+    def remove_event_listener(self, event, listener):
+        del self.listeners[event]
+        return defer.succeed(None)
+
+
+class MockTorProcess(object):
+    def __init__(self):
+        self.tor_protocol = MockTorProtocol()
+
+
+class MockProcessTransport(object):
+    pid = 1234
+
+    def __init__(self):
+        self.signals = []
+
+    def closeStdin(self):
+        pass
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class MockReactor(object):
+    def __init__(self):
+        self.spawned = []
+
+    def spawnProcess(self, process, executable, args, env, path):
+        process.transport = MockProcessTransport()
+        self.spawned.append((process, args))
+        return process.transport
+
+
+class TestBridgeBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.updates = []
+        self.bootstrap = torpool.BridgeBootstrap(
+            lambda *args: self.updates.append(args))
+
+    def test_circuit_built(self):
+        self.bootstrap.orConn('$ABCD~bridge LAUNCHED ID=1')
+        self.bootstrap.orConn('$ABCD~bridge CONNECTED ID=1')
+        self.bootstrap.circ('3 LAUNCHED BUILD_FLAGS=ONEHOP_TUNNEL,IS_INTERNAL'
+                            ' PURPOSE=GENERAL')
+        self.bootstrap.circ('3 BUILT $ABCD~bridge '
+                            'BUILD_FLAGS=ONEHOP_TUNNEL,IS_INTERNAL')
+        self.assertFalse(self.bootstrap.done.called)
+        self.bootstrap.circ('4 EXTENDED $ABCD~bridge BUILD_FLAGS=NEED_CAPACITY'
+                            ' PURPOSE=GENERAL')
+        self.bootstrap.circ('4 BUILT $ABCD~bridge,$EF01~relay,$2345~exit '
+                            'BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL')
+        self.assertTrue(self.successResultOf(self.bootstrap.done))
+        self.assertEqual([update[0] for update in self.updates],
+                         [80, 85, 90, 100])
+        self.assertEqual(self.updates[-1], (100, 'done', 'Done'))
+
+    def test_status_client(self):
+        self.bootstrap.statusClient('NOTICE BOOTSTRAP PROGRESS=85 '
+                                    'TAG=handshake_or SUMMARY="Finishing '
+                                    'handshake with first hop"')
+        # The progress never goes back
+        self.bootstrap.orConn('$ABCD~bridge LAUNCHED ID=1')
+        self.assertEqual(self.updates, [
+            (85, 'handshake_or', 'Finishing handshake with first hop')
+        ])
+        self.bootstrap.finish(False)
+        self.bootstrap.finish(True)
+        self.assertFalse(self.successResultOf(self.bootstrap.done))
+
+
+class TestTorPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = torpool.TorPool(2, idle_timeout=30)
+        self.pool.clock = task.Clock()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_acquire_and_release(self):
+        first = self.successResultOf(self.pool.acquire())
+        second = self.successResultOf(self.pool.acquire())
+        self.assertIsNot(first, second)
+        d = self.pool.acquire()
+        self.assertFalse(d.called)
+        self.pool.release(first)
+        self.assertIs(self.successResultOf(d), first)
+
+    def test_prefers_running_members(self):
+        self.pool.members[1].process = MockTorProcess()
+        member = self.successResultOf(self.pool.acquire())
+        self.assertIs(member, self.pool.members[1])
+        self.pool.members[1].process = None
+
+    def test_idle_timeout(self):
+        member = self.successResultOf(self.pool.acquire())
+        member.stop = lambda: setattr(member, 'stopped', True)
+        self.pool.release(member)
+        self.pool.clock.advance(20)
+        # Using the pool again delays stopping it
+        self.pool.release(self.successResultOf(self.pool.acquire()))
+        self.pool.clock.advance(20)
+        self.assertFalse(hasattr(member, 'stopped'))
+        self.pool.clock.advance(10)
+        self.assertTrue(member.stopped)
+
+    def test_shared_directory_information(self):
+        data_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_directory)
+        for name in torpool.SHARED_CACHE_FILES + ['state']:
+            with open(os.path.join(data_directory, name), 'w') as f:
+                f.write(name)
+        self.pool.updateSeed(data_directory)
+
+        new_data_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, new_data_directory)
+        self.pool.seed(new_data_directory)
+        self.assertEqual(sorted(os.listdir(new_data_directory)),
+                         sorted(torpool.SHARED_CACHE_FILES))
+
+
+class TestTorPoolMember(unittest.TestCase):
+    def setUp(self):
+        self.pool = torpool.TorPool(1)
+        self.pool.clock = task.Clock()
+        self.member = self.pool.members[0]
+        self.member.process = MockTorProcess()
+        self.member.dataDirectory = tempfile.mkdtemp()
+        self.protocol = self.member.process.tor_protocol
+
+    def tearDown(self):
+        self.member.process = None
+        self.pool.stop()
+
+    def test_reconfigure(self):
+        d = self.member.testBridge('127.0.0.1:9001', None, '/tor.log', 120)
+        self.assertEqual(self.protocol.commands, [
+            'DROPGUARDS',
+            'SETCONF Log="notice stdout" Log="notice file /tor.log" '
+            'UseBridges="1" Bridge="127.0.0.1:9001" ClientTransportPlugin '
+            'DisableNetwork="0"'
+        ])
+        self.protocol.listeners['CIRC']('4 BUILT $ABCD~bridge '
+                                        'BUILD_FLAGS=NEED_CAPACITY')
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.protocol.listeners, {})
+        self.assertEqual(self.protocol.commands[-1],
+                         'SETCONF DisableNetwork="1" Log="notice stdout"')
+
+    def test_reconfigure_timeout(self):
+        d = self.member.testBridge('obfs4 127.0.0.1:9001',
+                                   'obfs4 exec /fakebin', '/tor.log', 120)
+        self.assertIn('ClientTransportPlugin="obfs4 exec /fakebin"',
+                      self.protocol.commands[-1])
+        self.pool.clock.advance(120)
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(self.protocol.commands[-1],
+                         'SETCONF DisableNetwork="1" Log="notice stdout"')
+
+    def test_tor_exits(self):
+        d = self.member.testBridge('127.0.0.1:9001', None, '/tor.log', 120)
+        self.member._disconnected(None, self.member.process)
+        self.assertFalse(self.successResultOf(d))
+        self.assertIs(self.member.process, None)
+        self.assertIs(self.member.dataDirectory, None)
+
+
+class TestTorPoolMemberLaunch(unittest.TestCase):
+    def setUp(self):
+        self.patch(onion, 'tor_details', {'binary': '/fakebin/tor'})
+        self.pool = torpool.TorPool(1)
+        self.pool.clock = task.Clock()
+        self.member = self.pool.members[0]
+        self.member.reactor = MockReactor()
+
+    def tearDown(self):
+        self.member.process = None
+        self.pool.stop()
+
+    def test_launch_and_test_bridge(self):
+        d = self.member.testBridge('127.0.0.1:9001', None, '/tor.log', 120)
+        [(process, args)] = self.member.reactor.spawned
+        self.assertEqual(args[args.index('DisableNetwork') + 1], '1')
+        self.assertNotIn('Bridge', args)
+        self.assertIs(self.member.process, None)
+
+        protocol = MockTorProtocol()
+        protocol.post_bootstrap = defer.succeed(protocol)
+        process.tor_connected(protocol)
+        self.assertIs(self.member.process, process)
+        # Every bridge, including the first one, is tested by reconfiguring
+        # the idle tor.
+        self.assertEqual(protocol.commands[-2:], [
+            'DROPGUARDS',
+            'SETCONF Log="notice stdout" Log="notice file /tor.log" '
+            'UseBridges="1" Bridge="127.0.0.1:9001" ClientTransportPlugin '
+            'DisableNetwork="0"'
+        ])
+
+        # The bridge does not work, but the tor is kept for the next one
+        self.pool.clock.advance(120)
+        self.assertFalse(self.successResultOf(d))
+        self.assertIs(self.member.process, process)
+        self.assertEqual(protocol.commands[-1],
+                         'SETCONF DisableNetwork="1" Log="notice stdout"')
+        self.assertEqual(process.transport.signals, [])
+
+    def test_launch_timeout(self):
+        d = self.member.testBridge('127.0.0.1:9001', None, '/tor.log', 120)
+        [(process, args)] = self.member.reactor.spawned
+        data_directory = self.member.dataDirectory
+        self.assertTrue(os.path.isdir(data_directory))
+        self.pool.clock.advance(120)
+        self.assertEqual(process.transport.signals, ['TERM'])
+        process.processEnded(failure.Failure(error.ProcessTerminated(
+            signal=15)))
+        self.assertFalse(self.successResultOf(d))
+        self.assertIs(self.member.process, None)
+        self.assertFalse(os.path.exists(data_directory))
+        self.flushLoggedErrors(RuntimeError)
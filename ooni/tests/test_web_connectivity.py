@@ -0,0 +1,107 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ooni.nettests.blocking.web_connectivity import WebConnectivityTest
+
+
+class StubWebConnectivityTest(WebConnectivityTest):
+    """
+    Records when its experiments and the control request are started and
+    leaves them pending until they are completed by the test.
+    """
+    def __init__(self, no_pipeline=False):
+        WebConnectivityTest.__init__(self)
+        self.localOptions = {
+            'url': 'http://example.com/',
+            'backend': 'http://127.0.0.1:57001',
+            'retries': 1,
+            'timeout': 240,
+            'no-pipeline': no_pipeline
+        }
+        self.report = {}
+        self.events = []
+        self.pending = {}
+        self.setUp()
+
+    def _start(self, step):
+        self.events.append(step)
+        d = defer.Deferred()
+        self.pending[step] = d
+        return d
+
+    def complete(self, step, result=None):
+        self.events.append(step + ' done')
+        self.pending.pop(step).callback(result)
+
+    def experiment_dns_query(self):
+        return self._start('dns')
+
+    def experiment_tcp_connect(self, socket):
+        return self._start('tcp ' + socket)
+
+    def experiment_http_get_request(self):
+        return self._start('http')
+
+    def control_request(self, sockets):
+        d = self._start('control')
+
+        @d.addCallback
+        def cb(control):
+            self.control = control
+            self.report['control'] = control
+        return d
+
+
+control = {
+    'tcp_connect': {'93.184.216.34:80': {'status': True, 'failure': None}},
+    'dns': {'addrs': ['93.184.216.34'], 'failure': None},
+    'http_request': {'body_length': -1, 'failure': 'connection_refused',
+                     'status_code': -1, 'headers': {}, 'title': ''}
+}
+
+
+class TestWebConnectivity(unittest.TestCase):
+    def run_test(self, web_connectivity):
+        d = web_connectivity.test_web_connectivity()
+        web_connectivity.complete('dns', ['93.184.216.34'])
+        web_connectivity.complete('tcp 93.184.216.34:80')
+        web_connectivity.complete('http')
+        if 'control' in web_connectivity.pending:
+            web_connectivity.complete('control', control)
+        self.assertTrue(d.called)
+        return d
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        web_connectivity = StubWebConnectivityTest()
+        yield self.run_test(web_connectivity)
+        # The control request is sent as soon as the DNS experiment is done
+        self.assertEqual(web_connectivity.events, [
+            'dns', 'dns done', 'control', 'tcp 93.184.216.34:80',
+            'tcp 93.184.216.34:80 done', 'http', 'http done', 'control done'
+        ])
+        self.assertEqual(web_connectivity.report['control'], control)
+        self.assertEqual(web_connectivity.report['dns_consistency'],
+                         'consistent')
+
+    @defer.inlineCallbacks
+    def test_no_pipeline(self):
+        web_connectivity = StubWebConnectivityTest(no_pipeline=True)
+        yield self.run_test(web_connectivity)
+        self.assertEqual(web_connectivity.events, [
+            'dns', 'dns done', 'tcp 93.184.216.34:80',
+            'tcp 93.184.216.34:80 done', 'http', 'http done', 'control',
+            'control done'
+        ])
+        self.assertEqual(web_connectivity.report['control'], control)
+
+    @defer.inlineCallbacks
+    def test_runtimes(self):
+        web_connectivity = StubWebConnectivityTest()
+        yield self.run_test(web_connectivity)
+        runtimes = web_connectivity.report['runtimes']
+        self.assertEqual(sorted(runtimes.keys()),
+                         ['control_request', 'dns_experiment',
+                          'http_experiment', 'tcp_connect'])
+        for runtime in runtimes.values():
+            self.assertTrue(runtime >= 0)
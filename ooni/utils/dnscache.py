@@ -0,0 +1,165 @@
+"""
+A cache of the DNS lookups made by all the measurements of an ooniprobe
+process.
+"""
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from twisted.names import dns, error
+
+
+def _records(result):
+    """
+    Returns the answers and the authority records of the result of a query,
+    which is either a :class:twisted.names.dns.Message or the (answers,
+    authority, additional) tuple that the lookup methods of the resolvers
+    return.
+    """
+    if isinstance(result, dns.Message):
+        return result.answers, result.authority
+    return result[0], result[1]
+
+
+class DNSCache(object):
+    """
+    Remembers the results of the DNS lookups for as long as their TTL allows
+    and makes the lookups for a name that is already being looked up wait
+    for the same query instead of sending their own.
+
+    The answers are cached for the lowest TTL among them. Empty answers and
+    the names that do not exist are cached for the TTL of the SOA record that
+    came with them, as per RFC 2308, or for negativeTTL seconds if there was
+    none. The other failures, like timeouts, are never cached.
+
+    Only the last cacheSize results are kept.
+    """
+    cacheSize = 4096
+    negativeTTL = 60
+
+    # So that we can test when the results expire
+    clock = reactor
+
+    def __init__(self):
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._cache = OrderedDict()
+        self._inFlight = {}
+
+    def _count(self, outcome, stats):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        if stats is not None:
+            stats[outcome] = stats.get(outcome, 0) + 1
+
+    def _ttl(self, answers, authority):
+        if answers:
+            return min(answer.ttl for answer in answers)
+        for record in authority:
+            if record.type == dns.SOA:
+                return min(record.ttl, record.payload.minimum)
+        return self.negativeTTL
+
+    def _store(self, key, result):
+        if isinstance(result, Failure):
+            if not result.check(error.DNSNameError):
+                return
+            message = result.value.args[0] if result.value.args else None
+            if isinstance(message, dns.Message):
+                ttl = self._ttl([], message.authority)
+            else:
+                ttl = self.negativeTTL
+        else:
+            ttl = self._ttl(*_records(result))
+        if ttl <= 0:
+            return
+
+        self._cache.pop(key, None)
+        if len(self._cache) >= self.cacheSize:
+            self._cache.popitem(last=False)
+        self._cache[key] = (self.clock.seconds() + ttl, result)
+
+    def _cached(self, key):
+        try:
+            expires, result = self._cache.pop(key)
+        except KeyError:
+            return None
+        if expires <= self.clock.seconds():
+            return None
+        self._cache[key] = (expires, result)
+        return result
+
+    def lookup(self, key, query, bypass=False, stats=None):
+        """
+        Returns a Deferred that fires with the result of the lookup identified
+        by key, calling query to send it if it is neither cached nor in
+        flight. query must return a Deferred.
+
+        If bypass is True the query is sent regardless and its result is not
+        cached, for the measurements that need to see what is on the wire.
+
+        Whether the lookup was a hit, coalesced, a miss or bypassed is also
+        counted in the stats dict, if given.
+        """
+        if bypass:
+            self._count('bypassed', stats)
+            return query()
+
+        result = self._cached(key)
+        if result is not None:
+            self._count('hits', stats)
+            if isinstance(result, Failure):
+                return defer.fail(result)
+            return defer.succeed(result)
+
+        d = defer.Deferred()
+        if key in self._inFlight:
+            self._count('coalesced', stats)
+            self._inFlight[key].append(d)
+            return d
+
+        self._count('misses', stats)
+        self._inFlight[key] = [d]
+
+        def done(result):
+            self._store(key, result)
+            for waiting in self._inFlight.pop(key):
+                if isinstance(result, Failure):
+                    waiting.errback(result)
+                else:
+                    waiting.callback(result)
+
+        defer.maybeDeferred(query).addBoth(done)
+        return d
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def summary(self):
+        return cacheSummary({
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'bypassed': self.bypassed
+        })
+
+
+def cacheSummary(stats):
+    """
+    Adds the total number of lookups and the ratio of the ones that did not
+    need to send a query to the counters of a DNSCache.
+    """
+    stats = dict(stats)
+    for outcome in ('hits', 'coalesced', 'misses', 'bypassed'):
+        stats.setdefault(outcome, 0)
+    stats['lookups'] = sum(stats.values())
+    cacheable = stats['lookups'] - stats['bypassed']
+    stats['hit_ratio'] = 0.0
+    if cacheable:
+        stats['hit_ratio'] = \
+            float(stats['hits'] + stats['coalesced']) / cacheable
+    return stats
+
+dns_cache = DNSCache()
@@ -0,0 +1,189 @@
+"""
+Sends a large number of DNS queries over UDP at the same time, without
+opening a socket for each of them.
+"""
+import math
+import random
+
+from twisted.internet import defer, protocol, reactor
+from twisted.names import dns, error
+
+from ooni.utils import log
+
+
+def questions(queries):
+    return [(str(query.name).lower(), query.type, query.cls)
+            for query in queries]
+
+
+class DNSEngineProtocol(protocol.DatagramProtocol):
+    noisy = False
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def datagramReceived(self, data, addr):
+        self.engine.datagramReceived(self, data, addr)
+
+
+class PendingQuery(object):
+    def __init__(self, queries, data, timeouts):
+        self.queries = queries
+        self.data = data
+        self.timeouts = timeouts
+        self.slot = None
+        self.deferred = defer.Deferred()
+
+
+class DNSEngine(object):
+    """
+    Multiplexes the DNS queries over a pool of sockets that stay open, so
+    that thousands of them can be outstanding at the same time.
+
+    Every query gets an ID that is not in use for the same server on the
+    same socket, and a response is only taken as the answer to a query if it
+    comes from the server the query was sent to, with the same ID and the
+    same question. The other responses are ignored.
+
+    Instead of a timer for every query, the timeouts are kept in a timer
+    wheel whose slots are resolution seconds apart, which is checked every
+    resolution seconds while queries are pending. A query is sent again for
+    every timeout in its list of timeouts, like
+    :meth:twisted.names.client.Resolver.queryUDP does.
+    """
+    sockets = 4
+    resolution = 0.1
+    maxPacketSize = 4096
+
+    # So that we can test the timeouts
+    clock = reactor
+    # So that we can test the listenUDP calls
+    reactor = reactor
+
+    def __init__(self):
+        self._protocols = []
+        self._ports = []
+        self._nextProtocol = 0
+        self._pending = {}
+        self._wheel = {}
+        self._ticker = None
+
+    def _listen(self):
+        for _ in range(self.sockets - len(self._protocols)):
+            engine_protocol = DNSEngineProtocol(self)
+            self._ports.append(self.reactor.listenUDP(
+                0, engine_protocol, maxPacketSize=self.maxPacketSize))
+            self._protocols.append(engine_protocol)
+
+    def query(self, queries, address, timeout=(1,)):
+        """
+        Sends the queries, a list of :class:twisted.names.dns.Query, to the
+        DNS server at address, a tuple of IP address and port, and returns a
+        Deferred that fires with the :class:twisted.names.dns.Message it
+        answers with or fails with
+        :class:twisted.names.error.DNSQueryTimeoutError.
+        """
+        try:
+            self._listen()
+        except Exception:
+            return defer.fail()
+
+        engine_protocol = self._protocols[self._nextProtocol]
+        self._nextProtocol = (self._nextProtocol + 1) % len(self._protocols)
+        address = (address[0], int(address[1]))
+        while True:
+            key = (engine_protocol, address, random.randint(0, 0xffff))
+            if key not in self._pending:
+                break
+
+        message = dns.Message(key[2], recDes=1)
+        message.queries = queries
+        pending = PendingQuery(queries, message.toStr(), list(timeout))
+        self._pending[key] = pending
+        self._send(key, pending)
+        return pending.deferred
+
+    @property
+    def outstanding(self):
+        return len(self._pending)
+
+    def _send(self, key, pending):
+        engine_protocol, address, _ = key
+        try:
+            engine_protocol.transport.write(pending.data, address)
+        except Exception:
+            del self._pending[key]
+            pending.deferred.errback()
+            return
+        self._schedule(key, pending,
+                       self.clock.seconds() + pending.timeouts.pop(0))
+
+    def _schedule(self, key, pending, deadline):
+        pending.slot = int(math.ceil(deadline / self.resolution))
+        self._wheel.setdefault(pending.slot, set()).add(key)
+        if self._ticker is None:
+            self._ticker = self.clock.callLater(self.resolution, self._tick)
+
+    def _unschedule(self, key, pending):
+        keys = self._wheel.get(pending.slot)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._wheel[pending.slot]
+
+    def _tick(self):
+        self._ticker = None
+        # A slot is due once its deadline is in the past
+        now = int(math.floor(self.clock.seconds() / self.resolution))
+        for slot in sorted(slot for slot in self._wheel if slot <= now):
+            for key in self._wheel.pop(slot):
+                pending = self._pending[key]
+                if pending.timeouts:
+                    self._send(key, pending)
+                else:
+                    del self._pending[key]
+                    pending.deferred.errback(
+                        error.DNSQueryTimeoutError(pending.queries))
+        if self._wheel and self._ticker is None:
+            self._ticker = self.clock.callLater(self.resolution, self._tick)
+
+    def datagramReceived(self, engine_protocol, data, addr):
+        message = dns.Message()
+        try:
+            message.fromStr(data)
+        except Exception:
+            log.debug("Invalid DNS response from %s:%d" % addr)
+            return
+
+        key = (engine_protocol, addr, message.id)
+        pending = self._pending.get(key)
+        if pending is None:
+            # A late response to a query that has timed out
+            return
+        if questions(message.queries) != questions(pending.queries):
+            log.debug("DNS response from %s:%d for another question" % addr)
+            return
+
+        del self._pending[key]
+        self._unschedule(key, pending)
+        pending.deferred.callback(message)
+
+    def stop(self):
+        """
+        Closes the sockets. The queries that are still pending fail with
+        :class:twisted.names.error.DNSQueryTimeoutError.
+        """
+        pending, self._pending = self._pending, {}
+        self._wheel.clear()
+        if self._ticker is not None and self._ticker.active():
+            self._ticker.cancel()
+        self._ticker = None
+        for query in pending.values():
+            query.deferred.errback(error.DNSQueryTimeoutError(query.queries))
+
+        ports, self._ports, self._protocols = self._ports, [], []
+        self._nextProtocol = 0
+        return defer.DeferredList([defer.maybeDeferred(port.stopListening)
+                                   for port in ports])
+
+dns_engine = DNSEngine()
@@ -0,0 +1,121 @@
+"""
+Measures how long the modules imported while ooniprobe starts take to load.
+
+It has to be installed before anything else gets imported, which is why the
+entry points look for --profile-startup in sys.argv themselves.
+"""
+import sys
+import time
+import __builtin__
+
+
+class ImportProfiler(object):
+    """
+    Times every import that loads new modules. The cumulative time of a
+    module includes the modules it imports, while its own time does not.
+    """
+    def __init__(self):
+        self.cumulative = {}
+        self.own = {}
+        self.total = 0.0
+        self.reported = False
+        self._import = None
+        self._stack = []
+        self._names = []
+        self._startTime = None
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._profiledImport
+        self._startTime = time.time()
+
+    def uninstall(self):
+        if self._import is not None:
+            __builtin__.__import__ = self._import
+            self._import = None
+
+    def _moduleName(self, name, globals):
+        if not globals or not globals.get('__name__'):
+            return name
+        package = globals['__name__']
+        if '__path__' not in globals:
+            package = package.rpartition('.')[0]
+        if not name:
+            # from . import foo
+            return package
+        # Python 2 tries the name relative to the importing package first
+        if package and name not in sys.modules and \
+                '%s.%s' % (package, name) in sys.modules:
+            return '%s.%s' % (package, name)
+        return name
+
+    def _profiledImport(self, name, globals=None, locals=None, fromlist=None,
+                        level=-1):
+        loaded = len(sys.modules)
+        # A package can be imported again while it is still loading, in
+        # which case the inner import is already part of its cumulative time
+        nested = name in self._names
+        self._names.append(name)
+        # The time spent in the imports made by this one
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            self._names.pop()
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if len(sys.modules) > loaded:
+                module_name = self._moduleName(name, globals)
+                if not nested:
+                    self.cumulative[module_name] = \
+                        self.cumulative.get(module_name, 0) + elapsed
+                self.own[module_name] = \
+                    self.own.get(module_name, 0) + elapsed - children
+                self.total += elapsed - children
+
+    def report(self, stream=sys.stderr, limit=30):
+        total = time.time() - self._startTime
+        stream.write("Startup took %.3fs, %.3fs of which importing %d "
+                     "modules\n" % (total, self.total, len(self.own)))
+        stream.write("%10s %10s  %s\n" % ("cumulative", "own", "module"))
+        modules = sorted(self.cumulative.items(), key=lambda item: item[1],
+                         reverse=True)
+        for module_name, cumulative in modules[:limit]:
+            stream.write("%8.1fms %8.1fms  %s\n" % (
+                cumulative * 1000, self.own[module_name] * 1000, module_name))
+
+
+def profileStartup(argv=sys.argv):
+    """
+    Starts profiling the imports if --profile-startup is among the arguments
+    and returns the profiler, otherwise returns None.
+    """
+    if '--profile-startup' not in argv:
+        return None
+    profiler = ImportProfiler()
+    profiler.install()
+    return profiler
+
+
+def reportStartup(profiler):
+    """
+    Prints the import times once the reactor is running, which is when
+    ooniprobe is done starting up, or when exiting if it never gets there, as
+    with ooniprobe -s.
+    """
+    if profiler is None:
+        return
+    import atexit
+    from twisted.internet import reactor
+
+    def report():
+        if profiler.reported:
+            return
+        profiler.uninstall()
+        profiler.report()
+        profiler.reported = True
+    reactor.callWhenRunning(report)
+    atexit.register(report)
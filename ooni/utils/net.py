@@ -1,14 +1,13 @@
 import sys
 import socket
 from random import randint
+from hashlib import sha256
 
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet.protocol import Factory, Protocol
 from twisted.web.iweb import IBodyProducer
 
-from scapy.config import conf
-
 from ooni.errors import IfaceError
 
 # This is our own connectProtocol to avoid noisy twisted cluttering our logs
@@ -123,14 +122,20 @@ class BodyReceiver(Protocol):
 
 
 class Downloader(Protocol):
+    """
+    Writes the body of a response to download_path, hashing it on the way,
+    and fires finished with its hex sha256 digest.
+    """
     def __init__(self, download_path,
                  finished, content_length=None):
         self.finished = finished
         self.bytes_remaining = content_length
         self.fp = open(download_path, 'w+')
+        self.sha256 = sha256()
 
     def dataReceived(self, b):
         self.fp.write(b)
+        self.sha256.update(b)
         if self.bytes_remaining:
             if self.bytes_remaining == 0:
                 self.connectionLost(None)
@@ -140,7 +145,7 @@ class Downloader(Protocol):
     def connectionLost(self, reason):
         self.fp.flush()
         self.fp.close()
-        self.finished.callback(None)
+        self.finished.callback(self.sha256.hexdigest())
 
 
 class ConnectAndCloseProtocol(Protocol):
@@ -174,6 +179,7 @@ def randomFreePort(addr="127.0.0.1"):
 
 def getDefaultIface():
     """ Return the default interface or raise IfaceError """
+    from scapy.config import conf
     iface = conf.route.route('0.0.0.0', verbose=0)[0]
     if len(iface) > 0:
         return iface
@@ -4,8 +4,6 @@ import subprocess
 from distutils.spawn import find_executable
 from distutils.version import LooseVersion
 
-from txtorcon.util import find_tor_binary as tx_find_tor_binary
-
 from ooni.settings import config
 
 ONION_ADDRESS_REGEXP = re.compile("^((httpo|http|https)://)?"
@@ -22,6 +20,7 @@ class OBFSProxyVersion(LooseVersion):
 def find_tor_binary():
     if config.advanced.tor_binary:
         return config.advanced.tor_binary
+    from txtorcon.util import find_tor_binary as tx_find_tor_binary
     return tx_find_tor_binary()
 
 
@@ -73,15 +72,30 @@ def is_onion_address(address):
 
 
 
-tor_details = {
+class LazyDetails(dict):
+    """
+    A dict that is filled in by find_details the first time one of its keys
+    is looked up, so that the executables are only run when their details
+    are needed and not every time ooniprobe starts.
+    """
+    def __init__(self, find_details):
+        dict.__init__(self)
+        self._findDetails = find_details
+
+    def __missing__(self, key):
+        self.update(self._findDetails())
+        return dict.__getitem__(self, key)
+
+
+tor_details = LazyDetails(lambda: {
     'binary': find_tor_binary(),
     'version': tor_version()
-}
+})
 
-obfsproxy_details = {
+obfsproxy_details = LazyDetails(lambda: {
     'binary': find_executable('obfsproxy'),
     'version': obfsproxy_version()
-}
+})
 
 transport_bin_name = { 'fte': 'fteproxy',
                        'scramblesuit': 'obfsproxy',
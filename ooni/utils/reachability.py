@@ -0,0 +1,192 @@
+"""
+Finds which of the addresses of a backend (a collector or a test helper) is
+reachable, and remembers it across the runs of ooniprobe.
+"""
+import os
+import json
+
+from twisted.internet import defer, reactor
+
+from ooni.settings import config
+from ooni.utils import log
+
+
+class ReachabilityCache(object):
+    """
+    Remembers for ttl seconds whether the backends were reachable and what
+    the bouncer answered, in a JSON file in the ooni home, so that
+    consecutive runs of ooniprobe (for example from cron) do not look them
+    up again.
+
+    A ttl of 0 or None disables the cache.
+    """
+    # So that we can test when the entries expire
+    clock = reactor
+
+    def __init__(self, path=None, ttl=None):
+        if path is None:
+            path = os.path.join(config.ooni_home, 'reachability.json')
+        if ttl is None:
+            ttl = config.advanced.reachability_cache_ttl
+        self.path = path
+        self.ttl = ttl or 0
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except IOError:
+            pass
+        except ValueError:
+            log.debug("Ignoring the invalid reachability cache %s" %
+                      self.path)
+
+    def _save(self):
+        now = self.clock.seconds()
+        self._entries = dict((key, entry)
+                             for key, entry in self._entries.items()
+                             if entry['expires_at'] > now)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            log.debug("Could not save the reachability cache: %s" % exc)
+
+    def get(self, key):
+        """
+        Returns what was stored for key or None if it has expired.
+        """
+        if self.ttl <= 0:
+            return None
+        self._load()
+        entry = self._entries.get(key)
+        if entry is None or entry['expires_at'] <= self.clock.seconds():
+            return None
+        # So that the callers can modify what they get
+        return json.loads(json.dumps(entry['value']))
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self._load()
+        self._entries[key] = {
+            'value': json.loads(json.dumps(value)),
+            'expires_at': self.clock.seconds() + self.ttl
+        }
+        self._save()
+
+    def remove(self, key):
+        if self.ttl <= 0:
+            return
+        self._load()
+        if self._entries.pop(key, None) is not None:
+            self._save()
+
+
+def backend_key(settings):
+    return ' '.join([settings['type'], settings['address'],
+                     settings.get('front') or '']).strip()
+
+
+def first_reachable(name, candidates, cache=None):
+    """
+    Checks the reachability of all the candidates at the same time and
+    returns a Deferred that fires with the first one in the list that is
+    reachable, or with None if none of them is.
+
+    The most preferred candidates come first in the list, so a candidate
+    wins as soon as it is reachable and all the ones before it are known
+    not to be, at which point the other checks are cancelled.
+
+    The verdicts found in the cache are used instead of checking again,
+    unless they would leave us with no reachable candidate.
+
+    Args:
+        name:
+            what the candidates are, for the log messages.
+        candidates:
+            a list of (key, client) tuples, where key identifies the address
+            of the client in the cache.
+    """
+    result = defer.Deferred()
+    verdicts = [None] * len(candidates)
+    probes = {}
+    starting = [True]
+    done = [False]
+
+    def finish(client):
+        if done[0]:
+            return
+        done[0] = True
+        for probe in probes.values():
+            if not probe.called:
+                probe.cancel()
+        result.callback(client)
+
+    def decide():
+        if starting[0] or done[0]:
+            return
+        for idx, verdict in enumerate(verdicts):
+            if verdict is None:
+                # We are still waiting for a more preferred candidate
+                return
+            if verdict:
+                finish(candidates[idx][1])
+                return
+        unchecked = [idx for idx in range(len(candidates))
+                     if idx not in probes]
+        if unchecked:
+            log.debug("No %s is reachable according to the cache, "
+                      "checking again" % name)
+            start(unchecked)
+        else:
+            finish(None)
+
+    def probed(reachable, idx):
+        key = candidates[idx][0]
+        verdicts[idx] = bool(reachable)
+        if not reachable:
+            log.err("Unreachable %s %s" % (name, key))
+        if cache is not None:
+            cache.set(key, verdicts[idx])
+        decide()
+
+    def failed(failure, idx):
+        if failure.check(defer.CancelledError) and done[0]:
+            return
+        log.err("Failed to check the reachability of %s %s" % (
+            name, candidates[idx][0]))
+        log.exception(failure)
+        verdicts[idx] = False
+        decide()
+
+    def start(indexes):
+        starting[0] = True
+        for idx in indexes:
+            verdicts[idx] = None
+            probe = defer.maybeDeferred(candidates[idx][1].isReachable)
+            probes[idx] = probe
+            probe.addCallbacks(probed, failed, callbackArgs=(idx,),
+                               errbackArgs=(idx,))
+        starting[0] = False
+        decide()
+
+    to_check = []
+    for idx, (key, client) in enumerate(candidates):
+        cached = cache.get(key) if cache is not None else None
+        if cached is None:
+            to_check.append(idx)
+            continue
+        log.debug("Using the cached reachability of %s %s" % (name, key))
+        verdicts[idx] = cached
+        if cached:
+            # There is no need to check the less preferred ones
+            break
+    start(to_check)
+    return result
@@ -0,0 +1,458 @@
+"""
+A pool of long lived tor processes that are reconfigured over their control
+port to test one bridge at a time, instead of launching and bootstrapping a
+new tor for every bridge.
+"""
+import os
+import re
+import shutil
+import tempfile
+
+from twisted.internet import defer, error, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+
+import txtorcon
+
+from ooni.utils import log, onion
+from ooni.utils.net import randomFreePort
+
+# The files of the DataDirectory that only contain directory information
+# signed by the directory authorities, which tor checks when loading them and
+# which does not depend on the bridges that were used. The state file, that
+# holds the guards, is never shared.
+SHARED_CACHE_FILES = [
+    'cached-certs',
+    'cached-microdesc-consensus',
+    'cached-microdescs',
+    'cached-microdescs.new'
+]
+
+BOOTSTRAP_REGEXP = re.compile('BOOTSTRAP PROGRESS=(\d+) TAG=(\S+) '
+                              'SUMMARY="(.*?)"')
+
+
+def setconf(*options):
+    """
+    Returns the SETCONF command that sets the given (key, value) options,
+    where a value of None resets the option to its default.
+    """
+    args = []
+    for key, value in options:
+        if value is None:
+            args.append(key)
+        else:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            args.append('%s="%s"' % (key, value))
+    return 'SETCONF ' + ' '.join(args)
+
+
+class BridgeBootstrap(object):
+    """
+    Follows the events of a tor that was told to use a new bridge and fires
+    done with True once a circuit has been built through it.
+
+    tor reports its bootstrap progress only until it first reaches 100%, so
+    the progress of a reused tor is derived from its connection and circuit
+    events, using the phases of the bootstrap status events.
+    """
+    def __init__(self, progress_updates=None):
+        self.progress_updates = progress_updates
+        self.progress = 0
+        self.done = defer.Deferred()
+
+    def update(self, progress, tag, summary):
+        if progress <= self.progress:
+            return
+        self.progress = progress
+        if self.progress_updates:
+            self.progress_updates(progress, tag, summary)
+
+    def finish(self, success):
+        if not self.done.called:
+            self.done.callback(success)
+
+    def statusClient(self, data):
+        match = BOOTSTRAP_REGEXP.search(data)
+        if match:
+            self.update(int(match.group(1)), match.group(2), match.group(3))
+
+    def orConn(self, data):
+        fields = data.split()
+        if len(fields) < 2:
+            return
+        if fields[1] == 'LAUNCHED':
+            self.update(80, 'conn_or', 'Connecting to the Tor network')
+        elif fields[1] == 'CONNECTED':
+            self.update(85, 'handshake_or',
+                        'Finishing handshake with first hop')
+
+    def circ(self, data):
+        fields = data.split()
+        # The one hop circuits are only used to fetch the bridge descriptor
+        if len(fields) < 2 or 'ONEHOP_TUNNEL' in data:
+            return
+        if fields[1] in ('LAUNCHED', 'EXTENDED'):
+            self.update(90, 'circuit_create', 'Establishing a Tor circuit')
+        elif fields[1] == 'BUILT':
+            self.update(100, 'done', 'Done')
+            self.finish(True)
+
+
+class IdleTorProcessProtocol(txtorcon.TorProcessProtocol):
+    """
+    A TorProcessProtocol whose connected_cb fires as soon as the control
+    connection is set up, instead of once tor has bootstrapped, which it
+    does not do while its network is disabled.
+    """
+    def protocol_bootstrapped(self, proto):
+        txtorcon.TorProcessProtocol.protocol_bootstrapped(self, proto)
+        if self.connected_cb is not None:
+            self.connected_cb.callback(self)
+            self.connected_cb = None
+
+
+class TorPoolMember(object):
+    """
+    A tor process of the pool. It is launched with its network disabled, so
+    that a broken bridge does not cost a new tor, and is then reconfigured
+    to test every bridge it is given until the pool is stopped.
+    """
+    # So that we can test the spawnProcess calls
+    reactor = reactor
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.process = None
+        self.dataDirectory = None
+        self.bootstrap = None
+        self.transportLogOffset = 0
+
+    @property
+    def transportLogPath(self):
+        return os.path.join(self.dataDirectory, 'pt_state', 'obfs4proxy.log')
+
+    def transportLog(self):
+        """
+        Returns what obfs4proxy logged in the DataDirectory since the last
+        bridge test started or None if it did not log anything.
+        """
+        if self.dataDirectory is None:
+            return None
+        try:
+            with open(self.transportLogPath) as f:
+                f.seek(self.transportLogOffset)
+                return f.read()
+        except IOError:
+            return None
+
+    @defer.inlineCallbacks
+    def testBridge(self, bridge, transport_line, tor_logfile, timeout,
+                   progress_updates=None):
+        """
+        Connects to the Tor network through bridge and returns a Deferred
+        that fires with True if it succeeded within timeout seconds and with
+        False otherwise.
+
+        Args:
+            bridge:
+                the Bridge line to use, without the "Bridge" keyword.
+            transport_line:
+                the ClientTransportPlugin line of the transport of the bridge
+                or None if it is a vanilla bridge.
+            tor_logfile:
+                where tor should log while testing this bridge.
+            progress_updates:
+                is called with the progress, tag and summary of the
+                bootstrap.
+        """
+        if self.process is None:
+            launched = yield self._launch(tor_logfile, timeout)
+            if not launched:
+                defer.returnValue(False)
+        success = yield self._reconfigure(bridge, transport_line, tor_logfile,
+                                          timeout, progress_updates)
+        defer.returnValue(success)
+
+    @defer.inlineCallbacks
+    def _launch(self, tor_logfile, timeout):
+        """
+        Launches tor with its network disabled and returns a Deferred that
+        fires with True once we are connected to its control port.
+        """
+        self.dataDirectory = tempfile.mkdtemp()
+        self.transportLogOffset = 0
+        self.pool.seed(self.dataDirectory)
+
+        config = txtorcon.TorConfig()
+        config.ControlPort = randomFreePort()
+        config.SocksPort = randomFreePort()
+        config.DataDirectory = self.dataDirectory
+        config.DisableNetwork = 1
+        config.CookieAuthentication = 1
+        # So that tor exits when we do
+        setattr(config, '__OwningControllerProcess', os.getpid())
+        config.log = ['notice stdout', 'notice file %s' % tor_logfile]
+        config.save()
+
+        endpoint = TCP4ClientEndpoint(self.reactor, 'localhost',
+                                      config.ControlPort)
+        process = IdleTorProcessProtocol(
+            lambda: txtorcon.build_tor_connection(endpoint,
+                                                  build_state=False),
+            config=config)
+        args = [onion.tor_details['binary'], '-f', '/non-existant',
+                '--ignore-missing-torrc']
+        for key, value in config.config_args():
+            args.extend([key, value])
+
+        try:
+            transport = self.reactor.spawnProcess(
+                process, onion.tor_details['binary'], args=args,
+                env={'HOME': self.dataDirectory}, path=self.dataDirectory)
+        except (OSError, RuntimeError) as exc:
+            log.debug("Failed to launch tor: %s" % exc)
+            self._removeDataDirectory()
+            defer.returnValue(False)
+        transport.closeStdin()
+
+        timer = self.pool.clock.callLater(timeout, self._terminate, process)
+        try:
+            yield process.connected_cb
+        except Exception as exc:
+            # tor has exited or has been killed
+            log.debug("Failed to launch tor: %s" % exc)
+            self._removeDataDirectory()
+            defer.returnValue(False)
+        finally:
+            if timer.active():
+                timer.cancel()
+
+        self.process = process
+        process.tor_protocol.on_disconnect.addBoth(self._disconnected,
+                                                   process)
+        self.pool.launched(self)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _reconfigure(self, bridge, transport_line, tor_logfile, timeout,
+                     progress_updates):
+        protocol = self.process.tor_protocol
+        try:
+            self.transportLogOffset = os.path.getsize(self.transportLogPath)
+        except OSError:
+            self.transportLogOffset = 0
+
+        self.bootstrap = BridgeBootstrap(progress_updates)
+        listeners = [('STATUS_CLIENT', self.bootstrap.statusClient),
+                     ('ORCONN', self.bootstrap.orConn),
+                     ('CIRC', self.bootstrap.circ)]
+        timer = self.pool.clock.callLater(timeout, self.bootstrap.finish,
+                                          False)
+        try:
+            try:
+                # So that tor does not try the bridges tested before
+                yield protocol.queue_command('DROPGUARDS')
+            except txtorcon.TorProtocolError:
+                log.debug("This tor does not support DROPGUARDS")
+            for event, listener in listeners:
+                yield protocol.add_event_listener(event, listener)
+            yield protocol.queue_command(setconf(
+                ('Log', 'notice stdout'),
+                ('Log', 'notice file %s' % tor_logfile),
+                ('UseBridges', 1),
+                ('Bridge', bridge),
+                ('ClientTransportPlugin', transport_line),
+                ('DisableNetwork', 0)
+            ))
+            success = yield self.bootstrap.done
+        except txtorcon.TorProtocolError as exc:
+            log.debug("tor refused to use %s: %s" % (bridge, exc))
+            success = False
+        except Exception as exc:
+            log.err("Lost the control connection of tor while testing %s" %
+                    bridge)
+            log.exception(exc)
+            self.stop()
+            defer.returnValue(False)
+        finally:
+            if timer.active():
+                timer.cancel()
+            self.bootstrap = None
+
+        if self.process is None:
+            # tor exited while the bridge was being tested
+            defer.returnValue(success)
+        for event, listener in listeners:
+            yield protocol.remove_event_listener(event, listener)
+        yield self._idle()
+        defer.returnValue(success)
+
+    @defer.inlineCallbacks
+    def _idle(self):
+        """
+        Disables the network, which closes all the connections and circuits
+        through the bridge, until the next bridge is tested.
+        """
+        try:
+            yield self.process.tor_protocol.queue_command(setconf(
+                ('DisableNetwork', 1),
+                ('Log', 'notice stdout')
+            ))
+        except Exception as exc:
+            log.err("Failed to disable the network of tor")
+            log.exception(exc)
+            self.stop()
+            return
+        self.pool.updateSeed(self.dataDirectory)
+
+    def _disconnected(self, result, process):
+        if process is not self.process:
+            return
+        log.debug("The control connection of tor was closed")
+        self.process = None
+        if self.bootstrap is not None:
+            self.bootstrap.finish(False)
+        self._removeDataDirectory()
+
+    def _removeDataDirectory(self):
+        if self.dataDirectory is not None:
+            shutil.rmtree(self.dataDirectory, ignore_errors=True)
+            self.dataDirectory = None
+
+    @staticmethod
+    def _terminate(process):
+        try:
+            process.transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            process.transport.loseConnection()
+
+    def stop(self):
+        process = self.process
+        self.process = None
+        if process is not None:
+            self._terminate(process)
+        self._removeDataDirectory()
+
+
+class TorPool(object):
+    """
+    Hands out up to size tor processes, each used to test one bridge at a
+    time, and shares the directory information they fetched so that the
+    ones launched later do not bootstrap from scratch.
+
+    The tor processes are stopped once none of them has been used for
+    idle_timeout seconds, or when the reactor shuts down.
+    """
+    # So that we can test the idle timeout
+    clock = reactor
+
+    def __init__(self, size, idle_timeout=30):
+        self.size = size
+        self.idleTimeout = idle_timeout
+        self.members = [TorPoolMember(self) for _ in range(size)]
+        self.free = list(self.members)
+        self.waiting = []
+        self.seedDirectory = None
+        self._idleCall = None
+        self._shutdownTrigger = None
+
+    def acquire(self):
+        """
+        Returns a Deferred that fires with a free member, preferring the ones
+        that are already running.
+        """
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.cancel()
+        self._idleCall = None
+        if not self.free:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        running = [member for member in self.free
+                   if member.process is not None]
+        member = (running or self.free)[0]
+        self.free.remove(member)
+        return defer.succeed(member)
+
+    def release(self, member):
+        if self.waiting:
+            self.waiting.pop(0).callback(member)
+            return
+        self.free.append(member)
+        if len(self.free) == self.size and self.idleTimeout:
+            self._idleCall = self.clock.callLater(self.idleTimeout,
+                                                  self.stop)
+
+    def launched(self, member):
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._shutdown)
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        self.stop()
+
+    def seed(self, data_directory):
+        """
+        Copies the shared directory information to the DataDirectory of a
+        tor that is about to be launched.
+        """
+        if self.seedDirectory is None:
+            return
+        for name in SHARED_CACHE_FILES:
+            path = os.path.join(self.seedDirectory, name)
+            if not os.path.exists(path):
+                continue
+            try:
+                shutil.copy2(path, os.path.join(data_directory, name))
+            except (IOError, OSError) as exc:
+                log.debug("Failed to copy %s: %s" % (name, exc))
+
+    def updateSeed(self, data_directory):
+        """
+        Keeps the directory information of data_directory to share it, if
+        its consensus is more recent than the one that is shared.
+        """
+        if data_directory is None:
+            return
+        consensus = os.path.join(data_directory, SHARED_CACHE_FILES[1])
+        try:
+            mtime = os.path.getmtime(consensus)
+        except OSError:
+            return
+        if self.seedDirectory is None:
+            self.seedDirectory = tempfile.mkdtemp()
+        try:
+            if os.path.getmtime(os.path.join(self.seedDirectory,
+                                             SHARED_CACHE_FILES[1])) >= mtime:
+                return
+        except OSError:
+            pass
+        for name in SHARED_CACHE_FILES:
+            path = os.path.join(data_directory, name)
+            seed_path = os.path.join(self.seedDirectory, name)
+            try:
+                if os.path.exists(path):
+                    shutil.copy2(path, seed_path + '.tmp')
+                    os.rename(seed_path + '.tmp', seed_path)
+                elif os.path.exists(seed_path):
+                    os.remove(seed_path)
+            except (IOError, OSError) as exc:
+                log.debug("Failed to share %s: %s" % (name, exc))
+
+    def stop(self):
+        """
+        Stops all the tor processes and removes the shared directory
+        information.
+        """
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.cancel()
+        self._idleCall = None
+        if self._shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        for member in self.members:
+            member.stop()
+        if self.seedDirectory is not None:
+            shutil.rmtree(self.seedDirectory, ignore_errors=True)
+            self.seedDirectory = None
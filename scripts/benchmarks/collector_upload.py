@@ -0,0 +1,126 @@
+# This benchmarks how many report entries per second the OONIBReporter is able
+# to submit to a collector, with and without batching.
+#
+# Usage:
+#
+#   python scripts/benchmarks/collector_upload.py [entries] [latency]
+#
+# A stand-in collector is started on localhost. It delays every response by
+# latency seconds (default 0.5) to simulate the round trip time of an onion
+# service collector.
+import sys
+import json
+import time
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+
+from ooni.backend_client import CollectorClient
+from ooni.reporter import OONIBReporter, ReportSink
+
+test_details = {
+    'test_name': 'benchmark',
+    'test_version': '0.0.0',
+    'software_name': 'ooniprobe',
+    'software_version': '0.0.0',
+    'input_hashes': [],
+    'probe_asn': 'AS0',
+    'probe_cc': 'ZZ',
+    'test_start_time': '2016-01-01 00:00:00',
+    'data_format_version': '0.2.0'
+}
+
+
+class StandInCollector(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, latency, batch_upload):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.batch_upload = batch_upload
+        self.entries = 0
+        self.requests = 0
+
+    def render_POST(self, request):
+        self.requests += 1
+        if request.path == '/report':
+            response = {
+                'report_id': 'BENCHMARK',
+                'backend_version': 'benchmark',
+                'supported_formats': ['yaml', 'json'],
+                'batch_upload': self.batch_upload
+            }
+        elif request.path.endswith('/close'):
+            response = {}
+        else:
+            content = json.loads(request.content.read())['content']
+            if isinstance(content, list):
+                self.entries += len(content)
+            else:
+                self.entries += 1
+            response = {'status': 'success'}
+
+        def respond():
+            request.write(json.dumps(response))
+            request.finish()
+        reactor.callLater(self.latency, respond)
+        return server.NOT_DONE_YET
+
+
+def makeEntry(idx):
+    return {
+        'input': 'http://example.com/%d' % idx,
+        'body': 'A' * 2048,
+        'headers': {'Content-Type': 'text/html'}
+    }
+
+
+@defer.inlineCallbacks
+def run(number, latency, batch_upload):
+    collector = StandInCollector(latency, batch_upload)
+    port = reactor.listenTCP(0, server.Site(collector), interface='127.0.0.1')
+    client = CollectorClient('http://127.0.0.1:%d' % port.getHost().port)
+    reporter = OONIBReporter(dict(test_details), client)
+
+    yield reporter.createReport()
+    start_time = time.time()
+    if reporter.batching:
+        written = [reporter.writeReportEntry(makeEntry(idx))
+                   for idx in xrange(number)]
+        # Don't wait for the batch interval to expire.
+        reporter.flushBatch()
+    else:
+        # This is what Report.write does for collectors that do not support
+        # batching.
+        sink = ReportSink(reporter, max_in_flight=15)
+        sink.maxPending = number
+        written = [sink.write(makeEntry(idx)) for idx in xrange(number)]
+    yield defer.gatherResults(written)
+    yield reporter.finish()
+    runtime = time.time() - start_time
+
+    assert collector.entries == number
+    yield port.stopListening()
+    defer.returnValue((runtime, collector.requests))
+
+
+@defer.inlineCallbacks
+def main():
+    number = 1000
+    latency = 0.5
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2])
+
+    print "%10s %10s %10s %12s" % ("mode", "requests", "total (s)",
+                                   "entries/s")
+    for mode, batch_upload in (("single", False), ("batch", True)):
+        runtime, requests = yield run(number, latency, batch_upload)
+        print "%10s %10d %10.3f %12.1f" % (mode, requests, runtime,
+                                           number / runtime)
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,123 @@
+# This benchmarks how many web_connectivity control requests per second can be
+# made to a test helper, with and without batching.
+#
+# Usage:
+#
+#   python scripts/benchmarks/control_batch.py [urls] [latency] [concurrency]
+#
+# A stand-in web connectivity test helper is started on localhost. It delays
+# every response by latency seconds (default 0.5) to simulate the round trip
+# time of a helper reached over Tor, and the first response on every new
+# connection by another two round trips, which is what setting up the TCP
+# connection and the TLS session through the circuit costs. The control
+# requests are made by concurrency (default 20) measurements at a time, like
+# the MeasurementManager does.
+import sys
+import json
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+from ooni import backend_client
+from ooni.backend_client import WebConnectivityClient
+
+
+class StandInHelper(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, latency, batch_control):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.batch_control = batch_control
+        self.controls = 0
+        self.requests = 0
+        self.connections = set()
+
+    def control(self, request):
+        self.controls += 1
+        return {
+            'tcp_connect': dict((socket, {'status': True, 'failure': None})
+                                for socket in request['tcp_connect']),
+            'dns': {'addrs': ['93.184.216.34'], 'failure': None},
+            'http_request': {'body_length': 1270, 'failure': None,
+                             'status_code': 200, 'headers': {},
+                             'title': 'Example Domain'}
+        }
+
+    def respond(self, request, response):
+        def respond():
+            request.write(json.dumps(response))
+            request.finish()
+        latency = self.latency
+        if request.channel not in self.connections:
+            self.connections.add(request.channel)
+            latency += 2 * self.latency
+        reactor.callLater(latency, respond)
+        return server.NOT_DONE_YET
+
+    def render_GET(self, request):
+        self.requests += 1
+        return self.respond(request, {'status': 'ok',
+                                      'batch_control': self.batch_control})
+
+    def render_POST(self, request):
+        self.requests += 1
+        body = json.loads(request.content.read())
+        if request.path == '/batch':
+            response = {'responses': map(self.control, body['requests'])}
+        else:
+            response = self.control(body)
+        return self.respond(request, response)
+
+
+@defer.inlineCallbacks
+def run(number, latency, concurrency, batch_control):
+    helper = StandInHelper(latency, batch_control)
+    port = reactor.listenTCP(0, server.Site(helper), interface='127.0.0.1')
+    address = 'http://127.0.0.1:%d' % port.getHost().port
+
+    def measurements():
+        for idx in xrange(number):
+            client = WebConnectivityClient(address)
+            yield client.control('http://example.com/%d' % idx,
+                                 ['93.184.216.34:80'])
+
+    start_time = time.time()
+    cooperator = task.Cooperator()
+    work = measurements()
+    yield defer.DeferredList([cooperator.coiterate(work)
+                              for _ in range(concurrency)])
+    runtime = time.time() - start_time
+
+    assert helper.controls == number
+    backend_client._control_batchers.clear()
+    yield backend_client.closeConnectionPools()
+    yield port.stopListening()
+    defer.returnValue((runtime, helper.requests, len(helper.connections)))
+
+
+@defer.inlineCallbacks
+def main():
+    number = 1000
+    latency = 0.5
+    concurrency = 20
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        concurrency = int(sys.argv[3])
+
+    print "%10s %10s %12s %10s %12s" % ("mode", "requests", "connections",
+                                        "total (s)", "controls/s")
+    for mode, batch_control in (("single", False), ("batch", True)):
+        runtime, requests, connections = yield run(number, latency,
+                                                   concurrency, batch_control)
+        print "%10s %10d %12d %10.3f %12.1f" % (mode, requests, connections,
+                                                runtime, number / runtime)
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,84 @@
+# This benchmarks how many DNS queries per second the DNS tests can make with
+# either of the DNS backends.
+#
+# Usage:
+#
+#   python scripts/benchmarks/dns_engine.py [queries] [concurrency]
+#
+# A stand-in DNS server is started on localhost, which answers every A query
+# right away. The queries (default 5000) are made by DNSTest.performALookup
+# with the cache bypassed, concurrency (default 500) at a time, first with
+# the "resolver" backend, which opens a UDP port for every query, and then
+# with the "engine" backend.
+import sys
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.names import dns
+
+from ooni.templates import dnst
+from ooni.utils.dnsengine import dns_engine
+
+
+class StandInServer(protocol.DatagramProtocol):
+    noisy = False
+
+    def datagramReceived(self, data, addr):
+        message = dns.Message()
+        message.fromStr(data)
+        name = str(message.queries[0].name)
+        answer = dns.Message(message.id, answer=1)
+        answer.queries = message.queries
+        answer.answers = [dns.RRHeader(name=name, type=dns.A,
+                                       payload=dns.Record_A('127.0.0.1'))]
+        self.transport.write(answer.toStr(), addr)
+
+
+@defer.inlineCallbacks
+def run(backend, number, concurrency, address):
+    dns_test = dnst.DNSTest()
+    dns_test._setUp()
+    dns_test.dnsBackend = backend
+    dns_test.queryTimeout = [5]
+
+    def lookups():
+        for idx in xrange(number):
+            yield dns_test.performALookup('%d.example.com' % idx, address,
+                                          bypass_cache=True)
+
+    start_time = time.time()
+    cooperator = task.Cooperator()
+    work = lookups()
+    yield defer.DeferredList([cooperator.coiterate(work)
+                              for _ in range(concurrency)])
+    runtime = time.time() - start_time
+    failures = len([query for query in dns_test.report['queries']
+                    if query['failure']])
+    defer.returnValue((runtime, failures))
+
+
+@defer.inlineCallbacks
+def main():
+    number = 5000
+    concurrency = 500
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        concurrency = int(sys.argv[2])
+
+    port = reactor.listenUDP(0, StandInServer(), interface='127.0.0.1')
+    address = ('127.0.0.1', port.getHost().port)
+
+    print "%10s %10s %10s %12s" % ("backend", "failures", "total (s)",
+                                   "queries/s")
+    for backend in ("resolver", "engine"):
+        runtime, failures = yield run(backend, number, concurrency, address)
+        print "%10s %10d %10.3f %12.1f" % (backend, failures, runtime,
+                                           number / runtime)
+    yield dns_engine.stop()
+    yield port.stopListening()
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,97 @@
+# This benchmarks how much memory HTTPTest needs to fetch large responses.
+#
+# Usage:
+#
+#   python scripts/benchmarks/http_body.py [size in MB] [concurrency]
+#
+# A stand-in web server on localhost answers every request with a body of the
+# given size (default 32MB). The body is fetched by concurrency (default 10)
+# HTTPTest measurements at the same time, once keeping the whole bodies and
+# once with the default max_http_body_size. Every case runs in its own
+# process, whose peak RSS is printed.
+import os
+import sys
+import time
+import resource
+import subprocess
+
+from twisted.internet import defer, reactor
+from twisted.web import resource as web_resource, server
+
+
+class LargeBody(web_resource.Resource):
+    isLeaf = True
+
+    def __init__(self, size):
+        web_resource.Resource.__init__(self)
+        self.size = size
+
+    def render_GET(self, request):
+        request.setHeader('Content-Length', str(self.size))
+        chunk = 'A' * 65536
+        remaining = [self.size]
+
+        def write():
+            if remaining[0] <= 0:
+                request.finish()
+                return
+            data = chunk[:remaining[0]]
+            remaining[0] -= len(data)
+            request.write(data)
+            reactor.callLater(0, write)
+        write()
+        return server.NOT_DONE_YET
+
+
+@defer.inlineCallbacks
+def measure(size, concurrency, max_body_size):
+    from ooni.settings import config
+    from ooni.templates import httpt
+
+    config.advanced.max_http_body_size = max_body_size
+
+    port = reactor.listenTCP(0, server.Site(LargeBody(size)),
+                             interface='127.0.0.1')
+    url = 'http://127.0.0.1:%d/' % port.getHost().port
+
+    def fetch():
+        http_test = httpt.HTTPTest()
+        http_test.localOptions['socksproxy'] = None
+        http_test._setUp()
+        return http_test.doRequest(url)
+
+    start_time = time.time()
+    responses = yield defer.gatherResults([fetch()
+                                           for _ in range(concurrency)])
+    runtime = time.time() - start_time
+    assert all(response.bodyLength == size for response in responses)
+    yield port.stopListening()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print "%.3f %.1f" % (runtime, peak_rss)
+    reactor.stop()
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 \
+        else 32 * 1024 * 1024
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    print "%14s %10s %15s" % ("max body size", "total (s)", "peak RSS (MB)")
+    for max_body_size in ('-1', '1048576'):
+        output = subprocess.check_output([
+            sys.executable, __file__, '--measure', str(size),
+            str(concurrency), max_body_size
+        ], env=os.environ)
+        runtime, peak_rss = output.split()[-2:]
+        print "%14s %10s %15s" % (
+            'unlimited' if max_body_size == '-1' else max_body_size,
+            runtime, peak_rss)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--measure']:
+        max_body_size = int(sys.argv[4])
+        reactor.callWhenRunning(measure, int(sys.argv[2]), int(sys.argv[3]),
+                                None if max_body_size < 0 else max_body_size)
+        reactor.run()
+    else:
+        main()
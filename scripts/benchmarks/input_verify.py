@@ -0,0 +1,70 @@
+# This benchmarks how long verifying a cached input file takes and how much
+# memory it needs.
+#
+# Usage:
+#
+#   python scripts/benchmarks/input_verify.py [size in MB]
+#
+# An input file of the given size (default 256MB) is written to a temporary
+# directory and hashed by reading it all at once, like InputFile.verify used
+# to do, then verified with InputFile.verify, first when it has never been
+# verified and then once it has. Every case runs in its own process, whose
+# peak RSS is printed.
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+from hashlib import sha256
+
+
+def measure(mode, path):
+    from ooni.deck import InputFile
+
+    input_file = InputFile(os.path.basename(path),
+                           base_path=os.path.dirname(path))
+    start_time = time.time()
+    if mode == 'read':
+        with open(path) as f:
+            assert sha256(f.read()).hexdigest() == input_file.id
+    else:
+        input_file.verify()
+    runtime = time.time() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print "%.3f %.1f" % (runtime, peak_rss)
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 \
+        else 256 * 1024 * 1024
+
+    directory = tempfile.mkdtemp()
+    try:
+        tmp_path = os.path.join(directory, 'input')
+        file_hash = sha256()
+        chunk = os.urandom(1024 * 1024)
+        with open(tmp_path, 'wb') as f:
+            for _ in range(size / len(chunk)):
+                f.write(chunk)
+                file_hash.update(chunk)
+        path = os.path.join(directory, file_hash.hexdigest())
+        os.rename(tmp_path, path)
+
+        print "%12s %10s %15s" % ("mode", "total (s)", "peak RSS (MB)")
+        for mode, label in (('read', 'read all'), ('verify', 'chunked'),
+                            ('verify', 'memoized')):
+            output = subprocess.check_output([
+                sys.executable, __file__, '--measure', mode, path
+            ], env=os.environ)
+            runtime, peak_rss = output.split()[-2:]
+            print "%12s %10s %15s" % (label, runtime, peak_rss)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        main()
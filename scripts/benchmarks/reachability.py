@@ -0,0 +1,111 @@
+# This benchmarks how long looking up a reachable collector takes when the
+# preferred collectors are down.
+#
+# Usage:
+#
+#   python scripts/benchmarks/reachability.py [down] [delay]
+#
+# Stand-in collectors are started on localhost. The first down (default 2)
+# of them, in order of preference, take delay seconds (default 3) to fail,
+# like an onion service that cannot be reached, and the other two answer
+# right away. The collector is looked up by checking the collectors one
+# after the other, like Deck.getReachableCollector used to do, then by
+# Deck.getReachableCollector, without and with the reachability cache.
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+
+from ooni.deck import Deck
+from ooni.settings import config
+from ooni.utils.reachability import ReachabilityCache, first_reachable
+
+
+class StandInCollector(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, delay):
+        resource.Resource.__init__(self)
+        self.delay = delay
+
+    def render_GET(self, request):
+        # The collectors tell they are reachable by answering requests for
+        # an invalid path with a 404 error.
+        if self.delay:
+            response = '{"error": 502}'
+        else:
+            response = '{"error": 404}'
+
+        def respond():
+            request.write(response)
+            request.finish()
+        reactor.callLater(self.delay, respond)
+        return server.NOT_DONE_YET
+
+
+@defer.inlineCallbacks
+def one_after_the_other(deck, address, alternates):
+    for collector_settings in deck.sortAddressesByPriority(address,
+                                                           alternates):
+        collector = deck._CollectorClient(settings=collector_settings)
+        collector = yield first_reachable(
+            'collector', [(collector_settings['address'], collector)])
+        if collector is not None:
+            defer.returnValue(collector)
+
+
+@defer.inlineCallbacks
+def main():
+    down = 2
+    delay = 3.0
+    if len(sys.argv) > 1:
+        down = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        delay = float(sys.argv[2])
+
+    # The stand-in collectors are plaintext HTTP ones
+    config.advanced.insecure_backend = True
+    ports = []
+    addresses = []
+    for idx in range(down + 2):
+        collector = StandInCollector(delay if idx < down else 0)
+        port = reactor.listenTCP(0, server.Site(collector),
+                                 interface='127.0.0.1')
+        ports.append(port)
+        addresses.append('http://127.0.0.1:%d' % port.getHost().port)
+    alternates = [{'type': 'http', 'address': address}
+                  for address in addresses[1:]]
+
+    directory = tempfile.mkdtemp()
+    cache_path = os.path.join(directory, 'reachability.json')
+    deck = Deck()
+    print "%16s %10s" % ("mode", "total (s)")
+    for mode, lookup in (
+            ("one at a time", lambda: one_after_the_other(
+                deck, addresses[0], alternates)),
+            ("concurrent", lambda: deck.getReachableCollector(
+                addresses[0], alternates)),
+            ("cache miss", lambda: deck.getReachableCollector(
+                addresses[0], alternates,
+                cache=ReachabilityCache(cache_path, ttl=60))),
+            ("cache hit", lambda: deck.getReachableCollector(
+                addresses[0], alternates,
+                cache=ReachabilityCache(cache_path, ttl=60)))):
+        start_time = time.time()
+        collector = yield lookup()
+        runtime = time.time() - start_time
+        assert collector.base_address == addresses[down]
+        print "%16s %10.3f" % (mode, runtime)
+
+    shutil.rmtree(directory)
+    for port in ports:
+        yield port.stopListening()
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,62 @@
+# This benchmarks how long the report log takes to update the status of a
+# report, depending on how many reports it keeps track of.
+#
+# Usage:
+#
+#   python scripts/benchmarks/report_log.py [updates]
+#
+# For every size, a report log is filled with that many reports that could
+# not be created, like on a probe that has been offline for a while. Then
+# the time a report takes to go through created, incomplete and closed is
+# measured, averaged over updates (default 50) reports, as well as how long
+# listing the reports to upload takes.
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+
+from ooni.reporter import OONIBReportLog
+
+
+@defer.inlineCallbacks
+def run(size, updates):
+    directory = tempfile.mkdtemp()
+    try:
+        report_log = OONIBReportLog(os.path.join(directory, 'reporting.log'))
+        for idx in xrange(size):
+            yield report_log.creation_failed('pending-%d.yaml' % idx,
+                                             'httpo://foo.onion')
+
+        start_time = time.time()
+        for idx in xrange(updates):
+            report_file = 'report-%d.yaml' % idx
+            yield report_log.created(report_file, 'httpo://foo.onion', 'id')
+            yield report_log.incomplete(report_file)
+            yield report_log.closed(report_file)
+        update_time = (time.time() - start_time) / updates
+
+        start_time = time.time()
+        assert len(report_log.reports_to_upload) == size
+        list_time = time.time() - start_time
+    finally:
+        shutil.rmtree(directory)
+    defer.returnValue((update_time, list_time))
+
+
+@defer.inlineCallbacks
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print "%8s %20s %20s" % ("reports", "created..closed (ms)",
+                             "list to upload (ms)")
+    for size in (100, 1000, 10000):
+        update_time, list_time = yield run(size, updates)
+        print "%8d %20.2f %20.2f" % (size, update_time * 1000,
+                                     list_time * 1000)
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
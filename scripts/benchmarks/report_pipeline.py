@@ -0,0 +1,106 @@
+# This benchmarks the per entry overhead of writing report entries through
+# ooni.reporter.ReportSink against the previous design, in which every entry
+# was written by its own ReportEntry task scheduled on a TaskManager.
+#
+# Usage:
+#
+#   python scripts/benchmarks/report_pipeline.py [entries]
+#
+# Entries are written to a reporter that discards them, so that only the
+# overhead of the pipeline is measured. Every mode is run in its own process to
+# be able to report its peak memory usage.
+import os
+import sys
+import time
+import resource
+import subprocess
+
+from twisted.internet import defer
+
+from ooni.managers import TaskManager
+from ooni.reporter import ReportSink
+from ooni.tasks import TaskWithTimeout
+
+
+class NullReporter(object):
+    def writeReportEntry(self, entry):
+        pass
+
+
+class LegacyReportEntry(TaskWithTimeout):
+    def __init__(self, reporter, entry):
+        self.reporter = reporter
+        self.entry = entry
+        self.timeout = 80
+        TaskWithTimeout.__init__(self)
+
+    def run(self):
+        return self.reporter.writeReportEntry(self.entry)
+
+
+class LegacyReportEntryManager(TaskManager):
+    concurrency = 15
+    retries = 3
+
+    def succeeded(self, result, task):
+        pass
+
+    def failed(self, failure, task):
+        pass
+
+
+def legacyWrite(manager, reporter, entry):
+    d = defer.Deferred()
+
+    def all_reports_written(_):
+        if not d.called:
+            d.callback(None)
+
+    write_report = LegacyReportEntry(reporter, entry)
+    manager.schedule(write_report)
+    dl = defer.DeferredList([write_report.done])
+    dl.addCallback(all_reports_written)
+    return d
+
+
+def makeEntry(idx):
+    return {'input': 'http://example.com/%d' % idx, 'body': 'A' * 128}
+
+
+def run(mode, number):
+    reporter = NullReporter()
+    written = []
+    start_time = time.time()
+    if mode == 'legacy':
+        manager = LegacyReportEntryManager()
+        for idx in xrange(number):
+            written.append(legacyWrite(manager, reporter, makeEntry(idx)))
+    else:
+        sink = ReportSink(reporter)
+        for idx in xrange(number):
+            written.append(sink.write(makeEntry(idx)))
+    runtime = time.time() - start_time
+    assert all(d.called for d in written)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%10s %10d %14.2f %14d" % (mode, number,
+                                      runtime / number * 10 ** 6, max_rss)
+
+
+def main():
+    number = 100000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        run(sys.argv[2], number)
+        return
+
+    print "%10s %10s %14s %14s" % ("mode", "entries", "per entry (us)",
+                                   "max rss (kB)")
+    sys.stdout.flush()
+    for mode in ('legacy', 'sink'):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               str(number), mode])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# This benchmarks how many report entries per second oonireport is able to
+# upload when it has a backlog of reports to upload.
+#
+# Usage:
+#
+#   python scripts/benchmarks/report_upload.py [reports] [entries] [latency]
+#
+# A stand-in collector is started on localhost. It delays every response by
+# latency seconds (default 0.1) to simulate the round trip time of an onion
+# service collector. The reports (default 8), of entries (default 100)
+# measurements each, are uploaded with upload_all, first one report and one
+# entry at a time, then several reports and entries at a time and finally to
+# a collector that supports batch uploads.
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+
+from ooni.settings import config
+from ooni.reporter import JSONLReporter, OONIBReportLog
+from ooni.report import tool
+
+test_details = {
+    'test_name': 'benchmark',
+    'test_version': '0.0.0',
+    'software_name': 'ooniprobe',
+    'software_version': '0.0.0',
+    'input_hashes': [],
+    'probe_asn': 'AS0',
+    'probe_cc': 'ZZ',
+    'test_start_time': '2016-01-01 00:00:00',
+    'data_format_version': '0.2.0'
+}
+
+
+class StandInCollector(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, latency, batch_upload):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.batch_upload = batch_upload
+        self.entries = 0
+        self.requests = 0
+
+    def render_POST(self, request):
+        self.requests += 1
+        if request.path == '/report':
+            response = {
+                'report_id': 'BENCHMARK',
+                'backend_version': 'benchmark',
+                'supported_formats': ['yaml', 'json'],
+                'batch_upload': self.batch_upload
+            }
+        elif request.path.endswith('/close'):
+            response = {}
+        else:
+            content = json.loads(request.content.read())['content']
+            if isinstance(content, list):
+                self.entries += len(content)
+            else:
+                self.entries += 1
+            response = {'status': 'success'}
+
+        def respond():
+            request.write(json.dumps(response))
+            request.finish()
+        reactor.callLater(self.latency, respond)
+        return server.NOT_DONE_YET
+
+
+def write_reports(directory, reports, entries):
+    report_files = []
+    for report_idx in range(reports):
+        report_file = os.path.join(directory, 'report-%d.jsonl' % report_idx)
+        reporter = JSONLReporter(test_details, report_file)
+        reporter.createReport()
+        for idx in xrange(entries):
+            reporter.writeReportEntry({
+                'input': 'http://example.com/%d' % idx,
+                'body': 'A' * 2048,
+                'headers': {'Content-Type': 'text/html'}
+            })
+        reporter.finish()
+        report_files.append(report_file)
+    return report_files
+
+
+@defer.inlineCallbacks
+def run(report_files, latency, batch_upload, concurrency,
+        reporting_concurrency):
+    collector = StandInCollector(latency, batch_upload)
+    port = reactor.listenTCP(0, server.Site(collector), interface='127.0.0.1')
+    address = 'http://127.0.0.1:%d' % port.getHost().port
+    config.advanced.reporting_concurrency = reporting_concurrency
+
+    directory = tempfile.mkdtemp()
+    report_log = OONIBReportLog(os.path.join(directory, 'reporting.sqlite'))
+    for report_file in report_files:
+        yield report_log.creation_failed(report_file, address)
+
+    start_time = time.time()
+    yield tool.upload_all(concurrency=concurrency, report_log=report_log)
+    runtime = time.time() - start_time
+
+    assert not report_log.reports_to_upload
+    report_log.close()
+    shutil.rmtree(directory)
+    yield port.stopListening()
+    defer.returnValue((runtime, collector.entries, collector.requests))
+
+
+@defer.inlineCallbacks
+def main():
+    reports = 8
+    entries = 100
+    latency = 0.1
+    if len(sys.argv) > 1:
+        reports = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        entries = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        latency = float(sys.argv[3])
+
+    directory = tempfile.mkdtemp()
+    report_files = write_reports(directory, reports, entries)
+    results = []
+    for mode, batch_upload, concurrency, reporting_concurrency in (
+            ("sequential", False, 1, 1),
+            ("concurrent", False, 4, 15),
+            ("batch", True, 4, 15)):
+        runtime, uploaded, requests = yield run(report_files, latency,
+                                                batch_upload, concurrency,
+                                                reporting_concurrency)
+        assert uploaded == reports * entries
+        results.append((mode, requests, runtime))
+    shutil.rmtree(directory)
+
+    print
+    print "%10s %10s %10s %12s" % ("mode", "requests", "total (s)",
+                                   "entries/s")
+    for mode, requests, runtime in results:
+        print "%10s %10d %10.3f %12.1f" % (mode, requests, runtime,
+                                           reports * entries / runtime)
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,78 @@
+# This benchmarks how long it takes ooniprobe to start.
+#
+# Usage:
+#
+#   python scripts/benchmarks/startup.py [runs]
+#
+# It times, in a fresh ooni home, "ooniprobe -s" with no nettest cache, with
+# the cache that the previous run has left behind, and the run of a single
+# nettest that does nothing, which should not need to look at the installed
+# nettests at all. For every case the best of a number of runs is printed.
+#
+# As ooniprobe keeps running once the nettest is done, the run of the nettest
+# is timed until its report gets closed.
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+ooniprobe = os.path.join(os.path.dirname(__file__), '..', '..', 'bin',
+                         'ooniprobe')
+
+empty_net_test = """
+from ooni.nettest import NetTestCase
+
+class EmptyTest(NetTestCase):
+    def test_nothing(self):
+        pass
+"""
+
+
+def run(home, args, before=None):
+    env = os.environ.copy()
+    env['HOME'] = home
+    if before:
+        before()
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable, ooniprobe] + args,
+                                   env=env, stdout=subprocess.PIPE,
+                                   stderr=devnull)
+        for line in iter(process.stdout.readline, ''):
+            if line.startswith('Report ID'):
+                process.terminate()
+                break
+        process.wait()
+    return time.time() - start
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    home = tempfile.mkdtemp()
+    cache_file = os.path.join(home, '.ooni', 'nettests.json')
+    net_test_file = os.path.join(home, 'empty_test.py')
+    with open(net_test_file, 'w') as f:
+        f.write(empty_net_test)
+
+    def remove_cache():
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+    cases = [
+        ('ooniprobe -s (cold)', ['-s'], remove_cache),
+        ('ooniprobe -s (warm)', ['-s'], None),
+        ('single nettest', ['-n', '-N', '-g', net_test_file], None)
+    ]
+    try:
+        # Creates the ooni home
+        run(home, ['-s'])
+        for name, args, before in cases:
+            best = min(run(home, args, before) for _ in range(runs))
+            print "%-20s %6.3fs" % (name, best)
+    finally:
+        shutil.rmtree(home)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# This benchmarks the per task scheduling cost of ooni.managers.TaskManager.
+#
+# Usage:
+#
+#   python scripts/benchmarks/task_manager.py [max_tasks]
+#
+# For every run it prints the number of tasks scheduled, the total time it took
+# to run all of them and the time spent per task. Every tenth task fails once
+# so that the retry heap is exercised as well. The time per task should stay
+# roughly constant as the number of tasks grows.
+import sys
+import time
+
+from twisted.internet import defer
+
+from ooni.tasks import BaseTask
+from ooni.managers import TaskManager
+
+
+class SyntheticTask(BaseTask):
+    def __init__(self, fail_once=False):
+        BaseTask.__init__(self)
+        self.fail_once = fail_once
+
+    def run(self):
+        if self.fail_once and self.failures == 0:
+            return defer.fail(Exception("synthetic failure"))
+        return defer.succeed(None)
+
+
+class BenchmarkTaskManager(TaskManager):
+    concurrency = 10
+
+    def __init__(self):
+        TaskManager.__init__(self)
+        self.completed = 0
+
+    def succeeded(self, result, task):
+        self.completed += 1
+
+    def failed(self, failure, task):
+        pass
+
+
+def run(number):
+    manager = BenchmarkTaskManager()
+    tasks = (SyntheticTask(fail_once=(i % 10 == 0)) for i in xrange(number))
+    start_time = time.time()
+    manager.schedule(tasks)
+    runtime = time.time() - start_time
+    assert manager.completed == number
+    return runtime
+
+
+def main():
+    max_tasks = 10 ** 6
+    if len(sys.argv) > 1:
+        max_tasks = int(sys.argv[1])
+
+    print "%10s %10s %14s" % ("tasks", "total (s)", "per task (us)")
+    number = 1000
+    while number <= max_tasks:
+        runtime = run(number)
+        print "%10d %10.3f %14.2f" % (number, runtime,
+                                       runtime / number * 10 ** 6)
+        number *= 10
+
+if __name__ == "__main__":
+    main()
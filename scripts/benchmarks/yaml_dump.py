@@ -0,0 +1,76 @@
+# This benchmarks the throughput of the YAML dumpers used to write reports.
+#
+# Usage:
+#
+#   python scripts/benchmarks/yaml_dump.py [entries]
+#
+# It serialises a number of web_connectivity like report entries, with headers
+# and a 16kB HTTP body each, using the pure python OSafeDumper and the libyaml
+# based OCSafeDumper, and prints the number of entries and bytes written per
+# second by each of them.
+import sys
+import time
+
+import yaml
+
+from ooni.reporter import OSafeDumper, OCSafeDumper
+
+
+def makeEntry(idx):
+    body = ''.join('<p>Paragraph %d of the page, with some text.</p>\n' % i
+                   for i in range(350))
+    return {
+        'input': 'http://example.com/%d' % idx,
+        'test_start_time': 1453887523.12,
+        'test_runtime': 0.5 + 0.25j,
+        'requests': [{
+            'request': {
+                'method': 'GET',
+                'url': 'http://example.com/%d' % idx,
+                'headers': {'User-Agent': ['Mozilla/5.0 (Windows NT 6.1)'],
+                            'Accept': ['text/html']},
+                'body': None
+            },
+            'response': {
+                'code': 200,
+                'headers': {'Content-Type': ['text/html'],
+                            'Server': ['nginx'],
+                            'Set-Cookie': ['a=b', 'c=d']},
+                'body': body
+            }
+        }],
+        'queries': [{'hostname': 'example.com', 'query_type': 'A',
+                     'answers': [{'ipv4': '93.184.216.34', 'ttl': None}]}],
+        'body_length_match': True,
+        'headers_match': True,
+        'accessible': True,
+        'blocking': False
+    }
+
+
+def run(dumper, entries):
+    written = 0
+    start_time = time.time()
+    for entry in entries:
+        written += len(yaml.dump_all([entry], Dumper=dumper))
+    runtime = time.time() - start_time
+    print "%14s %10d %14.1f %14.1f" % (dumper.__name__, len(entries),
+                                        len(entries) / runtime,
+                                        written / runtime / 1024)
+
+
+def main():
+    number = 1000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    entries = [makeEntry(idx) for idx in range(number)]
+
+    print "%14s %10s %14s %14s" % ("dumper", "entries", "entries/s", "kB/s")
+    run(OSafeDumper, entries)
+    if OCSafeDumper is None:
+        print "libyaml is not available"
+    else:
+        run(OCSafeDumper, entries)
+
+if __name__ == "__main__":
+    main()